@@ -0,0 +1,82 @@
+from datetime import timedelta
+
+from django.db import connections, router
+
+from .models import Sale
+from .writeback import chunks
+
+POINTS_PER_QUERY = 500
+
+# Postgres: one LATERAL ordered LIMIT 1 lookup on the (barcode, sale_time, id) index per point
+LATERAL_SQL = '''
+SELECT points.n, last.total_revenue, last.total_net_profit, last.total_quantity
+FROM (VALUES {values}) AS points (n, barcode, at)
+LEFT JOIN LATERAL (
+    SELECT sale.total_revenue, sale.total_net_profit, sale.total_quantity FROM {sale} AS sale
+    WHERE sale.barcode = points.barcode AND sale.sale_time <= points.at
+    ORDER BY sale.sale_time DESC, sale.id DESC LIMIT 1
+) AS last ON true
+'''
+
+# other databases: the same lookup as a correlated subquery picking the sale id
+CORRELATED_SQL = '''
+WITH points (n, barcode, at) AS (VALUES {values})
+SELECT points.n, sale.total_revenue, sale.total_net_profit, sale.total_quantity
+FROM points LEFT JOIN {sale} AS sale ON sale.id = (
+    SELECT last.id FROM {sale} AS last
+    WHERE last.barcode = points.barcode AND last.sale_time <= points.at
+    ORDER BY last.sale_time DESC, last.id DESC LIMIT 1
+)
+'''
+
+
+def last_sale_totals(points):
+    """
+    (revenue, net profit, quantity) running totals of the last sale up to each (barcode, at)
+    point, (0, 0, 0) for points without sales, looked up for all the points with a few
+    set-based queries. Reads from the database the router picks for sales.
+    """
+    connection = connections[router.db_for_read(Sale)]
+    sql = LATERAL_SQL if connection.vendor == 'postgresql' else CORRELATED_SQL
+    totals = [(0, 0, 0)] * len(points)
+    with connection.cursor() as cursor:
+        for chunk in chunks(enumerate(points), POINTS_PER_QUERY):
+            params = []
+            for n, (barcode, at) in chunk:
+                params += [n, barcode, connection.ops.adapt_datetimefield_value(at)]
+            cursor.execute(sql.format(
+                values=', '.join(['(%s, %s, %s)'] * len(chunk)),
+                sale=connection.ops.quote_name(Sale._meta.db_table),
+            ), params)
+            for n, *row in cursor.fetchall():
+                if row[0] is not None:
+                    totals[n] = tuple(row)
+    return totals
+
+
+def build_batch_reports(barcodes, windows):
+    """
+    Reports of every barcode over every (from_time, to_time) window, with the semantics of
+    the single report: the totals of the last sale up to `to_time` minus those of the last
+    sale before `from_time`. Boundaries shared between reports are looked up once.
+    """
+    points = {}
+    for barcode in barcodes:
+        for from_time, to_time in windows:
+            # sale times have microsecond precision, so "before from_time" is "up to 1µs before it"
+            points.setdefault((barcode, from_time - timedelta(microseconds=1)), len(points))
+            points.setdefault((barcode, to_time), len(points))
+    totals = last_sale_totals(list(points))
+
+    reports = []
+    for barcode in barcodes:
+        for from_time, to_time in windows:
+            gt = totals[points[barcode, to_time]]
+            lt = totals[points[barcode, from_time - timedelta(microseconds=1)]]
+            reports.append({
+                'barcode': barcode,
+                'revenue': gt[0] - lt[0],
+                'netProfit': gt[1] - lt[1],
+                'quantity': gt[2] - lt[2],
+            })
+    return reports
@@ -0,0 +1,54 @@
+"""
+Closed periods. A checkpoint freezes the history of a barcode before its `closed_at`: the
+sales before it, the supplies before it and the supply lots those sales consumed can't be
+created, changed or deleted anymore, and every replay of the barcode starts from the stored
+FIFO state instead of its first sale, see app.recalculation.replay_start. Sales of a closed
+period that ran out of stock stay unmatched when supplies arrive later.
+"""
+from .models import Checkpoint, Supply
+
+
+def latest_checkpoints(barcodes):
+    """
+    Latest checkpoint of each of the barcodes that has one, by barcode.
+    """
+    checkpoints = {}
+    for checkpoint in Checkpoint.objects.filter(barcode__in=barcodes).order_by('barcode', 'closed_at'):
+        checkpoints[checkpoint.barcode] = checkpoint
+    return checkpoints
+
+
+def latest_checkpoint(barcode):
+    return Checkpoint.objects.filter(barcode=barcode).order_by('-closed_at').first()
+
+
+def head_lot(checkpoint):
+    """
+    The supply lot the sales of a checkpoint, or of a BarcodeState, ended on, as far as the
+    supply queue needs it. None when they consumed nothing.
+    """
+    if checkpoint.supply_id is None:
+        return None
+    return Supply(id=checkpoint.supply_id, barcode=checkpoint.barcode, supply_time=checkpoint.supply_time,
+                  price=checkpoint.supply_price)
+
+
+def closes_sale(checkpoint, sale_time):
+    return checkpoint is not None and sale_time < checkpoint.closed_at
+
+
+def closes_supply(checkpoint, supply_time, supply_id=None):
+    """
+    Whether the supply at (supply_time, supply_id), a new one without an id, lies in the closed
+    period or up to the lot its sales ended on.
+    """
+    if checkpoint is None:
+        return False
+    if supply_time < checkpoint.closed_at:
+        return True
+    if checkpoint.supply_id is None:
+        return False
+    # a new supply gets the highest id, so it is queued after a head lot with the same time
+    return supply_time < checkpoint.supply_time or (
+        supply_id is not None and (supply_time, supply_id) <= (checkpoint.supply_time, checkpoint.supply_id)
+    )
@@ -0,0 +1,159 @@
+from typing import NamedTuple
+
+import numpy as np
+
+
+class FifoResult(NamedTuple):
+    """
+    Per-sale running totals and FIFO state after each sale. `supply_index` points into the
+    supply arrays, -1 means no supply was reached and the seeded state is carried on.
+    """
+    total_revenue: np.ndarray
+    total_net_profit: np.ndarray
+    total_quantity: np.ndarray
+    supply_index: np.ndarray
+    remaining_q: np.ndarray
+
+
+def fifo_order(timestamps):
+    """
+    Stable order of rows by timestamp, ties keep their input (id) order.
+    """
+    return np.argsort(np.asarray(timestamps), kind='stable')
+
+
+def match_fifo(sale_quantity, sale_price, supply_quantity, supply_price,
+               sale_time=None, supply_time=None, supply_avail_q=0, totals=(0, 0, 0)):
+    """
+    Matches sales against supplies first-in-first-out on columnar arrays.
+
+    Rows are expected in FIFO order unless `sale_time`/`supply_time` are given, in which case
+    they are ordered by them first; results always follow the input order. When seeding from
+    a preceding sale, `supply_avail_q` is what is left of the first supply and `totals` are
+    its (revenue, net profit, quantity). Sale units no supply is left for count at full price
+    as profit. Quantities are expected to be non-negative.
+
+    Everything follows from prefix sums: the revenue and quantity totals are cumulative sums
+    over the sales, and the cost of the first x supplied units is found by `searchsorted` on
+    the cumulative supply quantity.
+    """
+    sale_quantity = np.asarray(sale_quantity, dtype=np.int64)
+    sale_price = np.asarray(sale_price, dtype=np.int64)
+    supply_quantity = np.array(supply_quantity, dtype=np.int64)
+    supply_price = np.asarray(supply_price, dtype=np.int64)
+
+    sale_order = supply_order = None
+    if sale_time is not None:
+        sale_order = fifo_order(sale_time)
+        sale_quantity, sale_price = sale_quantity[sale_order], sale_price[sale_order]
+    if supply_time is not None:
+        supply_order = fifo_order(supply_time)
+        supply_quantity, supply_price = supply_quantity[supply_order], supply_price[supply_order]
+    if supply_avail_q and len(supply_quantity):
+        supply_quantity[0] = supply_avail_q
+
+    revenue0, net_profit0, quantity0 = totals
+    sold = np.cumsum(sale_quantity)
+    revenue = np.cumsum(sale_quantity * sale_price)
+
+    supplied = np.cumsum(supply_quantity)
+    supplied_total = supplied[-1] if len(supplied) else 0
+    cost = np.cumsum(supply_quantity * supply_price)
+
+    matched = np.minimum(sold, supplied_total)
+    if len(supplied):
+        lot = np.searchsorted(supplied, matched, side='left')
+        np.minimum(lot, len(supplied) - 1, out=lot)
+        lot_start = supplied - supply_quantity
+        lot_cost = cost - supply_quantity * supply_price
+        matched_cost = np.take(lot_cost, lot) + (matched - np.take(lot_start, lot)) * np.take(supply_price, lot)
+        remaining_q = np.take(supplied, lot) - matched
+    else:
+        lot = np.full(len(sold), -1, dtype=np.int64)
+        matched_cost = np.zeros(len(sold), dtype=np.int64)
+        remaining_q = np.zeros(len(sold), dtype=np.int64)
+    # sales left without supply end on the last lot with nothing remaining
+    unmatched = sold > supplied_total
+    lot[unmatched] = len(supplied) - 1
+    remaining_q[unmatched] = 0
+
+    _fix_zero_quantity_sales(lot, remaining_q, sale_quantity, supply_quantity, supply_avail_q)
+
+    result = FifoResult(
+        total_revenue=revenue0 + revenue,
+        total_net_profit=net_profit0 + revenue - matched_cost,
+        total_quantity=quantity0 + sold,
+        supply_index=lot,
+        remaining_q=remaining_q,
+    )
+    if supply_order is not None:
+        result = result._replace(supply_index=np.where(lot >= 0, supply_order[lot], -1))
+    if sale_order is not None:
+        inverse = np.empty_like(sale_order)
+        inverse[sale_order] = np.arange(len(sale_order))
+        result = FifoResult(*(column[inverse] for column in result))
+    return result
+
+
+class FifoAllocations(NamedTuple):
+    """
+    Units each sale took from each supply lot, one entry per (sale, lot) pair in FIFO order.
+    Units no supply was left for have no entry.
+    """
+    sale_index: np.ndarray
+    supply_index: np.ndarray
+    quantity: np.ndarray
+    unit_cost: np.ndarray
+
+
+def fifo_allocations(sale_quantity, supply_quantity, supply_price):
+    """
+    Splits the matched units of FIFO ordered sales over the supply lots, from the same prefix
+    sums as `match_fifo`: sale i took the units [sold[i - 1], sold[i]) of the queue, capped at
+    what was supplied, and lot j holds the units [supplied[j - 1], supplied[j]).
+    """
+    sale_quantity = np.asarray(sale_quantity, dtype=np.int64)
+    supply_quantity = np.asarray(supply_quantity, dtype=np.int64)
+    supply_price = np.asarray(supply_price, dtype=np.int64)
+    empty = np.zeros(0, dtype=np.int64)
+    if not len(supply_quantity) or not len(sale_quantity):
+        return FifoAllocations(empty, empty, empty, empty)
+
+    supplied = np.cumsum(supply_quantity)
+    matched_end = np.minimum(np.cumsum(sale_quantity), supplied[-1])
+    matched_start = np.concatenate(([0], matched_end[:-1]))
+    takes = matched_end > matched_start
+    first_lot = np.searchsorted(supplied, matched_start, side='right')
+    last_lot = np.searchsorted(supplied, matched_end - 1, side='right')
+    counts = np.where(takes, last_lot - first_lot + 1, 0)
+
+    sale_index = np.repeat(np.arange(len(sale_quantity)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    lot = np.repeat(first_lot, counts) + offsets
+    quantity = np.minimum(supplied[lot], matched_end[sale_index]) \
+        - np.maximum(supplied[lot] - supply_quantity[lot], matched_start[sale_index])
+    # lots of zero units inside a sale's range take nothing
+    keep = quantity > 0
+    return FifoAllocations(sale_index[keep], lot[keep], quantity[keep], supply_price[lot[keep]])
+
+
+def _fix_zero_quantity_sales(lot, remaining_q, sale_quantity, supply_quantity, supply_avail_q):
+    """
+    A sale of zero units consumes nothing but still moves on to the next lot when the current
+    one is used up. That depends on the state left by the previous sale, so these (rare) sales
+    are resolved in order on top of the vectorized result.
+    """
+    zero_sales = np.flatnonzero(sale_quantity == 0)
+    if not len(zero_sales):
+        return
+    for i in zero_sales.tolist():
+        if i:
+            prev_lot, prev_remaining = lot[i - 1], remaining_q[i - 1]
+        elif supply_avail_q and len(supply_quantity):
+            prev_lot, prev_remaining = 0, supply_avail_q
+        else:
+            prev_lot, prev_remaining = -1, 0
+        if prev_remaining == 0 and prev_lot + 1 < len(supply_quantity):
+            prev_lot += 1
+            prev_remaining = supply_quantity[prev_lot]
+        lot[i], remaining_q[i] = prev_lot, prev_remaining
@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class LockWaitStats:
+    """
+    Time spent waiting for barcode locks, process-wide.
+    """
+    def __init__(self):
+        self._guard = threading.Lock()
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds):
+        with self._guard:
+            self.count += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def snapshot(self):
+        with self._guard:
+            return {
+                'count': self.count,
+                'total_seconds': self.total_seconds,
+                'max_seconds': self.max_seconds,
+            }
+
+
+lock_wait_stats = LockWaitStats()
+
+
+class LocalBarcodeLocks:
+    """
+    In-process per-barcode locks for databases without advisory locks (SQLite, tests).
+    Entries are dropped once nobody holds or waits for them.
+    """
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+
+    def acquire(self, barcode):
+        with self._guard:
+            entry = self._locks.setdefault(barcode, [threading.RLock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def release(self, barcode):
+        with self._guard:
+            entry = self._locks[barcode]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[barcode]
+
+
+local_locks = LocalBarcodeLocks()
+
+# key of the lock taken instead of the barcode locks on SQLite
+SQLITE_WRITER = 'sqlite'
+
+
+@contextmanager
+def barcode_lock(*barcodes):
+    """
+    Runs the block in a transaction holding the locks of the given barcodes, so writes to
+    the same barcode are ordered while writes to different barcodes never wait on each other.
+    Postgres takes transaction-level advisory locks keyed by barcode, other databases fall
+    back to in-process locks, and SQLite to a single one for all barcodes. Locks are taken in
+    barcode order to rule out deadlocks.
+    """
+    barcodes = sorted(set(barcodes))
+    started = time.monotonic()
+    if connection.vendor == 'postgresql':
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for barcode in barcodes:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [barcode])
+            _record_wait(barcodes, started)
+            yield
+        return
+
+    acquired = []
+    # SQLite allows a single writer, and concurrent transactions upgrading to a write lock fail
+    # with "database is locked" instead of waiting, so there the writes take turns as a whole
+    keys = [SQLITE_WRITER] if connection.vendor == 'sqlite' else barcodes
+    try:
+        for key in keys:
+            local_locks.acquire(key)
+            acquired.append(key)
+        _record_wait(barcodes, started)
+        with transaction.atomic():
+            yield
+    finally:
+        for key in reversed(acquired):
+            local_locks.release(key)
+
+
+def _record_wait(barcodes, started):
+    waited = time.monotonic() - started
+    lock_wait_stats.record(waited)
+    logger.debug('waited %.4fs for barcode locks %s', waited, barcodes)
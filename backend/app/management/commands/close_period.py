@@ -0,0 +1,52 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from app.locks import barcode_lock
+from app.models import DirtyBarcode, Sale, Supply
+from app.recalculation import close_period
+from app.tasks import recalculate_dirty
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class Command(BaseCommand):
+    help = 'Closes the period before the given time: checkpoints the FIFO state of the barcodes ' \
+           'and freezes their earlier sales and supplies.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('closed_at', help='End of the closed period, "%s".' % TIME_FORMAT.replace('%', '%%'))
+        parser.add_argument('barcodes', nargs='*', type=int, help='Barcodes to close, all of them when omitted.')
+
+    def handle(self, *args, closed_at, barcodes, **options):
+        label = closed_at
+        try:
+            closed_at = timezone.make_aware(datetime.strptime(closed_at, TIME_FORMAT))
+        except ValueError:
+            raise CommandError('closed_at should be in the format "%s"' % TIME_FORMAT)
+        if closed_at > timezone.now():
+            raise CommandError('Only past periods can be closed')
+        if not barcodes:
+            barcodes = sorted(set(Sale.objects.values_list('barcode', flat=True).distinct())
+                              | set(Supply.objects.values_list('barcode', flat=True).distinct()))
+
+        failed = 0
+        for barcode in barcodes:
+            # the checkpoint is taken from the stored sales, so pending recalculations go first
+            if DirtyBarcode.objects.filter(barcode=barcode).exists():
+                recalculate_dirty(barcode)
+            with barcode_lock(barcode):
+                try:
+                    checkpoint = close_period(barcode, closed_at)
+                except ValueError as exc:
+                    failed += 1
+                    self.stderr.write(self.style.WARNING('barcode %d: %s' % (barcode, exc)))
+                    continue
+            self.stdout.write('barcode %d: revenue %d, net profit %d, quantity %d, supply %s with %d left' % (
+                barcode, checkpoint.total_revenue, checkpoint.total_net_profit, checkpoint.total_quantity,
+                checkpoint.supply_id, checkpoint.remaining_q,
+            ))
+        if failed:
+            raise CommandError('%d of %d barcodes not closed' % (failed, len(barcodes)))
+        self.stdout.write(self.style.SUCCESS('Closed %d barcodes before %s' % (len(barcodes), label)))
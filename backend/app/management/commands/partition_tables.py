@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from app.partitions import PARTITION_KEYS, ensure_partitions, is_partitioned, partition_table
+
+
+class Command(BaseCommand):
+    help = 'Converts the sale and supply tables to monthly range partitions on their time column (PostgreSQL).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, help='Months to create partitions for in advance, '
+                                                               'PARTITION_MONTHS_AHEAD by default.')
+
+    def handle(self, *args, months_ahead, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Table partitioning needs PostgreSQL, not %s' % connection.vendor)
+        for table in PARTITION_KEYS:
+            with connection.cursor() as cursor:
+                partitioned = is_partitioned(cursor, table)
+            if partitioned:
+                self.stdout.write('%s is already partitioned' % table)
+                continue
+            try:
+                partition_table(table, months_ahead)
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write('Partitioned %s' % table)
+        created = ensure_partitions(months_ahead)
+        self.stdout.write(self.style.SUCCESS('Partitioned tables, %d partitions created in addition' % len(created)))
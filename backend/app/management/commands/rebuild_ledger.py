@@ -0,0 +1,119 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.utils.timezone import make_aware
+
+from app.checkpoints import latest_checkpoint
+from app.locks import barcode_lock
+from app.models import Sale, Supply
+from app.recalculation import recalculate_from, refresh_supply_totals, verify_from
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def rebuild_barcode(barcode, since=None, dry_run=False):
+    """
+    Recalculates the supply running totals and the FIFO ledger of one barcode from `since`
+    on, no earlier than its latest checkpoint, or only diffs them against the stored values
+    with `dry_run`. Returns a summary dict.
+    """
+    started = time.perf_counter()
+    checkpoint = latest_checkpoint(barcode)
+    if checkpoint is not None and (since is None or since < checkpoint.closed_at):
+        # closed periods are frozen, the replay starts at their checkpoint
+        since = checkpoint.closed_at
+    supply_since = (since, 0) if since is not None else None
+    with barcode_lock(barcode):
+        supplies = refresh_supply_totals(barcode, supply_since, dry_run=dry_run)
+        if dry_run:
+            diff = verify_from(barcode, since)
+            sales, rows, examples = diff.sales, diff.mismatched, diff.examples
+        else:
+            stats = recalculate_from(barcode, since, trigger='rebuild')
+            sales, rows, examples = stats.sales_read, stats.rows_written, []
+    return {
+        'barcode': barcode,
+        'supplies': supplies,
+        'sales': sales,
+        'rows': rows,
+        'examples': examples,
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def rebuild_worker(args):
+    return rebuild_barcode(*args)
+
+
+def setup_worker():
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = 'Recalculates the FIFO running totals of the sales and supplies, or verifies them with --dry-run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('barcodes', nargs='*', type=int, help='Barcodes to rebuild, all of them when omitted.')
+        parser.add_argument('--since', help='Only recalculate sales and supplies from this time on, "%s".'
+                                            % TIME_FORMAT.replace('%', '%%'))
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes, each with its own connection.')
+        parser.add_argument('--dry-run', action='store_true', help='Diff the recomputed values against the stored ones '
+                                                                   'without writing.')
+
+    def handle(self, *args, barcodes, since, workers, dry_run, **options):
+        if since is not None:
+            try:
+                since = make_aware(datetime.strptime(since, TIME_FORMAT))
+            except ValueError:
+                raise CommandError('--since should be in the format "%s"' % TIME_FORMAT)
+        if workers < 1:
+            raise CommandError('--workers should be at least 1')
+        if workers > 1 and not dry_run and connection.vendor == 'sqlite':
+            self.stderr.write(self.style.WARNING('SQLite allows a single writer, rebuilding with one worker'))
+            workers = 1
+        if not barcodes:
+            barcodes = sorted(set(Sale.objects.values_list('barcode', flat=True).distinct())
+                              | set(Supply.objects.values_list('barcode', flat=True).distinct()))
+
+        tasks = [(barcode, since, dry_run) for barcode in barcodes]
+        started = time.perf_counter()
+        if workers == 1:
+            results = map(rebuild_worker, tasks)
+            self.report(results, len(tasks), started, dry_run)
+        else:
+            # Forked workers must not share the parent's open connections.
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, initializer=setup_worker) as pool:
+                results = pool.map(rebuild_worker, tasks, chunksize=max(1, len(tasks) // (workers * 8)))
+                self.report(results, len(tasks), started, dry_run)
+
+    def report(self, results, count, started, dry_run):
+        sales = supplies = rows = 0
+        for done, result in enumerate(results, 1):
+            sales += result['sales']
+            supplies += result['supplies']
+            rows += result['rows']
+            self.stdout.write('[%d/%d] barcode %d: %d sales, %d %s, %d supply totals %s in %.2fs' % (
+                done, count, result['barcode'], result['sales'], result['rows'],
+                'mismatched' if dry_run else 'rows written', result['supplies'],
+                'wrong' if dry_run else 'fixed', result['seconds'],
+            ))
+            for example in result['examples']:
+                self.stdout.write('    sale %d: stored %s, recomputed %s '
+                                  '(revenue, net profit, quantity, supply, remaining)'
+                                  % (example['id'], example['stored'], example['computed']))
+
+        elapsed = time.perf_counter() - started
+        summary = '%d barcodes, %d sales in %.2fs (%.0f sales/s)' % (
+            count, sales, elapsed, sales / elapsed if elapsed else 0
+        )
+        if not dry_run:
+            self.stdout.write(self.style.SUCCESS('Rebuilt ledger of %s' % summary))
+        elif rows or supplies:
+            raise CommandError('Verified %s: %d sales and %d supply totals differ' % (summary, rows, supplies))
+        else:
+            self.stdout.write(self.style.SUCCESS('Verified %s, no differences' % summary))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from app.locks import barcode_lock
+from app.models import Sale
+from app.rollups import refresh_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the hour and day sale rollups from the running totals of the sales.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('barcodes', nargs='*', type=int, help='Barcodes to rebuild, all of them when omitted.')
+
+    def handle(self, *args, barcodes, **options):
+        if not barcodes:
+            barcodes = Sale.objects.values_list('barcode', flat=True).distinct().order_by('barcode')
+        count = 0
+        for barcode in barcodes:
+            with barcode_lock(barcode):
+                refresh_rollups(barcode)
+            count += 1
+        self.stdout.write(self.style.SUCCESS('Rebuilt rollups of %d barcodes' % count))
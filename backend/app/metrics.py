@@ -0,0 +1,122 @@
+import threading
+from collections import defaultdict
+
+from .locks import lock_wait_stats
+from .report_cache import report_cache_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+def format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels.items()
+    )
+    return '{%s}' % ','.join('%s="%s"' % pair for pair in escaped)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Cumulative histogram per label set, rendered in the Prometheus text format.
+    """
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._guard = threading.Lock()
+        self._series = defaultdict(lambda: [[0] * len(buckets), 0, 0.0])
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._guard:
+            counts, _, _ = series = self._series[key]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._guard:
+            series = sorted((key, list(counts), count, total) for key, (counts, count, total) in self._series.items())
+        for key, counts, count, total in series:
+            labels = dict(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(labels, le=format_value(bound)), bucket_count))
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(labels, le='+Inf'), count))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(labels), format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(labels), count))
+        return lines
+
+
+def render_sample(name, kind, documentation, value):
+    return ['# HELP %s %s' % (name, documentation), '# TYPE %s %s' % (name, kind), '%s %s' % (name, format_value(value))]
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Request latency by endpoint.', ('endpoint', 'method', 'status')
+)
+request_queries = Histogram(
+    'http_request_db_queries', 'Database queries run by a request.', ('endpoint', 'method'), QUERY_BUCKETS
+)
+request_query_duration = Histogram(
+    'http_request_db_duration_seconds', 'Time a request spent in database queries.', ('endpoint', 'method')
+)
+recalculation_duration = Histogram(
+    'recalculation_duration_seconds', 'FIFO recalculation latency by trigger.', ('trigger',)
+)
+recalculation_rows_read = Histogram(
+    'recalculation_rows_read', 'Sale and supply rows read by a FIFO recalculation.', ('trigger',), ROW_BUCKETS
+)
+recalculation_rows_written = Histogram(
+    'recalculation_rows_written', 'Sale rows rewritten by a FIFO recalculation.', ('trigger',), ROW_BUCKETS
+)
+
+HISTOGRAMS = [
+    request_duration,
+    request_queries,
+    request_query_duration,
+    recalculation_duration,
+    recalculation_rows_read,
+    recalculation_rows_written,
+]
+
+
+def record_recalculation(trigger, seconds, rows_read, rows_written):
+    recalculation_duration.observe(seconds, trigger=trigger)
+    recalculation_rows_read.observe(rows_read, trigger=trigger)
+    recalculation_rows_written.observe(rows_written, trigger=trigger)
+
+
+def render_metrics():
+    """
+    All metrics of this process in the Prometheus text exposition format.
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+
+    lock_waits = lock_wait_stats.snapshot()
+    lines.extend(render_sample('barcode_lock_waits_total', 'counter', 'Barcode lock acquisitions.', lock_waits['count']))
+    lines.extend(render_sample(
+        'barcode_lock_wait_seconds_total', 'counter', 'Time spent waiting for barcode locks.', lock_waits['total_seconds']
+    ))
+    lines.extend(render_sample(
+        'barcode_lock_wait_seconds_max', 'gauge', 'Longest wait for barcode locks.', lock_waits['max_seconds']
+    ))
+
+    cache = report_cache_stats.snapshot()
+    lines.extend(render_sample('report_cache_hits_total', 'counter', 'Reports answered from the cache.', cache['hits']))
+    lines.extend(render_sample('report_cache_misses_total', 'counter', 'Reports built on a cache miss.', cache['misses']))
+    return '\n'.join(lines) + '\n'
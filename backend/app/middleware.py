@@ -0,0 +1,74 @@
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import connections
+
+from .metrics import request_duration, request_queries, request_query_duration
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting the queries of a request and the time spent in them.
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+def watch_queries(stack, queries):
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(queries))
+
+
+class MetricsMiddleware:
+    """
+    Records latency, query count and query time of every request, labelled with the URL
+    route it matched, see app.metrics.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryCounter()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            watch_queries(stack, queries)
+            response = self.get_response(request)
+        self.record(request, response, queries, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        queries = QueryCounter()
+        started = time.perf_counter()
+        # the async ORM runs the queries on the request's sync thread, whose connections are its own
+        with ExitStack() as stack:
+            await sync_to_async(watch_queries)(stack, queries)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(stack.close)()
+        self.record(request, response, queries, time.perf_counter() - started)
+        return response
+
+    def record(self, request, response, queries, elapsed):
+        match = request.resolver_match
+        endpoint = match.route if match else 'unmatched'
+        request_duration.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+        request_queries.observe(queries.count, endpoint=endpoint, method=request.method)
+        request_query_duration.observe(queries.seconds, endpoint=endpoint, method=request.method)
@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_sale_last_connected_supply_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyBarcode',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('barcode', models.BigIntegerField(unique=True)),
+                ('sale_time', models.DateTimeField(null=True)),
+                ('sale_id', models.IntegerField(default=0)),
+                ('version', models.IntegerField(default=1)),
+                ('marked_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'umag_hacknu_dirty_barcode',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_dirtybarcode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SaleRollup',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('barcode', models.BigIntegerField()),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket_start', models.DateTimeField()),
+                ('revenue', models.BigIntegerField(default=0)),
+                ('net_profit', models.BigIntegerField(default=0)),
+                ('quantity', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'umag_hacknu_sale_rollup',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='salerollup',
+            constraint=models.UniqueConstraint(fields=('barcode', 'granularity', 'bucket_start'), name='unique_sale_rollup_bucket'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 08:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_salerollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['sale_time', 'id'], name='umag_hacknu_sale_ti_d2f2f3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='supply',
+            index=models.Index(fields=['supply_time', 'id'], name='umag_hacknu_supply__f98962_idx'),
+        ),
+    ]
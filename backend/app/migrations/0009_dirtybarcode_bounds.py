@@ -0,0 +1,38 @@
+# Generated by Django 4.2 on 2026-10-18 08:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_sale_supply_time_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dirtybarcode',
+            name='bounded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='dirtybarcode',
+            name='last_sale_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dirtybarcode',
+            name='last_sale_time',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='dirtybarcode',
+            name='last_supply_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dirtybarcode',
+            name='last_supply_time',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
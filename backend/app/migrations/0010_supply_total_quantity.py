@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-18 08:58
+
+from django.db import migrations, models
+
+
+def backfill_supply_totals(apps, schema_editor):
+    Supply = apps.get_model('app', 'Supply')
+    for barcode in Supply.objects.values_list('barcode', flat=True).distinct().order_by('barcode'):
+        total = 0
+        supplies = []
+        for supply in Supply.objects.filter(barcode=barcode).order_by('supply_time', 'id').only('id', 'quantity'):
+            total += supply.quantity
+            supply.total_quantity = total
+            supplies.append(supply)
+        Supply.objects.bulk_update(supplies, fields=['total_quantity'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_dirtybarcode_bounds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='supply',
+            name='total_quantity',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_supply_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2 on 2026-10-18 09:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_supply_total_quantity'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sale',
+            name='last_connected_supply',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='app.supply'),
+        ),
+    ]
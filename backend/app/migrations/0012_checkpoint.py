@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_sale_last_connected_supply_no_constraint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('barcode', models.BigIntegerField()),
+                ('closed_at', models.DateTimeField()),
+                ('total_revenue', models.BigIntegerField(default=0)),
+                ('total_net_profit', models.BigIntegerField(default=0)),
+                ('total_quantity', models.BigIntegerField(default=0)),
+                ('supply_id', models.IntegerField(null=True)),
+                ('supply_time', models.DateTimeField(null=True)),
+                ('supply_price', models.IntegerField(default=0)),
+                ('remaining_q', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'umag_hacknu_checkpoint',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='checkpoint',
+            constraint=models.UniqueConstraint(fields=('barcode', 'closed_at'), name='unique_checkpoint_period'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-18 09:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BarcodeState',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('barcode', models.BigIntegerField(unique=True)),
+                ('last_sale_id', models.IntegerField(null=True)),
+                ('last_sale_time', models.DateTimeField(null=True)),
+                ('total_revenue', models.BigIntegerField(default=0)),
+                ('total_net_profit', models.BigIntegerField(default=0)),
+                ('total_quantity', models.BigIntegerField(default=0)),
+                ('supply_id', models.IntegerField(null=True)),
+                ('supply_time', models.DateTimeField(null=True)),
+                ('supply_price', models.IntegerField(default=0)),
+                ('remaining_q', models.IntegerField(default=0)),
+                ('last_supply_id', models.IntegerField(null=True)),
+                ('last_supply_time', models.DateTimeField(null=True)),
+                ('supplied_quantity', models.BigIntegerField(default=0)),
+                ('closed_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'db_table': 'umag_hacknu_barcode_state',
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-18 09:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_barcodestate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Allocation',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('barcode', models.BigIntegerField()),
+                ('sale_time', models.DateTimeField()),
+                ('quantity', models.IntegerField()),
+                ('unit_cost', models.IntegerField()),
+                ('sale', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='allocations', to='app.sale')),
+                ('supply', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='allocations', to='app.supply')),
+            ],
+            options={
+                'db_table': 'umag_hacknu_allocation',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='allocation',
+            index=models.Index(fields=['barcode', 'sale_time', 'sale'], name='umag_hacknu_barcode_32fad7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='allocation',
+            index=models.Index(fields=['supply', 'sale_time', 'sale'], name='umag_hacknu_supply__bc2c3b_idx'),
+        ),
+    ]
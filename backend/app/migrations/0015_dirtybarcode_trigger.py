@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_allocation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dirtybarcode',
+            name='trigger',
+            field=models.CharField(default='full', max_length=32),
+        ),
+    ]
@@ -10,12 +10,16 @@ class Sale(models.Model):
     total_net_profit = models.BigIntegerField(default=0)
     total_revenue = models.BigIntegerField(default=0)
     total_quantity = models.BigIntegerField(default=0)
-    last_connected_supply = models.ForeignKey('Supply', on_delete=models.DO_NOTHING, blank=True, null=True)
+    # no database constraint: a partitioned supply table can't back one, see app.partitions
+    last_connected_supply = models.ForeignKey(
+        'Supply', on_delete=models.DO_NOTHING, blank=True, null=True, db_constraint=False
+    )
     last_connected_supply_remaining_q = models.IntegerField(null=True)
 
     class Meta:
         indexes = [
             models.Index(fields=['barcode', 'sale_time', 'id']),
+            models.Index(fields=['sale_time', 'id']),
         ]
         db_table = 'umag_hacknu_sale'
 
@@ -26,9 +30,142 @@ class Supply(models.Model):
     quantity = models.IntegerField(default=1)
     price = models.IntegerField(default=0)
     supply_time = models.DateTimeField()
+    # units supplied up to and including this supply, in (supply_time, id) order
+    total_quantity = models.BigIntegerField(default=0)
 
     class Meta:
         indexes = [
             models.Index(fields=['barcode', 'supply_time', 'id']),
+            models.Index(fields=['supply_time', 'id']),
         ]
         db_table = 'umag_hacknu_supply'
+
+
+class Allocation(models.Model):
+    """
+    Units a sale took from one supply lot and what they cost, written by the FIFO replay for
+    every (sale, lot) pair. Sale time and barcode are copied over so the rows of a replayed
+    range of sales can be found by position, see app.recalculation.write_allocations.
+    """
+    id = models.BigAutoField(primary_key=True)
+    barcode = models.BigIntegerField()
+    # no database constraints: partitioned sale and supply tables can't back them, see app.partitions
+    sale = models.ForeignKey('Sale', on_delete=models.DO_NOTHING, db_constraint=False, related_name='allocations')
+    sale_time = models.DateTimeField()
+    supply = models.ForeignKey(
+        'Supply', on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, related_name='allocations'
+    )
+    quantity = models.IntegerField()
+    unit_cost = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['barcode', 'sale_time', 'sale']),
+            models.Index(fields=['supply', 'sale_time', 'sale']),
+        ]
+        db_table = 'umag_hacknu_allocation'
+
+
+class DirtyBarcode(models.Model):
+    """
+    Barcode whose sales still wait for a deferred FIFO recalculation starting at (sale_time, sale_id).
+    An empty sale_time means the whole history has to be replayed. When `bounded`, the last sale
+    and supply positions touched by the pending changes are known (empty when none of that kind
+    changed), which lets the recalculation stop early, see app.recalculation.ChangeBounds.
+    `trigger` is the kind of write that marked the barcode, the metrics label of the pass;
+    'coalesced' once writes of different kinds were merged into it.
+    """
+    id = models.AutoField(primary_key=True)
+    barcode = models.BigIntegerField(unique=True)
+    sale_time = models.DateTimeField(null=True)
+    sale_id = models.IntegerField(default=0)
+    bounded = models.BooleanField(default=False)
+    last_sale_time = models.DateTimeField(null=True)
+    last_sale_id = models.IntegerField(default=0)
+    last_supply_time = models.DateTimeField(null=True)
+    last_supply_id = models.IntegerField(default=0)
+    trigger = models.CharField(max_length=32, default='full')
+    version = models.IntegerField(default=1)
+    marked_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'umag_hacknu_dirty_barcode'
+
+
+class SaleRollup(models.Model):
+    """
+    Revenue, net profit and quantity sold of a barcode within one hour or day bucket.
+    Derived from the sales' running totals, see app.rollups.
+    """
+    HOUR = 'hour'
+    DAY = 'day'
+    GRANULARITY_CHOICES = [(HOUR, 'Hour'), (DAY, 'Day')]
+
+    id = models.AutoField(primary_key=True)
+    barcode = models.BigIntegerField()
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    bucket_start = models.DateTimeField()
+    revenue = models.BigIntegerField(default=0)
+    net_profit = models.BigIntegerField(default=0)
+    quantity = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['barcode', 'granularity', 'bucket_start'], name='unique_sale_rollup_bucket'),
+        ]
+        db_table = 'umag_hacknu_sale_rollup'
+
+
+class Checkpoint(models.Model):
+    """
+    FIFO state of a barcode at the close of a period: the running totals of its sales before
+    `closed_at` and the head of the supply queue after them. Sales and supplies of the closed
+    period are frozen and replays start here, see app.checkpoints.
+    """
+    id = models.AutoField(primary_key=True)
+    barcode = models.BigIntegerField()
+    closed_at = models.DateTimeField()
+    total_revenue = models.BigIntegerField(default=0)
+    total_net_profit = models.BigIntegerField(default=0)
+    total_quantity = models.BigIntegerField(default=0)
+    # lot the last sale of the period ended on and what is left of it, empty when nothing was consumed
+    supply_id = models.IntegerField(null=True)
+    supply_time = models.DateTimeField(null=True)
+    supply_price = models.IntegerField(default=0)
+    remaining_q = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['barcode', 'closed_at'], name='unique_checkpoint_period'),
+        ]
+        db_table = 'umag_hacknu_checkpoint'
+
+
+class BarcodeState(models.Model):
+    """
+    Head of a barcode's ledger: its last sale with the FIFO state after it, its last supply and
+    the units supplied in total. Kept in the transaction of every write, so a sale or supply
+    appended after all others is matched from this row alone. Missing while the barcode waits
+    for a deferred recalculation, see app.recalculation.refresh_barcode_state.
+    """
+    id = models.AutoField(primary_key=True)
+    barcode = models.BigIntegerField(unique=True)
+    last_sale_id = models.IntegerField(null=True)
+    last_sale_time = models.DateTimeField(null=True)
+    total_revenue = models.BigIntegerField(default=0)
+    total_net_profit = models.BigIntegerField(default=0)
+    total_quantity = models.BigIntegerField(default=0)
+    # lot the last sale ended on and what is left of it, empty when nothing was consumed
+    supply_id = models.IntegerField(null=True)
+    supply_time = models.DateTimeField(null=True)
+    supply_price = models.IntegerField(default=0)
+    remaining_q = models.IntegerField(default=0)
+    last_supply_id = models.IntegerField(null=True)
+    last_supply_time = models.DateTimeField(null=True)
+    supplied_quantity = models.BigIntegerField(default=0)
+    # end of the latest closed period, see Checkpoint
+    closed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'umag_hacknu_barcode_state'
@@ -0,0 +1,104 @@
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def keyset_q(fields, values):
+    """
+    Rows strictly after `values` in the (time, id) order given by `fields`. The redundant
+    `time >= value` gives the index scan, and partition pruning, a lower bound.
+    """
+    (time_field, id_field), (time_value, id_value) = fields, values
+    return Q(**{time_field + '__gte': time_value}) & (
+        Q(**{time_field + '__gt': time_value}) | Q(**{time_field: time_value, id_field + '__gt': id_value})
+    )
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over the view's `keyset_fields`, e.g. ('sale_time', 'id'). Each page
+    continues with a `WHERE (time, id) > cursor` seek on the composite index instead of an
+    OFFSET scan, so deep pages cost the same as the first one. The body stays a plain list,
+    the next page is announced in the `Link` header. Pages of model instances and of
+    `.values()` dicts are both supported.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'pageSize'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.trim_page(list(self.page_queryset(queryset, request, view)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        return self.trim_page([row async for row in self.page_queryset(queryset, request, view)])
+
+    def page_queryset(self, queryset, request, view):
+        """
+        The requested page plus one row telling whether another page follows.
+        """
+        self.request = request
+        self.fields = view.keyset_fields
+        self.page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(keyset_q(self.fields, cursor))
+        return queryset.order_by(*self.fields)[:self.page_size + 1]
+
+    def trim_page(self, page):
+        self.next_position = None
+        if len(page) > self.page_size:
+            page = page[:self.page_size]
+            last = page[-1]
+            if isinstance(last, dict):
+                self.next_position = [last[field] for field in self.fields]
+            else:
+                self.next_position = [getattr(last, field) for field in self.fields]
+        return page
+
+    def get_page_size(self, request):
+        page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            pass
+        return max(1, min(page_size, settings.LIST_MAX_PAGE_SIZE))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            time_value, id_value = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            time_value = parse_datetime(time_value)
+            if time_value is None:
+                raise ValueError
+            return time_value, int(id_value)
+        except (TypeError, ValueError, UnicodeEncodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        time_value, id_value = position
+        return base64.urlsafe_b64encode(json.dumps([time_value.isoformat(), id_value]).encode('ascii')).decode('ascii')
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_page_headers(self):
+        headers = {}
+        if self.next_position is not None:
+            headers['Link'] = '<%s>; rel="next"' % self.get_next_link()
+        return headers
+
+    def get_paginated_response(self, data):
+        return Response(data, headers=self.get_page_headers())
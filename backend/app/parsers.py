@@ -0,0 +1,29 @@
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from djangorestframework_camel_case.settings import api_settings
+from djangorestframework_camel_case.util import underscoreize
+
+
+class CamelCaseNDJSONParser(BaseParser):
+    """
+    Parses newline-delimited JSON bodies into a list of objects, one per non-empty line.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+
+        data = []
+        for line_no, line in enumerate(stream.read().decode(encoding).splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                data.append(json.loads(line))
+            except ValueError as exc:
+                raise ParseError('NDJSON parse error on line %d - %s' % (line_no, exc))
+        return underscoreize(data, **api_settings.JSON_UNDERSCOREIZE)
@@ -0,0 +1,176 @@
+"""
+Optional monthly range partitioning of the sale and supply tables on Postgres.
+
+`manage.py partition_tables` converts the plain tables once. From then on `ensure_partitions`,
+run periodically by celery beat, creates the partitions of the coming months and moves rows
+that landed in the default partition (months without a partition yet) into their own. Indexes
+declared on the parent, e.g. (barcode, sale_time, id), exist on every partition, and queries
+filtering on the time column only scan the partitions of the requested range.
+"""
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Sale, Supply
+
+PARTITION_KEYS = {
+    Sale._meta.db_table: 'sale_time',
+    Supply._meta.db_table: 'supply_time',
+}
+
+
+def month_start(moment):
+    moment = moment.astimezone(dt_timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(table, month):
+    return '%s_p%04d%02d' % (table, month.year, month.month)
+
+
+def default_partition(table):
+    return '%s_default' % table
+
+
+def is_partitioned(cursor, table):
+    cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [table])
+    return cursor.fetchone() is not None
+
+
+def partitions_of(cursor, table):
+    cursor.execute(
+        'SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass', [table]
+    )
+    return {name for name, in cursor.fetchall()}
+
+
+def add_partition(cursor, table, month):
+    """
+    Creates the partition of `month`, taking over the rows the default partition holds for it.
+    """
+    column, name = PARTITION_KEYS[table], partition_name(table, month)
+    quote = connection.ops.quote_name
+    bounds = [month, add_months(month, 1)]
+    cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING STORAGE)' % (quote(name), quote(table)))
+    if default_partition(table) in partitions_of(cursor, table):
+        cursor.execute(
+            'WITH moved AS (DELETE FROM {default} WHERE {column} >= %s AND {column} < %s RETURNING *) '
+            'INSERT INTO {name} SELECT * FROM moved'.format(
+                default=quote(default_partition(table)), column=quote(column), name=quote(name)
+            ),
+            bounds,
+        )
+    cursor.execute(
+        'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s)' % (quote(table), quote(name)), bounds
+    )
+    return name
+
+
+def ensure_partitions(months_ahead=None):
+    """
+    Creates the missing partitions of the partitioned tables: the current month, the next
+    `months_ahead` ones (PARTITION_MONTHS_AHEAD by default) and every month with rows in the
+    default partition. Returns the names of the created partitions.
+    """
+    if connection.vendor != 'postgresql':
+        return []
+    months_ahead = settings.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    current = month_start(datetime.now(dt_timezone.utc))
+    created = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for table, column in PARTITION_KEYS.items():
+            if not is_partitioned(cursor, table):
+                continue
+            months = {add_months(current, count) for count in range(months_ahead + 1)}
+            cursor.execute("SELECT DISTINCT date_trunc('month', %s, 'UTC') FROM %s" % (
+                connection.ops.quote_name(column), connection.ops.quote_name(default_partition(table))
+            ))
+            months.update(month_start(month) for month, in cursor.fetchall())
+            existing = partitions_of(cursor, table)
+            for month in sorted(months):
+                if partition_name(table, month) not in existing:
+                    created.append(add_partition(cursor, table, month))
+    return created
+
+
+def partition_table(table, months_ahead=None):
+    """
+    Converts the plain `table` into one range partitioned by month on its time column, with
+    a default partition for rows outside the monthly ones. The rows are copied over and the
+    indexes and outgoing foreign keys recreated on the parent, from where they propagate to
+    every partition. Tables referenced by foreign keys can't be converted. Holds an exclusive
+    lock on the table for the whole copy.
+    """
+    column = PARTITION_KEYS[table]
+    quote = connection.ops.quote_name
+    old = '%s_unpartitioned' % table
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % quote(table))
+        cursor.execute(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint WHERE contype = 'f' AND confrelid = %s::regclass",
+            [table]
+        )
+        references = cursor.fetchall()
+        if references:
+            raise ValueError('%s is referenced by foreign keys %s' % (table, references))
+
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE contype = 'f' AND conrelid = %s::regclass",
+            [table]
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(
+            'SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s '
+            'AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)',
+            [table, table]
+        )
+        indexes = cursor.fetchall()
+
+        # the definitions are recreated on the new table, under the same names
+        for name, _ in foreign_keys:
+            cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (quote(table), quote(name)))
+        for name, _ in indexes:
+            cursor.execute('DROP INDEX %s' % quote(name))
+        cursor.execute("SELECT conname FROM pg_constraint WHERE contype = 'p' AND conrelid = %s::regclass", [table])
+        for name, in cursor.fetchall():
+            cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (quote(table), quote(name)))
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (quote(table), quote(old)))
+
+        cursor.execute(
+            'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY INCLUDING STORAGE) '
+            'PARTITION BY RANGE (%s)'
+            % (quote(table), quote(old), quote(column))
+        )
+        # a primary key of a partitioned table has to contain the partition key
+        cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (id, %s)' % (quote(table), quote(column)))
+        cursor.execute('CREATE TABLE %s PARTITION OF %s DEFAULT' % (quote(default_partition(table)), quote(table)))
+        cursor.execute('SELECT min(%s) FROM %s' % (quote(column), quote(old)))
+        first, = cursor.fetchone()
+        current = month_start(datetime.now(dt_timezone.utc))
+        month = month_start(first) if first is not None and first < current else current
+        months_ahead = settings.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+        while month <= add_months(current, months_ahead):
+            add_partition(cursor, table, month)
+            month = add_months(month, 1)
+
+        cursor.execute('INSERT INTO %s SELECT * FROM %s' % (quote(table), quote(old)))
+        cursor.execute('DROP TABLE %s' % quote(old))
+        cursor.execute(
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), coalesce(max(id), 0) + 1, false) FROM {}".format(quote(table)),
+            [table]
+        )
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        sequence, = cursor.fetchone()
+        cursor.execute('ALTER SEQUENCE %s RENAME TO %s' % (sequence, quote('%s_id_seq' % table)))
+
+        for _, definition in indexes:
+            cursor.execute(definition)
+        for name, definition in foreign_keys:
+            cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (quote(table), quote(name), definition))
+        cursor.execute('ANALYZE %s' % quote(table))
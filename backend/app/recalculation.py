@@ -0,0 +1,690 @@
+import time
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+from django.db.models import BigIntegerField, Case, F, Q, Value, When
+
+from .checkpoints import closes_sale, head_lot, latest_checkpoint
+from .engine import FifoResult, fifo_allocations, match_fifo
+from .metrics import record_recalculation
+from .models import Allocation, BarcodeState, Checkpoint, Sale, Supply
+from .replicas import pin_to_primary
+from .report_cache import invalidate_reports
+from .rollups import add_to_rollups, refresh_rollups
+from .writeback import CHUNK_SIZE, insert_allocations, write_sale_totals
+
+FIRST_SALE_CHUNK = 1000
+SUPPLY_PAGE = 1000
+# sales shifted per UPDATE when a supply is re-priced
+REPRICE_CHUNK = 500
+
+SALE_STATE_DTYPE = [
+    ('id', np.int64),
+    ('quantity', np.int64),
+    ('price', np.int64),
+    ('total_revenue', np.int64),
+    ('total_net_profit', np.int64),
+    ('total_quantity', np.int64),
+    ('supply_id', np.int64),
+    ('remaining_q', np.int64),
+]
+
+
+class ChangeBounds(NamedTuple):
+    """
+    Latest (time, id) positions touched by the changes being recalculated, one for the sales
+    and one for the supply queue, None when no row of that kind changed. The stored FIFO state
+    of a sale can only be trusted past both.
+    """
+    sale: Optional[Tuple] = None
+    supply: Optional[Tuple] = None
+
+    def merge(self, other):
+        return ChangeBounds(latest_key(self.sale, other.sale), latest_key(self.supply, other.supply))
+
+
+def latest_key(first, second):
+    if first is None or second is None:
+        return first if second is None else second
+    return max(first, second)
+
+
+def key_q(time_field, time_value, id_value, lookup, id_field='id'):
+    """
+    Rows positioned relative to (time_value, id_value) in (time, id) order. The inclusive
+    bound on the time alone is redundant, but it is what an index range scan and partition
+    pruning can use, the OR of the exact condition can't be.
+    """
+    time_lookup = 'lt' if lookup.startswith('lt') else 'gt'
+    return Q(**{time_field + '__' + time_lookup + 'e': time_value}) & (
+        Q(**{time_field + '__' + time_lookup: time_value}) | Q(**{time_field: time_value, id_field + '__' + lookup: id_value})
+    )
+
+
+def sale_key_q(sale_time, sale_id, lookup='gte'):
+    """
+    Filter for sales positioned relative to (sale_time, sale_id) in FIFO order.
+    """
+    return key_q('sale_time', sale_time, sale_id, lookup)
+
+
+def supply_key_q(supply_time, supply_id, lookup='gte'):
+    """
+    Filter for supplies positioned relative to (supply_time, supply_id) in FIFO order.
+    """
+    return key_q('supply_time', supply_time, supply_id, lookup)
+
+
+def allocation_key_q(sale_time, sale_id, lookup='gte'):
+    """
+    Filter for allocations of the sales positioned relative to (sale_time, sale_id).
+    """
+    return key_q('sale_time', sale_time, sale_id, lookup, id_field='sale_id')
+
+
+def get_sales(barcode, from_sale=None, lookup='gte', limit=FIRST_SALE_CHUNK):
+    """
+    Next `limit` sales of the barcode from `from_sale` on, in FIFO order, with their stored totals
+    and FIFO state. Returns the columns as a structured array and the (sale_time, id) keys.
+    """
+    sales = Sale.objects.filter(barcode=barcode)
+    if from_sale:
+        sales = sales.filter(sale_key_q(*from_sale, lookup))
+    rows = list(sales.order_by('sale_time', 'id').values_list(
+        'id', 'quantity', 'price', 'total_revenue', 'total_net_profit', 'total_quantity',
+        'last_connected_supply_id', 'last_connected_supply_remaining_q', 'sale_time'
+    )[:limit])
+    columns = np.fromiter((
+        (*row[:6], -1 if row[6] is None else row[6], -1 if row[7] is None else row[7]) for row in rows
+    ), dtype=SALE_STATE_DTYPE, count=len(rows))
+    return columns, [(row[8], row[0]) for row in rows]
+
+
+class SupplyQueue:
+    """
+    Supplies of the barcode from the current FIFO position on, fetched in keyset pages as
+    the sales need them. The head lot only holds what is left of it; a used up lot is kept
+    as `carried`, where sales end up when no supply is left.
+    """
+    def __init__(self, barcode, supply=None, remaining_q=0):
+        self.barcode = barcode
+        self.ids, self.quantities, self.prices, self.keys = [], [], [], []
+        self.carried_id = self.carried_key = self.after = None
+        self.exhausted = False
+        self.rows_read = 0
+        if supply is not None:
+            self.after = (supply.supply_time, supply.id)
+            if remaining_q > 0:
+                self.append(supply.id, remaining_q, supply.price, self.after)
+            else:
+                self.carried_id, self.carried_key = supply.id, self.after
+
+    def append(self, supply_id, quantity, price, key):
+        self.ids.append(supply_id)
+        self.quantities.append(quantity)
+        self.prices.append(price)
+        self.keys.append(key)
+
+    def fill(self, units):
+        """
+        Fetches supplies until more than `units` are queued or the queue is exhausted, so the
+        lot following the last one consumed is always at hand.
+        """
+        queued = sum(self.quantities)
+        while queued <= units and not self.exhausted:
+            supplies = Supply.objects.filter(barcode=self.barcode)
+            if self.after is not None:
+                supplies = supplies.filter(supply_key_q(*self.after, 'gt'))
+            rows = list(supplies.order_by('supply_time', 'id')
+                        .values_list('id', 'quantity', 'price', 'supply_time')[:SUPPLY_PAGE])
+            self.exhausted = len(rows) < SUPPLY_PAGE
+            self.rows_read += len(rows)
+            for supply_id, quantity, price, supply_time in rows:
+                self.append(supply_id, quantity, price, (supply_time, supply_id))
+                queued += quantity
+            if rows:
+                self.after = self.keys[-1]
+
+    def lot_ids(self):
+        """
+        Supply ids by lot index, the last entry (index -1) is the carried lot, -1 for none.
+        """
+        return np.array(self.ids + [-1 if self.carried_id is None else self.carried_id], dtype=np.int64)
+
+    def lot_key(self, index):
+        return self.carried_key if index < 0 else self.keys[index]
+
+    def advance(self, index, remaining_q):
+        """
+        Moves the head to lot `index` with `remaining_q` left, where the last sale ended.
+        """
+        if index < 0:
+            return
+        if remaining_q:
+            start = index
+        else:
+            self.carried_id, self.carried_key = self.ids[index], self.keys[index]
+            start = index + 1
+        for column in (self.ids, self.quantities, self.prices, self.keys):
+            del column[:start]
+        if remaining_q:
+            self.quantities[0] = remaining_q
+
+
+def result_rows(sale_ids, result, supply_ids):
+    """
+    (id, net profit, quantity, revenue, supply id, remaining q) rows of the matched sales,
+    converted to Python values one chunk at a time.
+    """
+    for start in range(0, len(sale_ids), CHUNK_SIZE):
+        window = slice(start, start + CHUNK_SIZE)
+        for sale_id, net_profit, quantity, revenue, supply_id, remaining_q in zip(
+                sale_ids[window].tolist(), result.total_net_profit[window].tolist(),
+                result.total_quantity[window].tolist(), result.total_revenue[window].tolist(),
+                supply_ids[window].tolist(), result.remaining_q[window].tolist()):
+            yield sale_id, net_profit, quantity, revenue, None if supply_id < 0 else supply_id, remaining_q
+
+
+def converged_index(sales, keys, result, supply_ids, supplies, bounds):
+    """
+    First sale past the change bounds whose recomputed FIFO state equals the stored one.
+    From there on every sale is matched against the same lots as before.
+    """
+    same_state = (supply_ids == sales['supply_id']) & (result.remaining_q == sales['remaining_q'])
+    for index in np.flatnonzero(same_state).tolist():
+        if bounds.sale is not None and keys[index] <= bounds.sale:
+            continue
+        if bounds.supply is not None:
+            lot_key = supplies.lot_key(int(result.supply_index[index]))
+            if lot_key is None or lot_key <= bounds.supply:
+                continue
+        return index
+    return None
+
+
+class RecalculationStats:
+    """
+    Rows a recalculation read and wrote, for the metrics.
+    """
+    def __init__(self):
+        self.sales_read = 0
+        self.rows_written = 0
+
+
+class LedgerDiff:
+    """
+    Stored sale values that differ from a replay, counted instead of being rewritten.
+    Keeps the first `keep` differing sales as examples.
+    """
+    def __init__(self, keep=5):
+        self.keep = keep
+        self.sales = 0
+        self.mismatched = 0
+        self.examples = []
+
+    def compare(self, sales, result, supply_ids):
+        count = len(result.total_revenue)
+        stored = [sales[field][:count] for field in
+                  ('total_revenue', 'total_net_profit', 'total_quantity', 'supply_id', 'remaining_q')]
+        computed = [result.total_revenue, result.total_net_profit, result.total_quantity, supply_ids[:count],
+                    result.remaining_q]
+        differs = np.zeros(count, dtype=bool)
+        for stored_column, computed_column in zip(stored, computed):
+            differs |= stored_column != computed_column
+        self.sales += count
+        self.mismatched += int(differs.sum())
+        for index in np.flatnonzero(differs)[:self.keep - len(self.examples)].tolist():
+            self.examples.append({
+                'id': int(sales['id'][index]),
+                'stored': [int(column[index]) for column in stored],
+                'computed': [int(column[index]) for column in computed],
+            })
+
+
+def allocation_rows(barcode, sale_quantity, keys, supplies, count):
+    """
+    (barcode, sale id, sale time, supply id, quantity, unit cost) rows of the lots taken from
+    the supply queue by the first `count` of the sales at `keys`.
+    """
+    allocations = fifo_allocations(sale_quantity, supplies.quantities, supplies.prices)
+    lot_ids = supplies.lot_ids()
+    for sale_index, supply_index, quantity, unit_cost in zip(
+            allocations.sale_index.tolist(), allocations.supply_index.tolist(),
+            allocations.quantity.tolist(), allocations.unit_cost.tolist()):
+        if sale_index >= count:
+            break
+        sale_time, sale_id = keys[sale_index]
+        yield barcode, sale_id, sale_time, int(lot_ids[supply_index]), quantity, unit_cost
+
+
+def write_allocations(barcode, after, lookup, until, rows):
+    """
+    Replaces the allocations of the sales positioned from `after` (by `lookup`, from the
+    beginning without it) through `until` (to the end without it) by `rows`.
+    """
+    allocations = Allocation.objects.filter(barcode=barcode)
+    if after is not None:
+        allocations = allocations.filter(allocation_key_q(*after, lookup))
+    if until is not None:
+        allocations = allocations.filter(allocation_key_q(*until, 'lte'))
+    allocations.delete()
+    insert_allocations(rows)
+
+
+def shift_totals(barcode, after, revenue, net_profit, quantity):
+    """
+    Adds the deltas to the running totals of every sale past `after` in one statement.
+    Returns the number of sales shifted.
+    """
+    if not (revenue or net_profit or quantity):
+        return 0
+    return Sale.objects.filter(sale_key_q(*after, 'gt'), barcode=barcode).update(
+            total_revenue=F('total_revenue') + revenue,
+            total_net_profit=F('total_net_profit') + net_profit,
+            total_quantity=F('total_quantity') + quantity,
+        )
+
+
+def recalculate(barcode, supplies, from_sale=None, totals=(0, 0, 0), bounds=None, stats=None, diff=None):
+    """
+    Matches the sales of the barcode from `from_sale` on (all of them without it) against the
+    supply queue in growing chunks and stores the running totals and the FIFO state right
+    after every sale.
+
+    With the `bounds` of the changes known, the replay stops at the first sale past them whose
+    recomputed FIFO state matches the stored one. Every later sale keeps its matching, so its
+    totals only shift by a constant, applied with one set-based UPDATE. Returns the time of
+    that sale, None when the replay went through to the last sale.
+
+    With a LedgerDiff as `diff` nothing is written, the results are compared with the
+    stored values instead.
+    """
+    stats = stats or RecalculationStats()
+    lookup, chunk_size = 'gte', FIRST_SALE_CHUNK
+    while True:
+        sales, keys = get_sales(barcode, from_sale, lookup, chunk_size)
+        stats.sales_read += len(sales)
+        if not len(sales):
+            if diff is None:
+                # allocations of sales deleted past the last one
+                write_allocations(barcode, from_sale, lookup, None, [])
+            return None
+        supplies.fill(int(sales['quantity'].sum()))
+        result = match_fifo(sales['quantity'], sales['price'], supplies.quantities, supplies.prices, totals=totals)
+        supply_ids = np.take(supplies.lot_ids(), result.supply_index)
+
+        stop = None
+        if bounds is not None:
+            stop = converged_index(sales, keys, result, supply_ids, supplies, bounds)
+        if stop is not None:
+            result = FifoResult(*(column[:stop + 1] for column in result))
+        if diff is not None:
+            diff.compare(sales, result, supply_ids)
+        else:
+            write_sale_totals(result_rows(sales['id'], result, supply_ids))
+            write_allocations(barcode, from_sale, lookup, keys[len(result.total_revenue) - 1], allocation_rows(
+                barcode, sales['quantity'], keys, supplies, len(result.total_revenue)
+            ))
+            stats.rows_written += len(result.total_revenue)
+
+        if stop is not None:
+            stats.rows_written += shift_totals(
+                barcode, keys[stop],
+                int(result.total_revenue[stop] - sales['total_revenue'][stop]),
+                int(result.total_net_profit[stop] - sales['total_net_profit'][stop]),
+                int(result.total_quantity[stop] - sales['total_quantity'][stop]),
+            )
+            return keys[stop][0]
+
+        totals = (int(result.total_revenue[-1]), int(result.total_net_profit[-1]), int(result.total_quantity[-1]))
+        supplies.advance(int(result.supply_index[-1]), int(result.remaining_q[-1]))
+        from_sale, lookup = keys[-1], 'gt'
+        chunk_size = min(chunk_size * 2, CHUNK_SIZE * 4)
+
+
+def get_prev_sale(barcode, sale_time, sale_id):
+    return Sale.objects.filter(sale_key_q(sale_time, sale_id, 'lt'), barcode=barcode) \
+        .select_related('last_connected_supply').order_by('-sale_time', '-id').first()
+
+
+def has_fifo_state(sale):
+    """
+    Whether the sale carries the FIFO state after it. Rows written before the state was
+    kept per sale, or pointing at a supply deleted since, don't.
+    """
+    if sale is None or sale.last_connected_supply_remaining_q is None:
+        return False
+    return sale.last_connected_supply_id is None or sale.last_connected_supply is not None
+
+
+def replay_start(barcode, sale_time=None, sale_id=0):
+    """
+    Where a replay of the sales at or after (sale_time, sale_id) starts: the first sale's key,
+    the supply queue and the running totals, seeded from the preceding sale. Replays reaching
+    into a closed period, or not preceded by an open sale with FIFO state, start at the latest
+    checkpoint instead, and at the beginning of the history, with no first sale key, when the
+    barcode has none.
+    """
+    checkpoint = latest_checkpoint(barcode)
+    if sale_time is not None and not closes_sale(checkpoint, sale_time):
+        prev_sale = get_prev_sale(barcode, sale_time, sale_id)
+        if has_fifo_state(prev_sale) and not closes_sale(checkpoint, prev_sale.sale_time):
+            supplies = SupplyQueue(barcode, prev_sale.last_connected_supply, prev_sale.last_connected_supply_remaining_q)
+            return (sale_time, sale_id), supplies, (
+                prev_sale.total_revenue, prev_sale.total_net_profit, prev_sale.total_quantity
+            )
+    if checkpoint is None:
+        return None, SupplyQueue(barcode), (0, 0, 0)
+    supplies = SupplyQueue(barcode, head_lot(checkpoint), checkpoint.remaining_q)
+    return (checkpoint.closed_at, 0), supplies, (
+        checkpoint.total_revenue, checkpoint.total_net_profit, checkpoint.total_quantity
+    )
+
+
+def close_period(barcode, closed_at):
+    """
+    Stores a checkpoint of the barcode at `closed_at`, from the FIFO state of its last sale
+    before it. The stored sales have to be up to date.
+    """
+    checkpoint = latest_checkpoint(barcode)
+    if checkpoint is not None and checkpoint.closed_at >= closed_at:
+        raise ValueError('barcode %d is already closed up to %s' % (barcode, checkpoint.closed_at))
+    last_sale = Sale.objects.filter(barcode=barcode, sale_time__lt=closed_at) \
+        .select_related('last_connected_supply').order_by('-sale_time', '-id').first()
+    if last_sale is None:
+        checkpoint = Checkpoint.objects.create(barcode=barcode, closed_at=closed_at)
+    elif not has_fifo_state(last_sale):
+        raise ValueError('sale %d of barcode %d carries no FIFO state, rebuild the ledger first' % (last_sale.id, barcode))
+    else:
+        supply = last_sale.last_connected_supply
+        checkpoint = Checkpoint.objects.create(
+            barcode=barcode,
+            closed_at=closed_at,
+            total_revenue=last_sale.total_revenue,
+            total_net_profit=last_sale.total_net_profit,
+            total_quantity=last_sale.total_quantity,
+            supply_id=supply.id if supply else None,
+            supply_time=supply.supply_time if supply else None,
+            supply_price=supply.price if supply else 0,
+            remaining_q=last_sale.last_connected_supply_remaining_q,
+        )
+    refresh_barcode_state(barcode)
+    return checkpoint
+
+
+def refresh_barcode_state(barcode):
+    """
+    Recomputes the BarcodeState of the barcode from its last sale, last supply and latest
+    checkpoint, seeded the way `replay_start` seeds a replay after the last sale. Drops it
+    when that sale carries no FIFO state. Returns the state, None when dropped.
+    """
+    checkpoint = latest_checkpoint(barcode)
+    last_sale = Sale.objects.filter(barcode=barcode).select_related('last_connected_supply') \
+        .order_by('-sale_time', '-id').first()
+    last_supply = Supply.objects.filter(barcode=barcode).order_by('-supply_time', '-id') \
+        .only('supply_time', 'total_quantity').first()
+    if last_sale is not None and not closes_sale(checkpoint, last_sale.sale_time):
+        if not has_fifo_state(last_sale):
+            drop_barcode_state(barcode)
+            return None
+        head, remaining_q = last_sale.last_connected_supply, last_sale.last_connected_supply_remaining_q
+        totals = (last_sale.total_revenue, last_sale.total_net_profit, last_sale.total_quantity)
+    elif checkpoint is not None:
+        head, remaining_q = head_lot(checkpoint), checkpoint.remaining_q
+        totals = (checkpoint.total_revenue, checkpoint.total_net_profit, checkpoint.total_quantity)
+    else:
+        head, remaining_q, totals = None, 0, (0, 0, 0)
+    state, _ = BarcodeState.objects.update_or_create(barcode=barcode, defaults={
+        'last_sale_id': last_sale.id if last_sale else None,
+        'last_sale_time': last_sale.sale_time if last_sale else None,
+        'total_revenue': totals[0],
+        'total_net_profit': totals[1],
+        'total_quantity': totals[2],
+        'supply_id': head.id if head else None,
+        'supply_time': head.supply_time if head else None,
+        'supply_price': head.price if head else 0,
+        'remaining_q': remaining_q,
+        'last_supply_id': last_supply.id if last_supply else None,
+        'last_supply_time': last_supply.supply_time if last_supply else None,
+        'supplied_quantity': last_supply.total_quantity if last_supply else 0,
+        'closed_at': checkpoint.closed_at if checkpoint else None,
+    })
+    return state
+
+
+def drop_barcode_state(barcode):
+    BarcodeState.objects.filter(barcode=barcode).delete()
+
+
+def get_barcode_state(barcode):
+    return BarcodeState.objects.filter(barcode=barcode).first()
+
+
+def append_sale(state, sale_time, quantity, price, save):
+    """
+    Stores a new sale placed after every other sale of the barcode, matched from its
+    BarcodeState alone: `save(**fifo_fields)` creates the sale with its running totals and
+    FIFO state and returns it, then the state row and the rollup buckets of the sale are
+    updated. Supplies are only read when the sale uses up the current lot. Returns the sale,
+    None without saving when the sale is no such append and has to be replayed instead.
+    """
+    if state is None or (state.last_sale_time is not None and sale_time < state.last_sale_time) \
+            or (state.closed_at is not None and sale_time < state.closed_at):
+        return None
+    started = time.perf_counter()
+    supplies = SupplyQueue(state.barcode, head_lot(state), state.remaining_q)
+    supplies.fill(quantity)
+    totals = (state.total_revenue, state.total_net_profit, state.total_quantity)
+    result = match_fifo([quantity], [price], supplies.quantities, supplies.prices, totals=totals)
+    index = int(result.supply_index[0])
+    supply_id = int(supplies.lot_ids()[index])
+    sale = save(
+        total_revenue=int(result.total_revenue[0]),
+        total_net_profit=int(result.total_net_profit[0]),
+        total_quantity=int(result.total_quantity[0]),
+        last_connected_supply_id=None if supply_id < 0 else supply_id,
+        last_connected_supply_remaining_q=int(result.remaining_q[0]),
+    )
+
+    insert_allocations(allocation_rows(state.barcode, [quantity], [(sale.sale_time, sale.id)], supplies, 1))
+    state.last_sale_id, state.last_sale_time = sale.id, sale.sale_time
+    state.total_revenue, state.total_net_profit, state.total_quantity = \
+        sale.total_revenue, sale.total_net_profit, sale.total_quantity
+    if index >= 0:
+        # otherwise the sale reached no new lot and the head stays where it was
+        state.supply_id, state.supply_time, state.supply_price = \
+            supplies.ids[index], supplies.keys[index][0], supplies.prices[index]
+    state.remaining_q = sale.last_connected_supply_remaining_q
+    state.save()
+
+    invalidate_reports(state.barcode)
+    pin_to_primary(state.barcode)
+    add_to_rollups(state.barcode, sale.sale_time, *(total - before for total, before in zip(
+        (sale.total_revenue, sale.total_net_profit, sale.total_quantity), totals
+    )))
+    record_recalculation('append', time.perf_counter() - started, 1 + supplies.rows_read, 1)
+    return sale
+
+
+def append_supply(state, supply_time, quantity, save):
+    """
+    Stores a new supply queued after every other supply of the barcode: `save(total_quantity=...)`
+    creates it with its running total from the BarcodeState and returns it. Only valid while
+    no sale waits for stock, as then no sale's matching changes. Returns the supply, None
+    without saving when that doesn't hold.
+    """
+    if state is None or (state.last_supply_time is not None and supply_time < state.last_supply_time) \
+            or (state.closed_at is not None and supply_time < state.closed_at) \
+            or state.total_quantity >= state.supplied_quantity:
+        return None
+    supply = save(total_quantity=state.supplied_quantity + quantity)
+    state.last_supply_id, state.last_supply_time = supply.id, supply.supply_time
+    state.supplied_quantity = supply.total_quantity
+    state.save(update_fields=['last_supply_id', 'last_supply_time', 'supplied_quantity'])
+    pin_to_primary(state.barcode)
+    return supply
+
+
+def consumed_units(state, supply):
+    """
+    Units the sales have taken from the supply so far: all of a lot queued before the lot the
+    last sale ended on, none of one queued after it.
+    """
+    if state.supply_id is None or (supply.supply_time, supply.id) > (state.supply_time, state.supply_id):
+        return 0
+    if supply.id == state.supply_id:
+        return supply.quantity - state.remaining_q
+    return supply.quantity
+
+
+def reprice_supply(state, supply, save):
+    """
+    Changes the price of a supply through `save()`, which stores it, without replaying the FIFO
+    match: the matching stays the same, so only the allocations of the supply are re-priced
+    and the net profit totals shifted from the first sale taking from it, by the cost
+    difference accumulated up to each sale. Needs allocations covering every unit taken from
+    the supply, checked against the BarcodeState. Returns False without saving when they
+    don't, the caller replays then.
+    """
+    if state is None:
+        return False
+    started = time.perf_counter()
+    allocations = list(Allocation.objects.filter(supply_id=supply.id).order_by('sale_time', 'sale_id')
+                       .values_list('sale_time', 'sale_id', 'quantity'))
+    if sum(quantity for *_, quantity in allocations) != consumed_units(state, supply):
+        return False
+    old_price = supply.price
+    supply = save()
+    invalidate_reports(supply.barcode)
+    pin_to_primary(supply.barcode)
+    Allocation.objects.filter(supply_id=supply.id).update(unit_cost=supply.price)
+
+    shift, shifts = 0, []
+    for sale_time, sale_id, quantity in allocations:
+        shift += (old_price - supply.price) * quantity
+        shifts.append(((sale_time, sale_id), shift))
+    rows_written = len(allocations)
+    if shift:
+        for start in range(0, len(shifts), REPRICE_CHUNK):
+            chunk = shifts[start:start + REPRICE_CHUNK]
+            sales = Sale.objects.filter(sale_key_q(*chunk[0][0]), barcode=supply.barcode)
+            if start + REPRICE_CHUNK < len(shifts):
+                sales = sales.filter(sale_key_q(*shifts[start + REPRICE_CHUNK][0], 'lt'))
+            else:
+                sales = sales.filter(sale_key_q(*chunk[-1][0], 'lte'))
+            # every sale gets the shift of the last allocation at or before it
+            rows_written += sales.update(total_net_profit=F('total_net_profit') + Case(
+                *(When(sale_key_q(*key), then=Value(amount)) for key, amount in reversed(chunk)),
+                output_field=BigIntegerField(),
+            ))
+        rows_written += shift_totals(supply.barcode, shifts[-1][0], 0, shift, 0)
+        refresh_rollups(supply.barcode, shifts[0][0][0], shifts[-1][0][0])
+        state.total_net_profit += shift
+    if state.supply_id == supply.id:
+        state.supply_price = supply.price
+    state.save(update_fields=['total_net_profit', 'supply_price'])
+    record_recalculation('supply_price', time.perf_counter() - started, len(allocations), rows_written)
+    return True
+
+
+def recalculate_from(barcode, sale_time=None, sale_id=0, bounds=None, trigger='full'):
+    """
+    Recalculates the sales of the barcode positioned at or after (sale_time, sale_id).
+    FIFO state and running totals are seeded from the preceding sale, so the cost is
+    proportional to the affected suffix. Falls back to a full replay when the
+    preceding sale carries no state. Given the `bounds` of the changes, the rewrite
+    ends where the FIFO state converges again, see `recalculate`.
+
+    `trigger` labels the metrics; a 'create' counts as an 'append' when the new sale
+    turned out to be the last one, as 'backdated' otherwise. Returns the RecalculationStats.
+    """
+    started = time.perf_counter()
+    stats = RecalculationStats()
+    invalidate_reports(barcode)
+    pin_to_primary(barcode)
+    from_sale, supplies, totals = replay_start(barcode, sale_time, sale_id)
+    converged_at = recalculate(barcode, supplies, from_sale, totals, bounds, stats)
+    refresh_rollups(barcode, from_sale[0] if from_sale else None, converged_at)
+    refresh_barcode_state(barcode)
+
+    if trigger == 'create':
+        trigger = 'append' if stats.sales_read == 1 else 'backdated'
+    record_recalculation(
+        trigger, time.perf_counter() - started, stats.sales_read + supplies.rows_read, stats.rows_written
+    )
+    return stats
+
+
+def verify_from(barcode, sale_time=None, sale_id=0):
+    """
+    Replays the sales of the barcode at or after (sale_time, sale_id) like `recalculate_from`
+    without writing anything. Returns the LedgerDiff against the stored values.
+    """
+    diff = LedgerDiff()
+    from_sale, supplies, totals = replay_start(barcode, sale_time, sale_id)
+    recalculate(barcode, supplies, from_sale, totals, diff=diff)
+    return diff
+
+
+def supply_units_before(barcode, supply_time, supply_id):
+    """
+    Number of supplied units queued ahead of the (supply_time, supply_id) position: the running
+    total of the supply right before it, one ordered lookup on the (barcode, supply_time, id) index.
+    """
+    return Supply.objects.filter(supply_key_q(supply_time, supply_id, 'lt'), barcode=barcode) \
+        .order_by('-supply_time', '-id').values_list('total_quantity', flat=True).first() or 0
+
+
+def shift_supply_totals(barcode, after, quantity, exclude_id=None):
+    """
+    Adds `quantity` to the running totals of the supplies queued after the `after` position,
+    for a supply of that many units entering (or, negative, leaving) the queue there.
+    """
+    supplies = Supply.objects.filter(supply_key_q(*after, 'gt'), barcode=barcode)
+    if exclude_id is not None:
+        supplies = supplies.exclude(id=exclude_id)
+    if quantity:
+        supplies.update(total_quantity=F('total_quantity') + quantity)
+
+
+def place_supply(supply):
+    """
+    Sets the running total of a supply that (re)entered the queue and shifts the ones after it.
+    Returns the units queued ahead of it.
+    """
+    units_before = supply_units_before(supply.barcode, supply.supply_time, supply.id)
+    shift_supply_totals(supply.barcode, (supply.supply_time, supply.id), supply.quantity, exclude_id=supply.id)
+    Supply.objects.filter(id=supply.id).update(total_quantity=units_before + supply.quantity)
+    supply.total_quantity = units_before + supply.quantity
+    return units_before
+
+
+def refresh_supply_totals(barcode, since=None, dry_run=False):
+    """
+    Recomputes the running totals of the barcode's supplies from the (supply_time, id)
+    position `since` on, the whole queue without it. Returns how many were wrong; with
+    `dry_run` they are only counted.
+    """
+    supplies = Supply.objects.filter(barcode=barcode)
+    total = 0
+    if since is not None:
+        total = supply_units_before(barcode, *since)
+        supplies = supplies.filter(supply_key_q(*since))
+    changed = []
+    for supply in supplies.order_by('supply_time', 'id').only('id', 'quantity', 'total_quantity').iterator(chunk_size=2000):
+        total += supply.quantity
+        if supply.total_quantity != total:
+            supply.total_quantity = total
+            changed.append(supply)
+    if not dry_run:
+        Supply.objects.bulk_update(changed, fields=['total_quantity'], batch_size=1000)
+    return len(changed)
+
+
+def supply_change_point(barcode, units_before):
+    """
+    First sale that consumed, or was left waiting for, supply units at or after the
+    given position of the barcode's supply queue.
+    """
+    return Sale.objects.filter(barcode=barcode, total_quantity__gte=units_before) \
+        .order_by('sale_time', 'id').only('sale_time', 'id').first()
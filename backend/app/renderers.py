@@ -0,0 +1,49 @@
+import csv
+import json
+from abc import ABCMeta, abstractmethod
+
+from rest_framework.renderers import BaseRenderer
+
+from djangorestframework_camel_case.util import camelize
+
+
+class StreamingRenderer(BaseRenderer, metaclass=ABCMeta):
+    """
+    Renders rows one at a time, so exports can be streamed without holding the result in memory.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        fields = list(data[0]) if data else []
+        return ''.join(self.stream(data, fields)).encode(self.charset)
+
+    @abstractmethod
+    def stream(self, rows, fields):
+        """
+        Yields the rendered chunks of the `fields` of the rows.
+        """
+
+
+class NDJSONRenderer(StreamingRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def stream(self, rows, fields):
+        for row in rows:
+            yield json.dumps(camelize(row), separators=(',', ':')) + '\n'
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+class CSVRenderer(StreamingRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def stream(self, rows, fields):
+        writer = csv.writer(_Echo())
+        yield writer.writerow(list(camelize({field: None for field in fields})))
+        for row in rows:
+            yield writer.writerow([row[field] for field in fields])
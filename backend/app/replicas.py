@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from .report_cache import REPORT_CACHE
+
+# alias the ORM reads from in the current request, None for the primary
+_read_alias = ContextVar('read_alias', default=None)
+
+
+class ReplicaRouter:
+    """
+    Reads inside `reading_from(alias)` go to that database, all other reads and every
+    write to the primary. Views opt in per request, so recalculations and the reads of
+    write requests never see a lagging replica.
+    """
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+@contextmanager
+def reading_from(alias):
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def _pin_key(barcode):
+    return 'replica-pin:%s' % ('all' if barcode is None else barcode)
+
+
+def pin_to_primary(barcode):
+    """
+    Sends the reads of the barcode to the primary for REPLICA_PIN_SECONDS after the current
+    transaction commits, so a client reads its own writes while the replica catches up. Reads
+    not limited to a barcode are only pinned with REPLICA_UNSCOPED_PIN_SECONDS set, any write
+    would otherwise take them all off the replica. The pins live in the reports cache.
+    """
+    if not settings.REPLICA_DATABASE:
+        return
+    cache = caches[REPORT_CACHE]
+    transaction.on_commit(lambda: cache.set(_pin_key(barcode), True, timeout=settings.REPLICA_PIN_SECONDS))
+    if settings.REPLICA_UNSCOPED_PIN_SECONDS > 0:
+        transaction.on_commit(lambda: cache.set(_pin_key(None), True, timeout=settings.REPLICA_UNSCOPED_PIN_SECONDS))
+
+
+def replica_for(barcode=None):
+    """
+    Database alias for a read of the barcode (of any barcode with None): the replica unless
+    the barcode was written to recently, None for the primary.
+    """
+    if not settings.REPLICA_DATABASE or caches[REPORT_CACHE].get(_pin_key(barcode)):
+        return None
+    return settings.REPLICA_DATABASE
+
+
+def replica_for_barcodes(barcodes):
+    """
+    `replica_for` a read spanning several barcodes: the replica unless any of them was
+    written to recently.
+    """
+    if not settings.REPLICA_DATABASE or any(caches[REPORT_CACHE].get_many([_pin_key(b) for b in barcodes]).values()):
+        return None
+    return settings.REPLICA_DATABASE
+
+
+async def areplica_for(barcode=None):
+    if not settings.REPLICA_DATABASE or await caches[REPORT_CACHE].aget(_pin_key(barcode)):
+        return None
+    return settings.REPLICA_DATABASE
+
+
+def get_recent(queryset, **lookup):
+    """
+    The `.values()` row matching `lookup`, read from the replica unless it doesn't have the
+    row yet or the row's barcode is pinned, then from the primary. A retrieve doesn't know
+    its barcode up front, this keeps read-your-writes without an unscoped pin.
+    """
+    alias = replica_for()
+    if alias:
+        with reading_from(alias):
+            row = queryset.filter(**lookup).first()
+        if row is not None and replica_for(row['barcode']):
+            return row
+    return queryset.get(**lookup)
+
+
+async def aget_recent(queryset, **lookup):
+    alias = await areplica_for()
+    if alias:
+        with reading_from(alias):
+            row = await queryset.filter(**lookup).afirst()
+        if row is not None and await areplica_for(row['barcode']):
+            return row
+    return await queryset.aget(**lookup)
+
+
+@checks.register(checks.Tags.database)
+def check_replica_pins(app_configs, **kwargs):
+    """
+    Pins in a per-process cache are only seen by the worker that wrote, the others keep
+    reading the lagging replica.
+    """
+    if settings.REPLICA_DATABASE and isinstance(caches[REPORT_CACHE], LocMemCache):
+        return [checks.Warning(
+            'REPLICA_DATABASE is set without REPORT_CACHE_URL',
+            hint='Replica pins live in a per-process cache, so reads only see their own writes '
+                 'in the worker that made them. Point REPORT_CACHE_URL at redis with several workers.',
+            id='app.W001',
+        )]
+    return []
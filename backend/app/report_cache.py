@@ -0,0 +1,108 @@
+import threading
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+
+REPORT_CACHE = 'reports'
+
+
+class CacheStats:
+    """
+    Report cache hits and misses of this process.
+    """
+    def __init__(self):
+        self._guard = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        with self._guard:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def snapshot(self):
+        with self._guard:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+report_cache_stats = CacheStats()
+
+
+def _version_key(barcode):
+    return 'report-version:%s' % barcode
+
+
+def report_version(barcode):
+    """
+    Current report version of the barcode. A missing (or evicted) version restarts from a
+    timestamp, so it can never collide with entries of an earlier version.
+    """
+    cache = caches[REPORT_CACHE]
+    version = cache.get(_version_key(barcode))
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(_version_key(barcode), version, timeout=None):
+            version = cache.get(_version_key(barcode), version)
+    return version
+
+
+async def areport_version(barcode):
+    cache = caches[REPORT_CACHE]
+    version = await cache.aget(_version_key(barcode))
+    if version is None:
+        version = time.time_ns()
+        if not await cache.aadd(_version_key(barcode), version, timeout=None):
+            version = await cache.aget(_version_key(barcode), version)
+    return version
+
+
+def invalidate_reports(barcode):
+    """
+    Drops the cached reports of the barcode once the current transaction commits.
+    """
+    transaction.on_commit(lambda: _bump_version(barcode))
+
+
+def _bump_version(barcode):
+    try:
+        caches[REPORT_CACHE].incr(_version_key(barcode))
+    except ValueError:
+        # no version yet, the next read starts a fresh one
+        pass
+
+
+def cached_report(barcode, from_time, to_time, build_report):
+    """
+    Report for the window from the cache, built with `build_report()` on a miss.
+    The version is read before the report is built, so a write committing meanwhile
+    can only leave its result under an already outdated key.
+    """
+    cache = caches[REPORT_CACHE]
+    key = _report_key(barcode, report_version(barcode), from_time, to_time)
+    report = cache.get(key)
+    report_cache_stats.record(report is not None)
+    if report is None:
+        report = build_report()
+        cache.set(key, report)
+    return report
+
+
+async def acached_report(barcode, from_time, to_time, build_report):
+    """
+    `cached_report` for async views, `build_report()` returns an awaitable.
+    """
+    cache = caches[REPORT_CACHE]
+    key = _report_key(barcode, await areport_version(barcode), from_time, to_time)
+    report = await cache.aget(key)
+    report_cache_stats.record(report is not None)
+    if report is None:
+        report = await build_report()
+        await cache.aset(key, report)
+    return report
+
+
+def _report_key(barcode, version, from_time, to_time):
+    return 'report:%s:%s:%s:%s' % (barcode, version, from_time.isoformat(), to_time.isoformat())
@@ -0,0 +1,97 @@
+from datetime import timedelta, timezone as dt_timezone
+
+from django.db.models import F
+
+from .models import Sale, SaleRollup
+
+GRANULARITIES = [SaleRollup.HOUR, SaleRollup.DAY]
+
+
+def bucket_start(moment, granularity):
+    moment = moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if granularity == SaleRollup.DAY:
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def refresh_rollups(barcode, since=None, until=None):
+    """
+    Rebuilds the hour and day rollups of the barcode from the day containing `since`
+    (the whole history without it) through the day containing `until` (to the end without
+    it). A bucket's values are the running totals of its last sale minus those of the last
+    sale before it, so one ordered pass over the sales of the affected range is enough, and
+    buckets whose sales all shifted by the same amount keep their values.
+    """
+    rollups = SaleRollup.objects.filter(barcode=barcode)
+    sales = Sale.objects.filter(barcode=barcode)
+    base = (0, 0, 0)
+    if since is not None:
+        since = bucket_start(since, SaleRollup.DAY)
+        rollups = rollups.filter(bucket_start__gte=since)
+        sales = sales.filter(sale_time__gte=since)
+        prev_sale = Sale.objects.filter(barcode=barcode, sale_time__lt=since).order_by('-sale_time', '-id') \
+            .values_list('total_revenue', 'total_net_profit', 'total_quantity').first()
+        base = prev_sale or base
+    if until is not None:
+        until = bucket_start(until, SaleRollup.DAY) + timedelta(days=1)
+        rollups = rollups.filter(bucket_start__lt=until)
+        sales = sales.filter(sale_time__lt=until)
+    rollups.delete()
+
+    bucket_base = {granularity: base for granularity in GRANULARITIES}
+    buckets = {granularity: {} for granularity in GRANULARITIES}
+    last_totals = base
+    rows = sales.order_by('sale_time', 'id') \
+        .values_list('sale_time', 'total_revenue', 'total_net_profit', 'total_quantity').iterator(chunk_size=1000)
+    for sale_time, *totals in rows:
+        for granularity in GRANULARITIES:
+            start = bucket_start(sale_time, granularity)
+            if start not in buckets[granularity]:
+                bucket_base[granularity] = last_totals
+            buckets[granularity][start] = [total - prev for total, prev in zip(totals, bucket_base[granularity])]
+        last_totals = totals
+
+    SaleRollup.objects.bulk_create([
+        SaleRollup(
+            barcode=barcode,
+            granularity=granularity,
+            bucket_start=start,
+            revenue=revenue,
+            net_profit=net_profit,
+            quantity=quantity,
+        )
+        for granularity in GRANULARITIES
+        for start, (revenue, net_profit, quantity) in buckets[granularity].items()
+    ], batch_size=1000)
+
+
+def get_series(barcode, from_time, to_time, granularity):
+    """
+    Rollups of the buckets overlapping [from_time, to_time], in one range scan over the
+    (barcode, granularity, bucket_start) index. Buckets without sales are left out.
+    """
+    return SaleRollup.objects.filter(
+        barcode=barcode,
+        granularity=granularity,
+        bucket_start__gte=bucket_start(from_time, granularity),
+        bucket_start__lte=to_time,
+    ).order_by('bucket_start').values_list('bucket_start', 'revenue', 'net_profit', 'quantity')
+
+
+def add_to_rollups(barcode, sale_time, revenue, net_profit, quantity):
+    """
+    Adds the revenue, net profit and quantity of a sale appended after all others to its hour
+    and day buckets, one UPDATE per bucket, creating the buckets it opens.
+    """
+    for granularity in GRANULARITIES:
+        start = bucket_start(sale_time, granularity)
+        updated = SaleRollup.objects.filter(barcode=barcode, granularity=granularity, bucket_start=start).update(
+            revenue=F('revenue') + revenue,
+            net_profit=F('net_profit') + net_profit,
+            quantity=F('quantity') + quantity,
+        )
+        if not updated:
+            SaleRollup.objects.create(
+                barcode=barcode, granularity=granularity, bucket_start=start,
+                revenue=revenue, net_profit=net_profit, quantity=quantity,
+            )
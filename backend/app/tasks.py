@@ -0,0 +1,171 @@
+import asyncio
+import time
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+
+from .locks import barcode_lock
+from .models import DirtyBarcode
+from .partitions import ensure_partitions
+from .recalculation import (
+    ChangeBounds, drop_barcode_state, recalculate_from, refresh_barcode_state, supply_change_point
+)
+from .replicas import pin_to_primary
+from .report_cache import invalidate_reports
+
+
+def is_deferred():
+    return settings.RECALCULATION_MODE == 'deferred'
+
+
+def earliest_key(first, second):
+    """
+    Earlier of two (sale_time, sale_id) recalculation starts, where an empty sale_time
+    stands for the beginning of the history.
+    """
+    if first[0] is None or second[0] is None:
+        return None, 0
+    return min(first, second)
+
+
+# metrics label of a deferred pass merging writes of different kinds
+COALESCED = 'coalesced'
+
+BOUNDS_FIELDS = ['bounded', 'last_sale_time', 'last_sale_id', 'last_supply_time', 'last_supply_id']
+
+
+def bounds_fields(bounds):
+    """
+    DirtyBarcode field values storing the change bounds, None for unknown bounds.
+    """
+    sale = bounds.sale if bounds and bounds.sale else (None, 0)
+    supply = bounds.supply if bounds and bounds.supply else (None, 0)
+    return dict(zip(BOUNDS_FIELDS, [bounds is not None, *sale, *supply]))
+
+
+def dirty_bounds(dirty):
+    if not dirty.bounded:
+        return None
+    return ChangeBounds(
+        sale=(dirty.last_sale_time, dirty.last_sale_id) if dirty.last_sale_time else None,
+        supply=(dirty.last_supply_time, dirty.last_supply_id) if dirty.last_supply_time else None,
+    )
+
+
+def mark_dirty(barcode, sale_time=None, sale_id=0, bounds=None, trigger='full'):
+    """
+    Records that the barcode needs a recalculation from (sale_time, sale_id). Repeated
+    writes to a dirty barcode only move its start back and its change bounds forward,
+    so they are merged into one pass, labelled with their `trigger` when they all share
+    it and COALESCED otherwise. Without bounds the pass rewrites every sale. The barcode's
+    state row goes until the pass has run, appends take the replay path meanwhile.
+    """
+    with transaction.atomic():
+        drop_barcode_state(barcode)
+        dirty, created = DirtyBarcode.objects.get_or_create(barcode=barcode, defaults={
+            'sale_time': sale_time, 'sale_id': sale_id, 'trigger': trigger, **bounds_fields(bounds)
+        })
+        if not created:
+            dirty = DirtyBarcode.objects.select_for_update().get(id=dirty.id)
+            dirty.sale_time, dirty.sale_id = earliest_key((dirty.sale_time, dirty.sale_id), (sale_time, sale_id))
+            merged = dirty_bounds(dirty)
+            if merged is not None and bounds is not None:
+                merged = merged.merge(bounds)
+            else:
+                merged = None
+            for field, value in bounds_fields(merged).items():
+                setattr(dirty, field, value)
+            if dirty.trigger != trigger:
+                dirty.trigger = COALESCED
+            dirty.version += 1
+            dirty.save(update_fields=['sale_time', 'sale_id', *BOUNDS_FIELDS, 'trigger', 'version', 'marked_at'])
+    transaction.on_commit(lambda: recalculate_dirty.delay(barcode))
+
+
+def schedule_recalculation(barcode, sale_time=None, sale_id=0, bounds=None, trigger='full'):
+    invalidate_reports(barcode)
+    pin_to_primary(barcode)
+    if is_deferred():
+        mark_dirty(barcode, sale_time, sale_id, bounds, trigger)
+    else:
+        recalculate_from(barcode, sale_time, sale_id, bounds, trigger)
+
+
+def schedule_supply_recalculation(barcode, units_before, last_supply_key=None, trigger='supply'):
+    invalidate_reports(barcode)
+    pin_to_primary(barcode)
+    bounds = ChangeBounds(supply=last_supply_key) if last_supply_key else None
+    first_sale = supply_change_point(barcode, units_before)
+    if first_sale:
+        schedule_recalculation(barcode, first_sale.sale_time, first_sale.id, bounds, trigger)
+        return
+    dirty = DirtyBarcode.objects.filter(barcode=barcode).first() if is_deferred() else None
+    if dirty is not None:
+        # while a recalculation is pending the stored totals may be too low to reach the
+        # supply, so the pending pass has to account for it anyway
+        mark_dirty(barcode, dirty.sale_time, dirty.sale_id, bounds, trigger)
+    else:
+        # no sale is affected, only the supply side of the state changes
+        refresh_barcode_state(barcode)
+
+
+def wait_for_recalculation(barcode, timeout):
+    """
+    Waits until the barcode has no pending recalculation. Returns False if it is still
+    dirty after `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while DirtyBarcode.objects.filter(barcode=barcode).exists():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def wait_for_recalculations(barcodes, timeout):
+    """
+    `wait_for_recalculation` for many barcodes at once. Returns the barcodes still dirty
+    after `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        dirty = set(DirtyBarcode.objects.filter(barcode__in=barcodes).values_list('barcode', flat=True))
+        if not dirty or time.monotonic() >= deadline:
+            return dirty
+        time.sleep(0.05)
+
+
+async def await_for_recalculation(barcode, timeout):
+    """
+    `wait_for_recalculation` for async views, polling without holding a thread.
+    """
+    deadline = time.monotonic() + timeout
+    while await DirtyBarcode.objects.filter(barcode=barcode).aexists():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+@shared_task(ignore_result=True)
+def recalculate_dirty(barcode):
+    with barcode_lock(barcode):
+        dirty = DirtyBarcode.objects.filter(barcode=barcode).first()
+        if dirty is None:
+            # already drained by an earlier task for the same barcode
+            return
+        recalculate_from(barcode, dirty.sale_time, dirty.sale_id, dirty_bounds(dirty), dirty.trigger)
+        # a write that landed meanwhile bumped the version and queued its own task
+        DirtyBarcode.objects.filter(id=dirty.id, version=dirty.version).delete()
+
+
+@shared_task(ignore_result=True)
+def drain_dirty():
+    for barcode in DirtyBarcode.objects.order_by('marked_at').values_list('barcode', flat=True):
+        recalculate_dirty(barcode)
+
+
+@shared_task(ignore_result=True)
+def create_partitions():
+    ensure_partitions()
@@ -1,3 +1,893 @@
-from django.test import TestCase
+import io
+import base64
+import json
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import F
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from . import batch_reports, recalculation, tasks, views, writeback
+from .engine import match_fifo
+from .models import Allocation, Checkpoint, DirtyBarcode, Sale, SaleRollup, Supply
+from .recalculation import recalculate_from, refresh_supply_totals, reprice_supply, verify_from
+from .replicas import aget_recent, check_replica_pins
+from .report_cache import REPORT_CACHE, report_version
+from .rollups import GRANULARITIES
+
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def at(minute):
+    return START + timedelta(minutes=minute)
+
+
+def loop_fifo(sales, supplies):
+    """
+    The per-sale loop the FIFO engine replaced, on (quantity, price) sales and supplies in FIFO
+    order. Returns the (revenue, net profit, quantity) totals after each sale and the (supply
+    index, remaining quantity) it ended on, None when it ran out of supplies.
+    """
+    supplies = iter(enumerate(supplies))
+    supply, supply_avail_q = None, 0
+    revenue = net_profit = quantity = 0
+    totals, states = [], []
+    for sale_q, price in sales:
+        matched, state = False, None
+        while not matched:
+            try:
+                if not supply_avail_q:
+                    supply = next(supplies)
+                    supply_avail_q = supply[1][0]
+            except StopIteration:
+                break
+            q_update = min(sale_q, supply_avail_q)
+            if sale_q <= supply_avail_q:
+                matched = True
+                state = (supply[0], supply_avail_q - q_update)
+            sale_q -= q_update
+            supply_avail_q -= q_update
+            net_profit += (price - supply[1][1]) * q_update
+            revenue += price * q_update
+            quantity += q_update
+        if not matched:
+            revenue += price * sale_q
+            net_profit += price * sale_q
+            quantity += sale_q
+        totals.append((revenue, net_profit, quantity))
+        states.append(state)
+    return totals, states
+
+
+def random_history(rnd, sales, supplies, max_minute):
+    """
+    (minute, quantity, price) sales and supplies on few distinct minutes, so times tie, with
+    zero-quantity sales and, from time to time, fewer units supplied than sold.
+    """
+    return (
+        [(rnd.randrange(max_minute), rnd.choice([0, 1, 2, 3, 5]), rnd.randint(100, 150)) for _ in range(sales)],
+        [(rnd.randrange(max_minute), rnd.randint(1, 8), rnd.randint(50, 100)) for _ in range(supplies)],
+    )
+
+
+@contextmanager
+def recorded_replays():
+    """
+    Collects what every replay returned: the time of the sale it converged at, None when it
+    went through to the last sale.
+    """
+    stops, replay = [], recalculation.recalculate
+
+    def record(*args, **kwargs):
+        stops.append(replay(*args, **kwargs))
+        return stops[-1]
+
+    with mock.patch.object(recalculation, 'recalculate', side_effect=record):
+        yield stops
+
+
+class LedgerTestCase(TestCase):
+    """
+    Helpers to seed a barcode's history and write to it through the API.
+    """
+    client_class = APIClient
+
+    def seed(self, barcode, supplies=(), sales=()):
+        """
+        Inserts (minute, quantity, price) supplies and sales and recalculates the barcode.
+        """
+        Supply.objects.bulk_create([
+            Supply(barcode=barcode, supply_time=at(minute), quantity=quantity, price=price)
+            for minute, quantity, price in supplies
+        ])
+        Sale.objects.bulk_create([
+            Sale(barcode=barcode, sale_time=at(minute), quantity=quantity, price=price)
+            for minute, quantity, price in sales
+        ])
+        refresh_supply_totals(barcode)
+        recalculate_from(barcode)
+
+    def write(self, method, url, **data):
+        response = getattr(self.client, method)('/api/' + url, data, format='json')
+        self.assertIn(response.status_code, (200, 201), response.content)
+        return response.json() if response.content else None
+
+    def create_sale(self, barcode, minute, quantity, price):
+        return self.write('post', 'sales', barcode=barcode, quantity=quantity, price=price,
+                          saleTime=at(minute).strftime(TIME_FORMAT))
+
+    def create_supply(self, barcode, minute, quantity, price):
+        return self.write('post', 'supplies', barcode=barcode, quantity=quantity, price=price,
+                          supplyTime=at(minute).strftime(TIME_FORMAT))
+
+    def report(self, barcode, from_minute=-1, to_minute=10 ** 5):
+        response = self.client.get('/api/reports', {
+            'barcode': barcode,
+            'fromTime': at(from_minute).strftime(TIME_FORMAT),
+            'toTime': at(to_minute).strftime(TIME_FORMAT),
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def assertLedgerReplays(self, barcode):
+        """
+        The stored running totals and FIFO state equal a replay of the whole history.
+        """
+        diff = verify_from(barcode)
+        self.assertEqual(diff.mismatched, 0, diff.examples)
+        self.assertEqual(refresh_supply_totals(barcode, dry_run=True), 0)
+
+
+@override_settings(RECALCULATION_MODE='deferred', RECALCULATION_REPORT_WAIT=0)
+class DeferredRecalculationTest(LedgerTestCase):
+    """
+    Deferred mode on the eager celery settings: writes mark the barcode dirty and the
+    recalculation runs when the task does, simulated by holding the task back.
+    """
+    def setUp(self):
+        with self.settings(RECALCULATION_MODE='sync'):
+            for barcode in (1, 2):
+                self.seed(barcode, supplies=[(0, 10, 50), (100, 10, 60)],
+                          sales=[(minute, 2, 100 + minute) for minute in range(5, 200, 15)])
+
+    def apply_writes(self, barcode):
+        self.create_sale(barcode, 32, 3, 120)
+        self.create_supply(barcode, 50, 5, 40)
+        sale = Sale.objects.filter(barcode=barcode, sale_time=at(65)).get()
+        self.write('put', 'sales/%d' % sale.id, quantity=1, price=90, saleTime=at(12).strftime(TIME_FORMAT))
+        sale = Sale.objects.filter(barcode=barcode, sale_time=at(140)).get()
+        self.write('delete', 'sales/%d' % sale.id)
+
+    def test_marks_coalesce_into_one_recalculation(self):
+        with mock.patch.object(tasks.recalculate_dirty, 'delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            late = self.create_sale(1, 150, 1, 100)
+            earliest = self.create_sale(1, 40, 1, 100)
+            self.create_sale(1, 90, 1, 100)
+        self.assertEqual(delay.call_count, 3)
+
+        dirty = DirtyBarcode.objects.get(barcode=1)
+        self.assertEqual(dirty.version, 3)
+        self.assertEqual((dirty.sale_time, dirty.sale_id), (at(40), earliest['id']))
+        self.assertEqual(dirty.last_sale_id, late['id'])
+
+        with mock.patch.object(tasks, 'recalculate_from', wraps=recalculate_from) as recalculate:
+            tasks.drain_dirty()
+        recalculate.assert_called_once()
+        self.assertEqual(recalculate.call_args.args[:3], (1, at(40), earliest['id']))
+        self.assertFalse(DirtyBarcode.objects.exists())
+        self.assertLedgerReplays(1)
+
+    def test_writes_bump_the_report_version(self):
+        versions = report_version(1), report_version(2)
+        with mock.patch.object(tasks.recalculate_dirty, 'delay'), self.captureOnCommitCallbacks(execute=True):
+            self.create_sale(1, 32, 3, 120)
+        self.assertNotEqual(report_version(1), versions[0])
+        self.assertEqual(report_version(2), versions[1])
+
+    def test_reports_are_stale_until_drained(self):
+        with mock.patch.object(tasks.recalculate_dirty, 'delay'), self.captureOnCommitCallbacks(execute=True):
+            self.apply_writes(1)
+        self.assertTrue(self.report(1)['stale'])
+
+        tasks.drain_dirty()
+        deferred = self.report(1)
+        self.assertNotIn('stale', deferred)
+        self.assertLedgerReplays(1)
+
+        with self.settings(RECALCULATION_MODE='sync'), self.captureOnCommitCallbacks(execute=True):
+            self.apply_writes(2)
+        immediate = self.report(2)
+        self.assertEqual(dict(deferred, barcode=2), immediate)
+
+    def test_passes_keep_the_trigger_of_their_writes(self):
+        def drained_triggers():
+            with mock.patch.object(recalculation, 'record_recalculation') as record:
+                tasks.drain_dirty()
+            return [call.args[0] for call in record.call_args_list]
+
+        with mock.patch.object(tasks.recalculate_dirty, 'delay'), self.captureOnCommitCallbacks(execute=True):
+            self.create_sale(1, 32, 3, 120)
+            for minute in (65, 140):
+                self.write('delete', 'sales/%d' % Sale.objects.get(barcode=2, sale_time=at(minute)).id)
+        self.assertEqual(DirtyBarcode.objects.get(barcode=2).trigger, 'destroy')
+        self.assertEqual(drained_triggers(), ['backdated', 'destroy'])
+
+        with mock.patch.object(tasks.recalculate_dirty, 'delay'), self.captureOnCommitCallbacks(execute=True):
+            self.apply_writes(1)
+        self.assertEqual(drained_triggers(), [tasks.COALESCED])
+        self.assertLedgerReplays(1)
+        self.assertLedgerReplays(2)
+
+    def test_eager_task_recalculates_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_sale(1, 32, 3, 120)
+        self.assertFalse(DirtyBarcode.objects.exists())
+        self.assertNotIn('stale', self.report(1))
+        self.assertLedgerReplays(1)
+
+
+class FifoEngineTest(LedgerTestCase):
+    """
+    `match_fifo` and the chunked database replay against the per-sale loop they replaced.
+    """
+    def test_match_fifo_equals_the_loop(self):
+        rnd = random.Random(4)
+        for _ in range(300):
+            sales, supplies = random_history(rnd, rnd.randint(0, 30), rnd.randint(0, 10), 1)
+            sales = [(quantity, price) for _, quantity, price in sales]
+            supplies = [(quantity, price) for _, quantity, price in supplies]
+            totals, states = loop_fifo(sales, supplies)
+
+            result = match_fifo([q for q, _ in sales], [p for _, p in sales],
+                                [q for q, _ in supplies], [p for _, p in supplies])
+            self.assertEqual(list(zip(result.total_revenue.tolist(), result.total_net_profit.tolist(),
+                                      result.total_quantity.tolist())), totals)
+            for index, state in enumerate(states):
+                if state is not None:
+                    self.assertEqual((result.supply_index[index], result.remaining_q[index]), state)
+
+    def test_unsupplied_sales_count_at_full_price(self):
+        result = match_fifo([2, 0, 3], [100, 90, 120], [4], [30])
+        self.assertEqual(result.total_revenue.tolist(), [200, 200, 560])
+        self.assertEqual(result.total_net_profit.tolist(), [140, 140, 140 + 2 * (120 - 30) + 120])
+        self.assertEqual(result.total_quantity.tolist(), [2, 2, 5])
+
+    @mock.patch.multiple(recalculation, FIRST_SALE_CHUNK=4, SUPPLY_PAGE=3)
+    def test_recalculate_equals_the_loop(self):
+        rnd = random.Random(5)
+        for barcode in range(1, 13):
+            sales, supplies = random_history(rnd, rnd.randint(0, 40), rnd.randint(0, 12), 10)
+            if barcode == 1:
+                supplies = []
+            self.seed(barcode, supplies, sales)
+
+            sales = list(Sale.objects.filter(barcode=barcode).order_by('sale_time', 'id'))
+            supply_ids = list(Supply.objects.filter(barcode=barcode).order_by('supply_time', 'id')
+                              .values_list('id', 'quantity', 'price'))
+            totals, states = loop_fifo([(sale.quantity, sale.price) for sale in sales],
+                                       [(quantity, price) for _, quantity, price in supply_ids])
+            for sale, sale_totals, state in zip(sales, totals, states):
+                self.assertEqual((sale.total_revenue, sale.total_net_profit, sale.total_quantity), sale_totals)
+                if state is not None:
+                    self.assertEqual((sale.last_connected_supply_id, sale.last_connected_supply_remaining_q),
+                                     (supply_ids[state[0]][0], state[1]))
+
+
+@mock.patch.multiple(recalculation, FIRST_SALE_CHUNK=4, SUPPLY_PAGE=3)
+class ConvergenceTest(LedgerTestCase):
+    """
+    Bounded replays stop where the FIFO state converges and shift the totals of the rest,
+    which has to leave the same ledger as a full replay.
+    """
+    def setUp(self):
+        # 10 units every 30 minutes for about 1.5 sold, until minute 150 (the last lot at 120)
+        self.seed(1, supplies=[(minute, 10, 50 + minute // 30) for minute in range(0, 150, 30)],
+                  sales=[(minute, 1 + minute % 2, 100 + minute % 7) for minute in range(5, 300, 5)])
+
+    def sale_at(self, minute):
+        return Sale.objects.get(barcode=1, sale_time=at(minute))
+
+    def test_backdated_insert_replays_to_the_end(self):
+        self.seed(2, supplies=[(0, 1000, 50)], sales=[(minute, 2, 100) for minute in range(5, 300, 5)])
+        with recorded_replays() as stops:
+            self.create_sale(2, 22, 2, 120)
+        self.assertEqual(stops, [None])
+        self.assertLedgerReplays(2)
+
+    def test_backdated_insert_converges_once_out_of_stock(self):
+        with recorded_replays() as stops:
+            self.create_sale(1, 22, 2, 120)
+        self.assertEqual(len(stops), 1)
+        self.assertIsNotNone(stops[0])
+        self.assertLess(stops[0], at(295))
+        self.assertLedgerReplays(1)
+
+    def test_moved_sale_converges_past_its_old_position(self):
+        sale = self.sale_at(100)
+        with recorded_replays() as stops:
+            self.write('put', 'sales/%d' % sale.id, quantity=sale.quantity, price=sale.price,
+                       saleTime=at(52).strftime(TIME_FORMAT))
+        self.assertEqual(stops, [at(105)])
+        self.assertLedgerReplays(1)
+
+    def test_repriced_sale_converges_right_after_it(self):
+        sale = self.sale_at(60)
+        with recorded_replays() as stops:
+            self.write('put', 'sales/%d' % sale.id, quantity=sale.quantity, price=sale.price + 40,
+                       saleTime=at(60).strftime(TIME_FORMAT))
+        self.assertEqual(stops, [at(65)])
+        self.assertLedgerReplays(1)
+
+    def test_deleted_sale(self):
+        with recorded_replays() as stops:
+            self.write('delete', 'sales/%d' % self.sale_at(40).id)
+        self.assertEqual(len(stops), 1)
+        self.assertLedgerReplays(1)
+
+    def test_backdated_supply(self):
+        with recorded_replays():
+            self.create_supply(1, 70, 4, 30)
+        self.assertLedgerReplays(1)
+
+
+class ExportTest(LedgerTestCase):
+    """
+    The export reads keyset ordered chunks instead of a server-side cursor.
+    """
+    def test_chunks_cover_the_range_once_across_ties(self):
+        self.seed(1, supplies=[(0, 100, 10)], sales=[(minute // 4, 1, 20) for minute in range(20)])
+        self.seed(2, sales=[(0, 1, 20)])
+        with mock.patch.object(views, 'EXPORT_CHUNK', 3):
+            response = self.client.get('/api/sales/export', {'barcode': 1}, HTTP_ACCEPT='application/x-ndjson')
+            self.assertEqual(response.status_code, 200)
+            rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(
+            [row['id'] for row in rows],
+            list(Sale.objects.filter(barcode=1).order_by('sale_time', 'id').values_list('id', flat=True))
+        )
+
+
+@override_settings(REPLICA_DATABASE='replica', REPLICA_PIN_SECONDS=60, REPLICA_UNSCOPED_PIN_SECONDS=0)
+class ReplicaRoutingTest(TransactionTestCase):
+    """
+    Reads go to a second SQLite file standing in for the replica. Rows seeded only there, or
+    only in the primary, show which database answered.
+    """
+    databases = {'default', 'replica'}
+    client_class = APIClient
+
+    def setUp(self):
+        caches[REPORT_CACHE].clear()
+
+    def replica_sale(self, barcode, minute, price=100, **fields):
+        # ids well clear of the primary's, so a listed id tells the two apart
+        fields.setdefault('id', 1000 + Sale.objects.using('replica').count())
+        return Sale.objects.using('replica').create(barcode=barcode, sale_time=at(minute), price=price, **fields)
+
+    def create_sale(self, barcode, minute, price=100):
+        response = self.client.post('/api/sales', {
+            'barcode': barcode, 'quantity': 1, 'price': price, 'saleTime': at(minute).strftime(TIME_FORMAT)
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['id']
+
+    def listed_ids(self, **params):
+        response = self.client.get('/api/sales', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [row['id'] for row in response.json()]
+
+    def test_reads_go_to_the_replica(self):
+        sale = self.replica_sale(1, 0)
+        self.assertEqual(self.listed_ids(barcode=1), [sale.id])
+        self.assertEqual(self.listed_ids(), [sale.id])
+        self.assertEqual(self.client.get('/api/sales/%d' % sale.id).json()['price'], 100)
+
+    def test_write_pins_only_its_barcode(self):
+        other = self.replica_sale(2, 0)
+        stale = self.replica_sale(1, 5)
+        created = self.create_sale(1, 10)
+
+        self.assertEqual(self.listed_ids(barcode=1), [created])
+        self.assertEqual(self.listed_ids(barcode=2), [other.id])
+        self.assertEqual(self.listed_ids(), [other.id, stale.id])
+
+    @override_settings(REPLICA_UNSCOPED_PIN_SECONDS=60)
+    def test_unscoped_pin_is_opt_in(self):
+        self.replica_sale(2, 0)
+        created = self.create_sale(1, 10)
+        self.assertEqual(self.listed_ids(), [created])
+
+    def test_retrieve_reads_its_own_writes(self):
+        created = self.create_sale(1, 10, price=150)
+        self.assertEqual(self.client.get('/api/sales/%d' % created).json()['price'], 150)
+
+        # the replica caught up with an older version of the row, the pin still wins
+        self.replica_sale(1, 10, price=90, id=created)
+        self.assertEqual(self.client.get('/api/sales/%d' % created).json()['price'], 150)
+        row = async_to_sync(aget_recent)(Sale.objects.values('id', 'barcode', 'price'), pk=created)
+        self.assertEqual(row['price'], 150)
+
+        caches[REPORT_CACHE].clear()
+        self.assertEqual(self.client.get('/api/sales/%d' % created).json()['price'], 90)
+        self.assertEqual(self.client.get('/api/sales/%d' % (created + 1)).status_code, 404)
+
+    @override_settings(REPLICA_PIN_SECONDS=0.2)
+    def test_pin_expires(self):
+        sale = self.replica_sale(1, 0)
+        created = self.create_sale(1, 10)
+        self.assertEqual(self.listed_ids(barcode=1), [created])
+        time.sleep(0.3)
+        self.assertEqual(self.listed_ids(barcode=1), [sale.id])
+
+    def test_per_process_pins_are_flagged(self):
+        self.assertEqual([warning.id for warning in check_replica_pins(None)], ['app.W001'])
+        with override_settings(REPLICA_DATABASE=None):
+            self.assertEqual(check_replica_pins(None), [])
+
+
+class RepriceTest(LedgerTestCase):
+    """
+    A mid-history supply re-priced through the allocation fast path, or re-quantified through
+    a replay, leaves the same ledger as a full recalculation.
+    """
+    def setUp(self):
+        self.seed(1, supplies=[(2, 10, 30), (32, 10, 50), (62, 10, 40), (92, 10, 70)],
+                  sales=[(minute, 3, 100) for minute in range(5, 150, 5)])
+        self.supply = Supply.objects.get(barcode=1, supply_time=at(32))
+
+    def update_supply(self, quantity, price):
+        repriced = []
+
+        def recorded(*args):
+            repriced.append(reprice_supply(*args))
+            return repriced[-1]
+
+        with mock.patch.object(views, 'reprice_supply', recorded):
+            self.write('put', 'supplies/%d' % self.supply.id, quantity=quantity, price=price,
+                       supplyTime=at(32).strftime(TIME_FORMAT))
+        return repriced == [True]
+
+    def ledger(self):
+        response = self.client.get('/api/reports/lots', {
+            'barcode': 1, 'fromTime': at(-1).strftime(TIME_FORMAT), 'toTime': at(10 ** 5).strftime(TIME_FORMAT),
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        return (
+            list(Sale.objects.filter(barcode=1).order_by('sale_time', 'id').values_list(
+                'id', 'total_revenue', 'total_net_profit', 'total_quantity',
+                'last_connected_supply_id', 'last_connected_supply_remaining_q',
+            )),
+            list(Allocation.objects.order_by('sale_id', 'supply_id').values_list('sale_id', 'supply_id', 'quantity', 'unit_cost')),
+            response.json(),
+        )
+
+    def assertEqualsFullRecalculation(self):
+        ledger = self.ledger()
+        recalculate_from(1)
+        self.assertEqual(ledger, self.ledger())
+        self.assertLedgerReplays(1)
+
+    def test_reprice_and_requantify_mid_history(self):
+        self.assertTrue(self.update_supply(10, 80))
+        self.assertEqualsFullRecalculation()
+
+        self.assertFalse(self.update_supply(25, 80))
+        self.assertEqualsFullRecalculation()
+
+        self.assertTrue(self.update_supply(25, 20))
+        self.assertEqualsFullRecalculation()
+
+        self.assertFalse(self.update_supply(4, 20))
+        self.assertEqualsFullRecalculation()
+        lots = {lot['supplyId']: lot for lot in self.ledger()[2]['lots']}
+        self.assertEqual((lots[self.supply.id]['quantity'], lots[self.supply.id]['unitCost']), (4, 20))
+
+
+class BulkCreateTest(LedgerTestCase):
+    """
+    The JSON and NDJSON bulk endpoints insert every row of a batch, or none of them.
+    """
+    def setUp(self):
+        for barcode in (1, 2):
+            self.seed(barcode, supplies=[(0, 10, 50), (60, 10, 70)],
+                      sales=[(minute, 2, 100) for minute in range(5, 120, 10)])
+
+    def post_bulk(self, url, body, content_type):
+        return self.client.post('/api/' + url, body, content_type=content_type)
+
+    def test_ids_follow_the_input_order(self):
+        minutes = [(1, 130), (2, 12), (1, 7), (3, 40), (1, 7), (2, 200)]
+        response = self.post_bulk('sales/bulk', json.dumps([
+            {'barcode': barcode, 'quantity': 3, 'price': 90 + index, 'saleTime': at(minute).strftime(TIME_FORMAT)}
+            for index, (barcode, minute) in enumerate(minutes)
+        ]), 'application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        ids = response.json()['ids']
+        self.assertEqual(
+            [Sale.objects.values_list('barcode', 'sale_time', 'price').get(id=id) for id in ids],
+            [(barcode, at(minute), 90 + index) for index, (barcode, minute) in enumerate(minutes)]
+        )
+        for barcode in (1, 2, 3):
+            self.assertLedgerReplays(barcode)
+
+    def test_backdated_ndjson_supplies(self):
+        minutes = [(1, 30), (2, 1), (1, 200), (2, 55), (1, 30)]
+        response = self.post_bulk('supplies/bulk', '\n'.join(
+            json.dumps({'barcode': barcode, 'quantity': 4, 'price': 40, 'supplyTime': at(minute).strftime(TIME_FORMAT)})
+            for barcode, minute in minutes
+        ) + '\n', 'application/x-ndjson')
+        self.assertEqual(response.status_code, 200, response.content)
+        ids = response.json()['ids']
+        self.assertEqual([Supply.objects.values_list('barcode', 'supply_time').get(id=id) for id in ids],
+                         [(barcode, at(minute)) for barcode, minute in minutes])
+        for barcode in (1, 2):
+            self.assertLedgerReplays(barcode)
+
+    def test_one_invalid_row_rejects_the_batch(self):
+        sales, supplies = Sale.objects.count(), Supply.objects.count()
+        totals = list(Sale.objects.order_by('id').values_list('total_net_profit', flat=True))
+        response = self.post_bulk('sales/bulk', json.dumps([
+            {'barcode': 1, 'quantity': 1, 'price': 100, 'saleTime': at(3).strftime(TIME_FORMAT)},
+            {'barcode': 2, 'quantity': 'many', 'price': 100, 'saleTime': at(4).strftime(TIME_FORMAT)},
+        ]), 'application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.post_bulk('supplies/bulk', '{"barcode": 1, "quantity": 1, "price": 10, "supplyTime": "%s"}\n{"barcode": 2'
+                                  % at(3).strftime(TIME_FORMAT), 'application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((Sale.objects.count(), Supply.objects.count()), (sales, supplies))
+        self.assertEqual(list(Sale.objects.order_by('id').values_list('total_net_profit', flat=True)), totals)
+
+
+class RollupTest(LedgerTestCase):
+    """
+    The hour and day rollups kept up by the writes equal a rebuild from the running totals.
+    """
+    def setUp(self):
+        # sales every 50 minutes over three days, some hours and days without any
+        self.seed(1, supplies=[(0, 40, 50), (1500, 40, 60)], sales=[(minute, 2, 100) for minute in range(10, 4000, 50)])
+
+    def rollups(self):
+        return list(SaleRollup.objects.filter(barcode=1).order_by('granularity', 'bucket_start')
+                    .values_list('granularity', 'bucket_start', 'revenue', 'net_profit', 'quantity'))
+
+    def series(self, granularity):
+        response = self.client.get('/api/reports/series', {
+            'barcode': 1, 'fromTime': at(-60).strftime(TIME_FORMAT), 'toTime': at(5000).strftime(TIME_FORMAT),
+            'granularity': granularity,
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['series']
+
+    def test_incremental_rollups_equal_a_rebuild(self):
+        self.create_sale(1, 900, 2, 110)
+        self.create_supply(1, 200, 5, 30)
+        sale = Sale.objects.get(barcode=1, sale_time=at(1410))
+        self.write('put', 'sales/%d' % sale.id, quantity=4, price=130, saleTime=at(2990).strftime(TIME_FORMAT))
+        self.write('delete', 'sales/%d' % Sale.objects.get(barcode=1, sale_time=at(60)).id)
+        # appends after the replays only touch their own buckets
+        self.create_sale(1, 4100, 3, 120)
+        self.create_sale(1, 4105, 1, 90)
+        self.create_sale(1, 4400, 2, 100)
+        rollups, series = self.rollups(), {granularity: self.series(granularity) for granularity in GRANULARITIES}
+
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        self.assertEqual(self.rollups(), rollups)
+        self.assertEqual({granularity: self.series(granularity) for granularity in GRANULARITIES}, series)
+        days = series[SaleRollup.DAY]
+        self.assertEqual([day['bucketStart'] for day in days], ['2023-01-0%d 00:00:00' % day for day in range(1, 5)])
+        last = Sale.objects.filter(barcode=1).order_by('sale_time', 'id').last()
+        self.assertEqual(sum(day['netProfit'] for day in days), last.total_net_profit)
+
+
+class RebuildLedgerTest(LedgerTestCase):
+    """
+    `rebuild_ledger --dry-run` reports corrupted totals without writing, a rebuild fixes them.
+    """
+    def setUp(self):
+        for barcode in (1, 2):
+            self.seed(barcode, supplies=[(0, 10, 50), (60, 10, 70)], sales=[(minute, 2, 100) for minute in range(5, 120, 10)])
+
+    def stored(self):
+        return (
+            list(Sale.objects.order_by('id').values_list('total_revenue', 'total_net_profit', 'total_quantity')),
+            list(Supply.objects.order_by('id').values_list('total_quantity', flat=True)),
+        )
+
+    def test_dry_run_reports_a_corrupted_total_and_writes_nothing(self):
+        sale = Sale.objects.get(barcode=1, sale_time=at(45))
+        Sale.objects.filter(id=sale.id).update(total_net_profit=F('total_net_profit') + 7)
+        Supply.objects.filter(barcode=2, supply_time=at(60)).update(total_quantity=3)
+        corrupted = self.stored()
+
+        out = io.StringIO()
+        with self.assertRaisesMessage(CommandError, '1 sales and 1 supply totals differ'):
+            call_command('rebuild_ledger', dry_run=True, stdout=out)
+        self.assertIn('barcode 1: 12 sales, 1 mismatched, 0 supply totals wrong', out.getvalue())
+        self.assertIn('barcode 2: 12 sales, 0 mismatched, 1 supply totals wrong', out.getvalue())
+        self.assertIn('sale %d: stored' % sale.id, out.getvalue())
+        self.assertEqual(self.stored(), corrupted)
+
+        call_command('rebuild_ledger', stdout=io.StringIO())
+        call_command('rebuild_ledger', dry_run=True, stdout=io.StringIO())
+        self.assertLedgerReplays(1)
+        self.assertLedgerReplays(2)
+
+
+class KeysetPaginationTest(LedgerTestCase):
+    """
+    List pages seek past the (time, id) cursor of the previous page, ties on the time included.
+    """
+    def setUp(self):
+        self.seed(1, supplies=[(0, 100, 50)], sales=[(minute // 4, 1, 100 + minute) for minute in range(22)])
+        self.seed(2, sales=[(0, 1, 100), (3, 1, 100)])
+        self.ids = list(Sale.objects.filter(barcode=1).order_by('sale_time', 'id').values_list('id', flat=True))
+
+    def get_page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        # the async view serves the same page under ASGI
+        request = RequestFactory().get(url)
+        self.assertEqual(async_to_sync(views.alist_sales)(request).content, response.content)
+        return response
+
+    def test_pages_cover_every_row_once_in_order(self):
+        url, ids, pages = '/api/sales?barcode=1&pageSize=4', [], 0
+        while url:
+            response = self.get_page(url)
+            ids += [row['id'] for row in response.json()]
+            pages += 1
+            link = response.headers.get('Link')
+            url = link[1:link.index('>')].replace('http://testserver', '') if link else None
+        self.assertEqual(ids, self.ids)
+        self.assertEqual(pages, 6)
+
+    def test_no_link_on_the_last_page(self):
+        self.assertIn('Link', self.get_page('/api/sales?barcode=1&pageSize=21').headers)
+        self.assertNotIn('Link', self.get_page('/api/sales?barcode=1&pageSize=22').headers)
+
+    @override_settings(LIST_MAX_PAGE_SIZE=5)
+    def test_page_size_is_capped(self):
+        self.assertEqual(len(self.get_page('/api/sales?barcode=1&pageSize=100').json()), 5)
+        self.assertEqual(len(self.get_page('/api/sales?barcode=1&pageSize=0').json()), 1)
+        self.assertEqual(len(self.get_page('/api/sales?barcode=1&pageSize=many').json()), 5)
+
+    def test_malformed_cursor_is_not_found(self):
+        def encode(value):
+            return base64.urlsafe_b64encode(value.encode()).decode()
+
+        for cursor in ['%%%', 'bm90IGpzb24', encode('[]'), encode('["yesterday", 1]'),
+                       encode('["2023-01-01T00:00:00+00:00", "x"]'), encode('{"a": 1}'), encode('["\u00e9", 1]')]:
+            response = self.client.get('/api/sales', {'barcode': 1, 'cursor': cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+            self.assertEqual(response.json(), {'detail': 'Invalid cursor'})
+            request = RequestFactory().get('/api/sales', {'barcode': 1, 'cursor': cursor})
+            self.assertEqual(async_to_sync(views.alist_sales)(request).status_code, 404)
+
+
+class WritebackTest(TestCase):
+    """
+    Sale totals and allocations written back in chunks, past the chunk boundaries.
+    """
+    def setUp(self):
+        Sale.objects.bulk_create([Sale(barcode=1, sale_time=at(minute), price=100) for minute in range(2500)])
+        self.sales = list(Sale.objects.order_by('id'))
+
+    def totals(self, sale, index):
+        # every other sale without a lot, like sales past the last supply
+        return (sale.id, -index, index * 2, index * 3, None if index % 2 else sale.id, None if index % 2 else index % 7)
+
+    def stored(self):
+        return list(Sale.objects.order_by('id').values_list(
+            'id', 'total_net_profit', 'total_quantity', 'total_revenue',
+            'last_connected_supply_id', 'last_connected_supply_remaining_q',
+        ))
+
+    def test_chunks(self):
+        self.assertEqual([len(chunk) for chunk in writeback.chunks(iter(range(25)), 10)], [10, 10, 5])
+        self.assertEqual([len(chunk) for chunk in writeback.chunks(range(20), 10)], [10, 10])
+        self.assertEqual(list(writeback.chunks([], 10)), [])
+        self.assertEqual([value for chunk in writeback.chunks(range(2001), 1000) for value in chunk], list(range(2001)))
+
+    def test_executemany_update(self):
+        rows = [self.totals(sale, index) for index, sale in enumerate(self.sales)]
+        with connection.cursor() as cursor:
+            writeback._executemany_update(cursor, iter(rows))
+        self.assertEqual(self.stored(), rows)
+
+    @mock.patch.object(writeback, 'CHUNK_SIZE', 1000)
+    def test_write_sale_totals(self):
+        # COPY on postgres, the executemany UPDATE elsewhere; only the sales given change
+        rows = [self.totals(sale, index) for index, sale in enumerate(self.sales) if index % 3]
+        writeback.write_sale_totals(row for row in rows)
+        expected = {row[0]: row for row in rows}
+        self.assertEqual(self.stored(), [expected.get(sale.id, (sale.id, 0, 0, 0, None, None)) for sale in self.sales])
+
+    @mock.patch.object(writeback, 'CHUNK_SIZE', 1000)
+    def test_insert_allocations(self):
+        rows = [(1, sale.id, sale.sale_time, index % 5 + 1, index % 4, 50 + index % 9)
+                for index, sale in enumerate(self.sales[:2100])]
+        writeback.insert_allocations(iter(rows))
+        self.assertEqual(
+            list(Allocation.objects.order_by('sale_id').values_list(
+                'barcode', 'sale_id', 'sale_time', 'supply_id', 'quantity', 'unit_cost'
+            )),
+            rows
+        )
+
+
+class StockTest(LedgerTestCase):
+    """
+    Stock at a moment equals the units supplied minus the units sold up to it, summed row by row.
+    """
+    def test_stock_equals_the_brute_force_sums(self):
+        rnd = random.Random(7)
+        sales, supplies = random_history(rnd, 40, 12, 120)
+        self.seed(1, supplies=supplies, sales=sales)
+        self.seed(2, supplies=[(10, 5, 50)], sales=[(20, 2, 100)])
+        # back-dated writes through the API shift the running totals after them
+        self.create_supply(1, 15, 6, 40)
+        self.create_sale(1, 15, 4, 120)
+        supply = Supply.objects.filter(barcode=1).order_by('supply_time', 'id')[3]
+        self.write('put', 'supplies/%d' % supply.id, quantity=supply.quantity + 9, price=supply.price,
+                   supplyTime=supply.supply_time.strftime(TIME_FORMAT))
+        self.write('delete', 'supplies/%d' % Supply.objects.filter(barcode=1).order_by('supply_time', 'id')[0].id)
+        self.write('delete', 'sales/%d' % Sale.objects.filter(barcode=1).order_by('sale_time', 'id')[5].id)
+
+        for minute in [-1, *range(0, 125, 3)]:
+            supplied = sum(Supply.objects.filter(barcode=1, supply_time__lte=at(minute)).values_list('quantity', flat=True))
+            sold = sum(Sale.objects.filter(barcode=1, sale_time__lte=at(minute)).values_list('quantity', flat=True))
+            response = self.client.get('/api/stock', {'barcode': 1, 'at': at(minute).strftime(TIME_FORMAT)})
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(response.json(), {
+                'barcode': 1, 'at': at(minute).strftime(TIME_FORMAT),
+                'supplied': supplied, 'sold': sold, 'stock': supplied - sold,
+            }, minute)
+
+
+@override_settings(RECALCULATION_MODE='deferred', RECALCULATION_REPORT_WAIT=0)
+class BatchReportTest(LedgerTestCase):
+    """
+    Every entry of a batch report equals the single report of its barcode and window.
+    """
+    def setUp(self):
+        with self.settings(RECALCULATION_MODE='sync'):
+            self.seed(1, supplies=[(0, 10, 50), (60, 10, 70)], sales=[(minute, 2, 100 + minute) for minute in range(5, 120, 10)])
+            self.seed(2, supplies=[(0, 30, 40)], sales=[(minute // 3 * 10, 1, 90) for minute in range(30)])
+            # barcode 3 only sells late, barcode 4 never
+            self.seed(3, supplies=[(0, 5, 60)], sales=[(200, 3, 110), (200, 1, 120), (230, 4, 100)])
+        # barcode 2 waits for a deferred recalculation, both kinds of report flag it stale
+        with mock.patch.object(tasks.recalculate_dirty, 'delay'), self.captureOnCommitCallbacks(execute=True):
+            self.create_sale(2, 35, 2, 130)
+
+    def assertBatchEqualsSingleReports(self):
+        windows = [(-10, 300), (15, 45), (20, 20), (25, 200), (200, 230), (-30, -1), (121, 199)]
+        response = self.client.post('/api/reports/batch', {
+            'barcodes': [1, 2, 3, 4],
+            'windows': [{'fromTime': at(start).strftime(TIME_FORMAT), 'toTime': at(end).strftime(TIME_FORMAT)}
+                        for start, end in windows],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        reports = response.json()['reports']
+        self.assertEqual(len(reports), 4 * len(windows))
+
+        for report in reports:
+            window = {'fromTime': report.pop('fromTime'), 'toTime': report.pop('toTime')}
+            single = self.client.get('/api/reports', {'barcode': report['barcode'], **window})
+            self.assertEqual(report, single.json(), window)
+        self.assertEqual({report['quantity'] for report in reports if report['barcode'] == 4}, {0})
+        return {report['barcode'] for report in reports if report.get('stale')}
+
+    @mock.patch.object(batch_reports, 'POINTS_PER_QUERY', 3)
+    def test_entries_equal_the_single_reports(self):
+        self.assertEqual(self.assertBatchEqualsSingleReports(), {2})
+        tasks.drain_dirty()
+        self.assertEqual(self.assertBatchEqualsSingleReports(), set())
+
+
+class ClosedPeriodTest(LedgerTestCase):
+    """
+    Writes reaching into a closed period are rejected, later ones replay from its checkpoint.
+    """
+    def setUp(self):
+        # the sales before 01:00 take 24 units, 4 of them from the lot at 01:20: the head lot
+        # of the checkpoint lies after the closed period
+        self.seed(1, supplies=[(0, 10, 50), (40, 10, 60), (80, 10, 70), (120, 10, 80)],
+                  sales=[(minute, 4, 100) for minute in range(5, 60, 10)] + [(minute, 2, 120) for minute in range(65, 160, 10)])
+        self.seed(2, supplies=[(0, 10, 50)], sales=[(30, 2, 100)])
+        call_command('close_period', at(60).strftime(TIME_FORMAT), '1', stdout=io.StringIO())
+        self.checkpoint = Checkpoint.objects.get(barcode=1)
+        self.closed = self.closed_rows()
+
+    def sale_at(self, minute):
+        return Sale.objects.get(barcode=1, sale_time=at(minute))
+
+    def supply_at(self, minute):
+        return Supply.objects.get(barcode=1, supply_time=at(minute))
+
+    def closed_rows(self):
+        return (
+            list(Sale.objects.filter(barcode=1, sale_time__lt=at(60)).order_by('id').values_list(
+                'id', 'total_revenue', 'total_net_profit', 'total_quantity',
+                'last_connected_supply_id', 'last_connected_supply_remaining_q',
+            )),
+            list(Supply.objects.filter(barcode=1, supply_time__lte=at(80)).order_by('id').values_list(
+                'id', 'quantity', 'price', 'supply_time', 'total_quantity',
+            )),
+        )
+
+    def ledger(self):
+        return (
+            list(Sale.objects.order_by('id').values_list('id', 'sale_time', 'quantity', 'price', 'total_net_profit')),
+            list(Supply.objects.order_by('id').values_list('id', 'supply_time', 'quantity', 'price', 'total_quantity')),
+            list(Allocation.objects.order_by('id').values_list('sale_id', 'supply_id', 'quantity', 'unit_cost')),
+        )
+
+    def test_checkpoint(self):
+        head = self.supply_at(80)
+        self.assertEqual((self.checkpoint.supply_id, self.checkpoint.remaining_q), (head.id, 6))
+        self.assertEqual(self.checkpoint.total_quantity, 24)
+        self.assertFalse(Checkpoint.objects.filter(barcode=2).exists())
+
+    def test_closed_writes_are_rejected(self):
+        ledger = self.ledger()
+        time_of = {minute: at(minute).strftime(TIME_FORMAT) for minute in (30, 50, 70, 100)}
+        requests = [
+            ('post', 'sales', dict(barcode=1, quantity=1, price=100, saleTime=time_of[30])),
+            ('put', 'sales/%d' % self.sale_at(25).id, dict(quantity=1, price=100, saleTime=time_of[100])),
+            ('put', 'sales/%d' % self.sale_at(95).id, dict(quantity=2, price=120, saleTime=time_of[30])),
+            ('patch', 'sales/%d' % self.sale_at(55).id, dict(price=10)),
+            ('delete', 'sales/%d' % self.sale_at(25).id, {}),
+            ('post', 'supplies', dict(barcode=1, quantity=5, price=40, supplyTime=time_of[30])),
+            # ahead of the head lot, its units would have gone to the closed sales
+            ('post', 'supplies', dict(barcode=1, quantity=5, price=40, supplyTime=time_of[70])),
+            ('put', 'supplies/%d' % self.supply_at(80).id, dict(quantity=10, price=75, supplyTime=at(80).strftime(TIME_FORMAT))),
+            ('put', 'supplies/%d' % self.supply_at(120).id, dict(quantity=10, price=80, supplyTime=time_of[50])),
+            ('delete', 'supplies/%d' % self.supply_at(40).id, {}),
+            ('delete', 'supplies/%d' % self.supply_at(80).id, {}),
+        ]
+        for method, url, data in requests:
+            response = getattr(self.client, method)('/api/' + url, data, format='json')
+            self.assertEqual(response.status_code, 400, (method, url))
+            self.assertEqual(response.json(), {'error': 'Period closed before 2023-01-01 01:00:00'})
+
+        for url, rows in [('sales/bulk', [{'barcode': 2, 'quantity': 1, 'price': 100, 'saleTime': time_of[30]},
+                                          {'barcode': 1, 'quantity': 1, 'price': 100, 'saleTime': time_of[30]}]),
+                          ('supplies/bulk', [{'barcode': 1, 'quantity': 1, 'price': 100, 'supplyTime': time_of[100]},
+                                             {'barcode': 1, 'quantity': 1, 'price': 100, 'supplyTime': time_of[70]}])]:
+            self.assertEqual(self.client.post('/api/' + url, rows, format='json').status_code, 400, url)
+        self.assertEqual(self.ledger(), ledger)
+
+    def test_later_edits_replay_from_the_checkpoint(self):
+        with mock.patch.object(recalculation, 'head_lot', wraps=recalculation.head_lot) as head_lot:
+            self.create_sale(1, 61, 3, 110)
+        self.assertIn(mock.call(self.checkpoint), head_lot.call_args_list)
+        self.assertLedgerReplays(1)
+
+        sale = self.sale_at(61)
+        self.write('put', 'sales/%d' % sale.id, quantity=5, price=115, saleTime=at(61).strftime(TIME_FORMAT))
+        self.write('delete', 'sales/%d' % self.sale_at(65).id)
+        # same time as the head lot, queued after it
+        self.create_supply(1, 80, 4, 65)
+        self.create_supply(1, 100, 3, 90)
+        supply = self.supply_at(120)
+        self.write('put', 'supplies/%d' % supply.id, quantity=2, price=85,
+                   supplyTime=at(120).strftime(TIME_FORMAT))
+        self.write('delete', 'supplies/%d' % self.supply_at(100).id)
+        self.assertLedgerReplays(1)
+        self.assertEqual(self.closed_rows()[0], self.closed[0])
+
+        # nothing in the closed period ran out of stock, so a replay of the whole history agrees
+        sales = Sale.objects.filter(barcode=1).order_by('sale_time', 'id')
+        supplies = Supply.objects.filter(barcode=1).order_by('supply_time', 'id')
+        totals, _ = loop_fifo(sales.values_list('quantity', 'price'), supplies.values_list('quantity', 'price'))
+        self.assertEqual(list(sales.values_list('total_revenue', 'total_net_profit', 'total_quantity')), totals)
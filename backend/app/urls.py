@@ -5,28 +5,47 @@ from django.urls import path, include
 from rest_framework import routers
 
 from .routers import CustomReadOnlyRouter
-from .views import get_reports, SaleViewSet, SupplyViewSet
+from .views import (
+    alist_sales, alist_supplies, aget_reports, aretrieve_sale, aretrieve_supply, get_batch_reports, get_lot_margins,
+    get_reports, get_report_series, get_stock, with_async_reads, SaleViewSet, SupplyViewSet
+)
 
 urlpatterns = [
-    path('reports', get_reports),
-    path('sales', SaleViewSet.as_view(actions={
+    path('reports', with_async_reads(get_reports, aget_reports)),
+    path('reports/batch', get_batch_reports),
+    path('reports/series', get_report_series),
+    path('reports/lots', get_lot_margins),
+    path('stock', get_stock),
+    path('sales', with_async_reads(SaleViewSet.as_view(actions={
         'get': 'list',
         'post': 'create'
-    })),
-    path('supplies', SupplyViewSet.as_view(actions={
+    }), alist_sales)),
+    path('supplies', with_async_reads(SupplyViewSet.as_view(actions={
         'get': 'list',
         'post': 'create'
+    }), alist_supplies)),
+    path('sales/export', SaleViewSet.as_view(actions={
+        'get': 'export'
+    })),
+    path('supplies/export', SupplyViewSet.as_view(actions={
+        'get': 'export'
+    })),
+    path('sales/bulk', SaleViewSet.as_view(actions={
+        'post': 'bulk_create'
     })),
-    path('sales/<int:pk>', SaleViewSet.as_view(actions={
+    path('supplies/bulk', SupplyViewSet.as_view(actions={
+        'post': 'bulk_create'
+    })),
+    path('sales/<int:pk>', with_async_reads(SaleViewSet.as_view(actions={
         'get': 'retrieve',
         'put': 'update',
         'patch': 'partial_update',
         'delete': 'destroy'
-    })),
-    path('supplies/<int:pk>', SupplyViewSet.as_view(actions={
+    }), aretrieve_sale)),
+    path('supplies/<int:pk>', with_async_reads(SupplyViewSet.as_view(actions={
         'get': 'retrieve',
         'put': 'update',
         'patch': 'partial_update',
         'delete': 'destroy'
-    })),
+    }), aretrieve_supply)),
 ]
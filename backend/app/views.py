@@ -1,116 +1,180 @@
-from django.db.models import Max, Q
-from django.http import JsonResponse
+from collections import defaultdict
+
+import orjson
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q, Subquery, Sum
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
 from django.utils import timezone
 
 from rest_framework import viewsets, status
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
 from rest_framework.response import Response
 
-from .models import Sale, Supply
+from .batch_reports import build_batch_reports
+from .checkpoints import closes_sale, closes_supply, latest_checkpoint, latest_checkpoints
+from .encoders import RowEncoder
+from .locks import barcode_lock
+from .metrics import render_metrics
+from .models import Allocation, Sale, Supply
+from .pagination import keyset_q
+from .renderers import CSVRenderer, NDJSONRenderer
+from .replicas import aget_recent, areplica_for, get_recent, reading_from, replica_for, replica_for_barcodes
+from .recalculation import (
+    ChangeBounds, append_sale, append_supply, get_barcode_state, place_supply, refresh_supply_totals, reprice_supply,
+    shift_supply_totals, supply_units_before
+)
+from .report_cache import acached_report, cached_report
+from .rollups import GRANULARITIES, get_series
 from .serializers import SaleSerializer, SupplySerializer, SaleUpdateSerializer, SupplyUpdateSerializer
+from .tasks import (
+    await_for_recalculation, is_deferred, schedule_recalculation, schedule_supply_recalculation, wait_for_recalculation,
+    wait_for_recalculations
+)
 
 UPDATE_DESTROY_STATUS = status.HTTP_200_OK
+EXPORT_CHUNK = 2000
+
+SALE_ROWS = RowEncoder(SaleSerializer)
+SUPPLY_ROWS = RowEncoder(SupplySerializer)
 
 
 def make_kwargs(barcode, from_time, to_time, is_sale):
     kwargs = {}
     if from_time:
-        from_time = timezone.datetime.strptime(from_time, '%Y-%m-%d %H:%M:%S')
+        from_time = timezone.make_aware(timezone.datetime.strptime(from_time, '%Y-%m-%d %H:%M:%S'))
         kwargs['sale_time__gte' if is_sale else 'supply_time__gte'] = from_time
     if to_time:
-        to_time = timezone.datetime.strptime(to_time, '%Y-%m-%d %H:%M:%S')
+        to_time = timezone.make_aware(timezone.datetime.strptime(to_time, '%Y-%m-%d %H:%M:%S'))
         kwargs['sale_time__lte' if is_sale else 'supply_time__lte'] = to_time
     if barcode:
         kwargs['barcode'] = barcode
     return kwargs
 
 
-def recalculate(sales, supplies, supply_avail_q=0, prev_sale=None):
-    upd_sales = []
-    supply = None
-    for sale in sales:
-        matched = False
-        sale.total_net_profit = prev_sale.total_net_profit if prev_sale else 0
-        sale.total_quantity = prev_sale.total_quantity if prev_sale else 0
-        sale.total_revenue = prev_sale.total_revenue if prev_sale else 0
-        sale_q = sale.quantity
-        while not matched:
-            try:
-                if supply is None and supply_avail_q:
-                    supply = next(supplies)
-                if not supply_avail_q:
-                    supply = next(supplies)
-                    supply_avail_q = supply.quantity
-            except StopIteration:
-                break
-            q_update = min(sale_q, supply_avail_q)
-            if sale_q <= supply_avail_q:
-                matched = True
-                sale.last_connected_supply = supply
-                sale.last_connected_supply_remaining_q = supply_avail_q - q_update
-            sale_q -= q_update
-            supply_avail_q -= q_update
-            sale.total_net_profit += (sale.price - supply.price) * q_update
-            sale.total_revenue += sale.price * q_update
-            sale.total_quantity += q_update
-        if not matched:
-            sale.total_revenue += sale.price * sale_q
-            sale.total_net_profit += sale.price * sale_q
-            sale.total_quantity += sale_q
-        if prev_sale:
-            prev_sale.last_connected_supply = None
-            prev_sale.last_connected_supply_remaining_q = None
-        prev_sale = sale
-        upd_sales.append(sale)
-        if len(upd_sales) > 1000:
-            Sale.objects.bulk_update(upd_sales, fields=[
-                'total_net_profit',
-                'total_quantity',
-                'total_revenue',
-                'last_connected_supply',
-                'last_connected_supply_remaining_q'
-            ])
-            upd_sales = []
-    Sale.objects.bulk_update(upd_sales, fields=[
-        'total_net_profit',
-        'total_quantity',
-        'total_revenue',
-        'last_connected_supply',
-        'last_connected_supply_remaining_q'
-    ])
-
-
-def get_sales(barcode):
-    all_sales = Sale.objects.filter(barcode=barcode).order_by('sale_time', 'id') \
-        .iterator(chunk_size=1000)
-    return all_sales
-
-
-def get_supplies(barcode, first_supply=None):
-    if first_supply:
-        return Supply.objects.filter(
-            Q(supply_time__gt=first_supply.supply_time) | Q(supply_time=first_supply.supply_time, id__gte=first_supply.id),
-            barcode=barcode
-        ).order_by('supply_time', 'id').iterator(chunk_size=1000)
-    all_supplies = Supply.objects.filter(barcode=barcode).order_by('supply_time', 'id') \
-        .iterator(chunk_size=1000)
-    return all_supplies
-
-
-def new_supply(new_sup):
-    recalculate(get_sales(new_sup.barcode), get_supplies(new_sup.barcode))
-
-
-
-def new_sale(new_sale_):
-    recalculate(get_sales(new_sale_.barcode), get_supplies(new_sale_.barcode))
+def group_by_barcode(instances):
+    groups = defaultdict(list)
+    for instance in instances:
+        groups[instance.barcode].append(instance)
+    return groups
+
+
+def keyset_chunks(queryset, fields, size):
+    """
+    The queryset in `fields` order, fetched `size` rows at a time with a keyset seek per chunk.
+    """
+    queryset = queryset.order_by(*fields)
+    chunk = list(queryset[:size])
+    while chunk:
+        yield from chunk
+        if len(chunk) < size:
+            return
+        last = chunk[-1]
+        chunk = list(queryset.filter(keyset_q(fields, [getattr(last, field) for field in fields]))[:size])
+
+
+def stream_export(view, queryset):
+    """
+    Streams the queryset in the negotiated export format. Rows are read in keyset ordered chunks
+    rather than from a server-side cursor, so memory use doesn't depend on the size of the range
+    and the export also works behind a transaction pooling pgbouncer.
+    """
+    renderer = view.request.accepted_renderer
+    serializer = view.get_serializer()
+    rows = (serializer.to_representation(instance) for instance in keyset_chunks(queryset, view.keyset_fields, EXPORT_CHUNK))
+    response = StreamingHttpResponse(
+        renderer.stream(rows, list(serializer.fields)),
+        content_type='%s; charset=%s' % (renderer.media_type, renderer.charset)
+    )
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (queryset.model._meta.model_name, renderer.format)
+    return response
+
+
+def list_rows(view, queryset, encoder):
+    """
+    List response encoded straight from `.values()` rows, same bytes as the serializer would give.
+    """
+    rows = queryset.values(*encoder.fields)
+    page = view.paginate_queryset(rows)
+    if page is None:
+        return HttpResponse(encoder.encode(rows), content_type='application/json')
+    return HttpResponse(encoder.encode(page), content_type='application/json', headers=view.paginator.get_page_headers())
+
+
+def retrieve_row(view, encoder):
+    lookup_url_kwarg = view.lookup_url_kwarg or view.lookup_field
+    queryset = view.filter_queryset(view.get_queryset()).values(*encoder.fields)
+    try:
+        row = get_recent(queryset, **{view.lookup_field: view.kwargs[lookup_url_kwarg]})
+    except (queryset.model.DoesNotExist, TypeError, ValueError, ValidationError):
+        raise Http404
+    return HttpResponse(encoder.encode_one(row), content_type='application/json')
+
+
+def error_response(exc):
+    return HttpResponse(orjson.dumps({'detail': str(exc.detail)}), status=exc.status_code, content_type='application/json')
+
+
+async def alist_rows(request, viewset, encoder, is_sale):
+    """
+    `list_rows` for async views: the page is read with async iteration, so the worker
+    serves other requests while the database answers.
+    """
+    request = Request(request)
+    barcode = request.query_params.get('barcode')
+    from_time = request.query_params.get('fromTime')
+    to_time = request.query_params.get('toTime')
+    queryset = viewset.queryset.filter(**make_kwargs(barcode, from_time, to_time, is_sale)).values(*encoder.fields)
+    paginator = viewset.pagination_class()
+    try:
+        with reading_from(await areplica_for(barcode)):
+            page = await paginator.apaginate_queryset(queryset, request, viewset)
+    except NotFound as exc:
+        return error_response(exc)
+    return HttpResponse(encoder.encode(page), content_type='application/json', headers=paginator.get_page_headers())
+
+
+async def aretrieve_row(viewset, encoder, pk):
+    try:
+        row = await aget_recent(viewset.queryset.values(*encoder.fields), pk=pk)
+    except viewset.queryset.model.DoesNotExist:
+        return error_response(NotFound())
+    return HttpResponse(encoder.encode_one(row), content_type='application/json')
+
+
+def with_async_reads(view, read):
+    """
+    Serves the GET requests of `view` with the async `read` view when ASYNC_READS is on,
+    the other methods keep going to `view` on the request's sync thread.
+    """
+    if not settings.ASYNC_READS:
+        return view
+    write = sync_to_async(view)
+
+    async def dispatch(request, *args, **kwargs):
+        if request.method == 'GET':
+            return await read(request, *args, **kwargs)
+        return await write(request, *args, **kwargs)
+
+    dispatch.csrf_exempt = getattr(view, 'csrf_exempt', False)
+    return dispatch
+
+
+def period_closed(checkpoint):
+    closed_at = timezone.localtime(checkpoint.closed_at).strftime('%Y-%m-%d %H:%M:%S')
+    return JsonResponse({'error': 'Period closed before %s' % closed_at}, status=400)
 
 
 class SaleViewSet(viewsets.ModelViewSet):
     queryset = Sale.objects.all()
+    keyset_fields = ('sale_time', 'id')
 
     def get_serializer_class(self):
-        if self.action == 'create':
+        if self.action in ('create', 'bulk_create'):
             return SaleSerializer
         elif self.action == 'update':
             return SaleUpdateSerializer
@@ -119,60 +183,109 @@ class SaleViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        max_sale_time = Sale.objects.filter(barcode=serializer.validated_data['barcode']).aggregate(Max('sale_time'))['sale_time__max']
-        self.perform_create(serializer)
-        if max_sale_time is not None and max_sale_time <= serializer.instance.sale_time:
-            sale = Sale.objects.get(id=Sale.objects.filter(sale_time=max_sale_time).aggregate(Max('id'))['id__max'])
-            if sale.last_connected_supply:   
-                supplies = get_supplies(serializer.instance.barcode, sale.last_connected_supply)
-                recalculate([serializer.instance], supplies, sale.last_connected_supply_remaining_q, sale)
-            else:
-                recalculate([serializer.instance], iter(()), prev_sale=sale)
-        else:
-            new_sale(serializer.instance)
+        with barcode_lock(serializer.validated_data['barcode']):
+            sale = Sale(**serializer.validated_data)
+            state = get_barcode_state(sale.barcode)
+            if append_sale(state, sale.sale_time, sale.quantity, sale.price, serializer.save) is None:
+                checkpoint = latest_checkpoint(sale.barcode)
+                if closes_sale(checkpoint, sale.sale_time):
+                    return period_closed(checkpoint)
+                self.perform_create(serializer)
+                sale_key = (serializer.instance.sale_time, serializer.instance.id)
+                schedule_recalculation(
+                    serializer.instance.barcode, *sale_key, bounds=ChangeBounds(sale=sale_key), trigger='create'
+                )
         headers = self.get_success_headers(serializer.data)
         return JsonResponse({'id': serializer.instance.id}, status=status.HTTP_200_OK, headers=headers)
 
+    def bulk_create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with barcode_lock(*(item['barcode'] for item in serializer.validated_data)):
+            checkpoints = latest_checkpoints({item['barcode'] for item in serializer.validated_data})
+            for item in serializer.validated_data:
+                if closes_sale(checkpoints.get(item['barcode']), item['sale_time']):
+                    return period_closed(checkpoints[item['barcode']])
+            sales = Sale.objects.bulk_create([Sale(**item) for item in serializer.validated_data], batch_size=1000)
+            for barcode, group in group_by_barcode(sales).items():
+                sale_keys = [(sale.sale_time, sale.id) for sale in group]
+                schedule_recalculation(
+                    barcode, *min(sale_keys), bounds=ChangeBounds(sale=max(sale_keys)), trigger='bulk_create'
+                )
+        return JsonResponse({'ids': [sale.id for sale in sales]}, status=status.HTTP_200_OK)
+
     def destroy(self, request, *args, **kwargs):
-        instance = self.get_object()
-        self.perform_destroy(instance)
-        recalculate(get_sales(instance.barcode), get_supplies(instance.barcode))
+        with barcode_lock(self.get_object().barcode):
+            instance = self.get_object()
+            checkpoint = latest_checkpoint(instance.barcode)
+            if closes_sale(checkpoint, instance.sale_time):
+                return period_closed(checkpoint)
+            sale_key = (instance.sale_time, instance.id)
+            self.perform_destroy(instance)
+            schedule_recalculation(instance.barcode, *sale_key, bounds=ChangeBounds(sale=sale_key), trigger='destroy')
         return Response(status=UPDATE_DESTROY_STATUS)
 
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop('partial', False)
-        instance = self.get_object()
-        serializer = self.get_serializer(instance, data=request.data, partial=partial)
-        serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
+        with barcode_lock(self.get_object().barcode):
+            instance = self.get_object()
+            serializer = self.get_serializer(instance, data=request.data, partial=partial)
+            serializer.is_valid(raise_exception=True)
+            checkpoint = latest_checkpoint(instance.barcode)
+            if closes_sale(checkpoint, instance.sale_time) \
+                    or closes_sale(checkpoint, serializer.validated_data.get('sale_time', instance.sale_time)):
+                return period_closed(checkpoint)
+            old_key = (instance.sale_time, instance.id)
+            self.perform_update(serializer)
+
+            if getattr(instance, '_prefetched_objects_cache', None):
+                instance._prefetched_objects_cache = {}
+
+            new_key = (instance.sale_time, instance.id)
+            schedule_recalculation(
+                instance.barcode, *min(old_key, new_key), bounds=ChangeBounds(sale=max(old_key, new_key)), trigger='update'
+            )
 
-        if getattr(instance, '_prefetched_objects_cache', None):
-            instance._prefetched_objects_cache = {}
+        return Response(status=UPDATE_DESTROY_STATUS)
 
-        recalculate(get_sales(instance.barcode), get_supplies(instance.barcode))
+    def get_renderers(self):
+        if self.action == 'export':
+            return [NDJSONRenderer(), CSVRenderer()]
+        return super().get_renderers()
 
-        return Response(status=UPDATE_DESTROY_STATUS)
+    def export(self, request, *args, **kwargs):
+        barcode = request.query_params.get('barcode')
+        from_time = request.query_params.get('fromTime')
+        to_time = request.query_params.get('toTime')
+        queryset = self.filter_queryset(self.get_queryset()).filter(**make_kwargs(barcode, from_time, to_time, is_sale=True))
+        return stream_export(self, queryset)
 
     def list(self, request, *args, **kwargs):
         barcode = request.query_params.get('barcode')
         from_time = request.query_params.get('fromTime')
         to_time = request.query_params.get('toTime')
         queryset = self.filter_queryset(self.get_queryset()).filter(**make_kwargs(barcode, from_time, to_time, is_sale=True))
+        with reading_from(replica_for(barcode)):
+            return list_rows(self, queryset, SALE_ROWS)
 
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+    def retrieve(self, request, *args, **kwargs):
+        return retrieve_row(self, SALE_ROWS)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+
+async def alist_sales(request):
+    return await alist_rows(request, SaleViewSet, SALE_ROWS, is_sale=True)
+
+
+async def aretrieve_sale(request, pk):
+    return await aretrieve_row(SaleViewSet, SALE_ROWS, pk)
 
 
 class SupplyViewSet(viewsets.ModelViewSet):
     queryset = Supply.objects.all()
+    keyset_fields = ('supply_time', 'id')
 
     def get_serializer_class(self):
-        if self.action == 'create':
+        if self.action in ('create', 'bulk_create'):
             return SupplySerializer
         elif self.action == 'update':
             return SupplyUpdateSerializer
@@ -181,78 +294,162 @@ class SupplyViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
-        max_sale_time = Sale.objects.filter(barcode=serializer.instance.barcode).aggregate(Max('sale_time'))['sale_time__max']
-        if max_sale_time is not None and max_sale_time < serializer.instance.supply_time:
-            pass
-        else:
-            new_supply(serializer.instance)
+        with barcode_lock(serializer.validated_data['barcode']):
+            supply = Supply(**serializer.validated_data)
+            state = get_barcode_state(supply.barcode)
+            if append_supply(state, supply.supply_time, supply.quantity, serializer.save) is None:
+                checkpoint = latest_checkpoint(supply.barcode)
+                if closes_supply(checkpoint, supply.supply_time):
+                    return period_closed(checkpoint)
+                self.perform_create(serializer)
+                instance = serializer.instance
+                schedule_supply_recalculation(
+                    instance.barcode, place_supply(instance), (instance.supply_time, instance.id), trigger='supply_create'
+                )
         headers = self.get_success_headers(serializer.data)
         return JsonResponse({'id': serializer.instance.id}, status=status.HTTP_200_OK, headers=headers)
 
+    def bulk_create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with barcode_lock(*(item['barcode'] for item in serializer.validated_data)):
+            checkpoints = latest_checkpoints({item['barcode'] for item in serializer.validated_data})
+            for item in serializer.validated_data:
+                if closes_supply(checkpoints.get(item['barcode']), item['supply_time']):
+                    return period_closed(checkpoints[item['barcode']])
+            supplies = Supply.objects.bulk_create([Supply(**item) for item in serializer.validated_data], batch_size=1000)
+            for barcode, group in group_by_barcode(supplies).items():
+                supply_keys = [(supply.supply_time, supply.id) for supply in group]
+                refresh_supply_totals(barcode, min(supply_keys))
+                schedule_supply_recalculation(
+                    barcode, supply_units_before(barcode, *min(supply_keys)), max(supply_keys), trigger='supply_bulk_create'
+                )
+        return JsonResponse({'ids': [supply.id for supply in supplies]}, status=status.HTTP_200_OK)
+
     def destroy(self, request, *args, **kwargs):
-        instance = self.get_object()
-        self.perform_destroy(instance)
-        recalculate(get_sales(instance.barcode), get_supplies(instance.barcode))
+        with barcode_lock(self.get_object().barcode):
+            instance = self.get_object()
+            checkpoint = latest_checkpoint(instance.barcode)
+            if closes_supply(checkpoint, instance.supply_time, instance.id):
+                return period_closed(checkpoint)
+            supply_key = (instance.supply_time, instance.id)
+            units_before = supply_units_before(instance.barcode, *supply_key)
+            # sales still pointing at the lot lie past the change point and are rewritten by the recalculation
+            Sale.objects.filter(last_connected_supply=instance) \
+                .update(last_connected_supply=None, last_connected_supply_remaining_q=None)
+            self.perform_destroy(instance)
+            shift_supply_totals(instance.barcode, supply_key, -instance.quantity)
+            schedule_supply_recalculation(instance.barcode, units_before, supply_key, trigger='supply_destroy')
         return Response(status=UPDATE_DESTROY_STATUS)
 
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop('partial', False)
-        instance = self.get_object()
-        serializer = self.get_serializer(instance, data=request.data, partial=partial)
-        serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
+        with barcode_lock(self.get_object().barcode):
+            instance = self.get_object()
+            serializer = self.get_serializer(instance, data=request.data, partial=partial)
+            serializer.is_valid(raise_exception=True)
+            checkpoint = latest_checkpoint(instance.barcode)
+            if closes_supply(checkpoint, instance.supply_time, instance.id) or closes_supply(
+                    checkpoint, serializer.validated_data.get('supply_time', instance.supply_time), instance.id):
+                return period_closed(checkpoint)
+            price_only = all(serializer.validated_data.get(field, getattr(instance, field)) == getattr(instance, field)
+                             for field in ('supply_time', 'quantity'))
+            if price_only and reprice_supply(get_barcode_state(instance.barcode), instance, serializer.save):
+                return Response(status=UPDATE_DESTROY_STATUS)
+            units_before = supply_units_before(instance.barcode, instance.supply_time, instance.id)
+            old_key, old_quantity = (instance.supply_time, instance.id), instance.quantity
+            self.perform_update(serializer)
+
+            if getattr(instance, '_prefetched_objects_cache', None):
+                instance._prefetched_objects_cache = {}
+
+            shift_supply_totals(instance.barcode, old_key, -old_quantity, exclude_id=instance.id)
+            units_before = min(units_before, place_supply(instance))
+            schedule_supply_recalculation(
+                instance.barcode, units_before, max(old_key, (instance.supply_time, instance.id)), trigger='supply_update'
+            )
 
-        if getattr(instance, '_prefetched_objects_cache', None):
-            instance._prefetched_objects_cache = {}
+        return Response(status=UPDATE_DESTROY_STATUS)
 
-        recalculate(get_sales(instance.barcode), get_supplies(instance.barcode))
+    def get_renderers(self):
+        if self.action == 'export':
+            return [NDJSONRenderer(), CSVRenderer()]
+        return super().get_renderers()
 
-        return Response(status=UPDATE_DESTROY_STATUS)
+    def export(self, request, *args, **kwargs):
+        barcode = request.query_params.get('barcode')
+        from_time = request.query_params.get('fromTime')
+        to_time = request.query_params.get('toTime')
+        queryset = self.filter_queryset(self.get_queryset()).filter(**make_kwargs(barcode, from_time, to_time, is_sale=False))
+        return stream_export(self, queryset)
 
     def list(self, request, *args, **kwargs):
         barcode = request.query_params.get('barcode')
         from_time = request.query_params.get('fromTime')
         to_time = request.query_params.get('toTime')
         queryset = self.filter_queryset(self.get_queryset()).filter(**make_kwargs(barcode, from_time, to_time, is_sale=False))
+        with reading_from(replica_for(barcode)):
+            return list_rows(self, queryset, SUPPLY_ROWS)
 
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+    def retrieve(self, request, *args, **kwargs):
+        return retrieve_row(self, SUPPLY_ROWS)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
 
+async def alist_supplies(request):
+    return await alist_rows(request, SupplyViewSet, SUPPLY_ROWS, is_sale=False)
 
-@api_view(['GET'])
-def get_reports(request):
-    barcode = request.query_params.get('barcode')
-    from_time = request.query_params.get('fromTime')
-    to_time = request.query_params.get('toTime')
 
-    if not barcode or not from_time or not to_time:
-        return JsonResponse({'error': 'Missing required parameters'}, status=400)
+async def aretrieve_supply(request, pk):
+    return await aretrieve_row(SupplyViewSet, SUPPLY_ROWS, pk)
+
+
+def last_sale_id(barcode, **time_filter):
+    return Subquery(
+        Sale.objects.filter(barcode=barcode, **time_filter).order_by('-sale_time', '-id').values('id')[:1]
+    )
+
+
+def boundary_sales(barcode, from_time, to_time):
+    """
+    Last sale up to `to_time` and last sale before `from_time`, fetched in one query.
+    Each boundary is an ordered LIMIT 1 lookup on the (barcode, sale_time, id) index.
+    """
+    return Sale.objects.filter(
+        Q(id=last_sale_id(barcode, sale_time__lte=to_time)) | Q(id=last_sale_id(barcode, sale_time__lt=from_time))
+    ).only('sale_time', 'total_revenue', 'total_net_profit', 'total_quantity')
+
+
+def get_boundary_sales(barcode, from_time, to_time):
+    return pick_boundaries(boundary_sales(barcode, from_time, to_time), from_time, to_time)
 
-    try:
-        from_time = timezone.datetime.strptime(from_time, '%Y-%m-%d %H:%M:%S')
-        to_time = timezone.datetime.strptime(to_time, '%Y-%m-%d %H:%M:%S')
-        barcode = int(barcode)
-    except ValueError:
-        return JsonResponse({'error': 'Invalid datetime format'}, status=400)
 
+async def aget_boundary_sales(barcode, from_time, to_time):
+    sales = [sale async for sale in boundary_sales(barcode, from_time, to_time)]
+    return pick_boundaries(sales, from_time, to_time)
+
+
+def pick_boundaries(sales, from_time, to_time):
     gt = lt = None
+    for sale in sales:
+        key = (sale.sale_time, sale.id)
+        if sale.sale_time <= to_time and (gt is None or key > (gt.sale_time, gt.id)):
+            gt = sale
+        if sale.sale_time < from_time and (lt is None or key > (lt.sale_time, lt.id)):
+            lt = sale
+    return gt, lt
+
 
-    gt_time = Sale.objects.filter(barcode=barcode, sale_time__lte=to_time).aggregate(Max('sale_time'))['sale_time__max']
-    lt_time = Sale.objects.filter(barcode=barcode, sale_time__lt=from_time).aggregate(Max('sale_time'))['sale_time__max']
+def build_report(barcode, from_time, to_time):
+    gt, lt = get_boundary_sales(barcode, timezone.make_aware(from_time), timezone.make_aware(to_time))
+    return report_between(barcode, gt, lt)
 
-    if gt_time:
-        gt_id = Sale.objects.filter(barcode=barcode, sale_time=gt_time).aggregate(Max('id'))['id__max']
-        gt = Sale.objects.get(id=gt_id)
-    if lt_time:
-        lt_id = Sale.objects.filter(barcode=barcode, sale_time=lt_time).aggregate(Max('id'))['id__max']
-        lt = Sale.objects.get(id=lt_id)
 
+async def abuild_report(barcode, from_time, to_time):
+    gt, lt = await aget_boundary_sales(barcode, timezone.make_aware(from_time), timezone.make_aware(to_time))
+    return report_between(barcode, gt, lt)
+
+
+def report_between(barcode, gt, lt):
     rev = prof = quantity = 0
     if gt:
         rev += gt.total_revenue
@@ -263,9 +460,226 @@ def get_reports(request):
         prof -= lt.total_net_profit
         quantity -= lt.total_quantity
 
-    return JsonResponse({
+    return {
         'barcode': barcode,
         'revenue': rev,
         'netProfit': prof,
         'quantity': quantity,
-    }, status=200)
+    }
+
+
+def report_params(query_params):
+    """
+    Barcode and time window of a report request, or the error response for invalid parameters.
+    """
+    barcode = query_params.get('barcode')
+    from_time = query_params.get('fromTime')
+    to_time = query_params.get('toTime')
+
+    if not barcode or not from_time or not to_time:
+        return None, JsonResponse({'error': 'Missing required parameters'}, status=400)
+
+    try:
+        from_time = timezone.datetime.strptime(from_time, '%Y-%m-%d %H:%M:%S')
+        to_time = timezone.datetime.strptime(to_time, '%Y-%m-%d %H:%M:%S')
+        barcode = int(barcode)
+    except ValueError:
+        return None, JsonResponse({'error': 'Invalid datetime format'}, status=400)
+    return (barcode, from_time, to_time), None
+
+
+@api_view(['GET'])
+def get_reports(request):
+    params, error = report_params(request.query_params)
+    if error:
+        return error
+    barcode, from_time, to_time = params
+
+    stale = is_deferred() and not wait_for_recalculation(barcode, settings.RECALCULATION_REPORT_WAIT)
+    with reading_from(replica_for(barcode)):
+        if stale:
+            report = build_report(barcode, from_time, to_time)
+            report['stale'] = True
+        else:
+            report = cached_report(barcode, from_time, to_time, lambda: build_report(barcode, from_time, to_time))
+    return JsonResponse(report, status=200)
+
+
+async def aget_reports(request):
+    params, error = report_params(request.GET)
+    if error:
+        return error
+    barcode, from_time, to_time = params
+
+    stale = is_deferred() and not await await_for_recalculation(barcode, settings.RECALCULATION_REPORT_WAIT)
+    with reading_from(await areplica_for(barcode)):
+        if stale:
+            report = await abuild_report(barcode, from_time, to_time)
+            report['stale'] = True
+        else:
+            report = await acached_report(barcode, from_time, to_time, lambda: abuild_report(barcode, from_time, to_time))
+    return JsonResponse(report, status=200)
+
+
+def batch_report_params(data):
+    """
+    Barcodes and time windows of a batch report request, or the error response for an invalid body.
+    """
+    barcodes = data.get('barcodes') if isinstance(data, dict) else None
+    windows = data.get('windows') if isinstance(data, dict) else None
+
+    if not isinstance(barcodes, list) or not isinstance(windows, list) or not barcodes or not windows:
+        return None, JsonResponse({'error': 'Missing required parameters'}, status=400)
+    if len(barcodes) * len(windows) > settings.REPORT_BATCH_MAX_SIZE:
+        return None, JsonResponse({'error': 'At most %d reports per batch' % settings.REPORT_BATCH_MAX_SIZE},
+                                  status=400)
+
+    try:
+        barcodes = [int(barcode) for barcode in barcodes]
+        windows = [(
+            timezone.datetime.strptime(window['from_time'], '%Y-%m-%d %H:%M:%S'),
+            timezone.datetime.strptime(window['to_time'], '%Y-%m-%d %H:%M:%S'),
+        ) for window in windows]
+    except (KeyError, TypeError):
+        return None, JsonResponse({'error': 'Missing required parameters'}, status=400)
+    except ValueError:
+        return None, JsonResponse({'error': 'Invalid datetime format'}, status=400)
+    return (barcodes, windows), None
+
+
+@api_view(['POST'])
+def get_batch_reports(request):
+    params, error = batch_report_params(request.data)
+    if error:
+        return error
+    barcodes, windows = params
+
+    stale = set()
+    if is_deferred():
+        stale = wait_for_recalculations(barcodes, settings.RECALCULATION_REPORT_WAIT)
+    with reading_from(replica_for_barcodes(barcodes)):
+        reports = build_batch_reports(barcodes, [
+            (timezone.make_aware(from_time), timezone.make_aware(to_time)) for from_time, to_time in windows
+        ])
+
+    windows = [(from_time.strftime('%Y-%m-%d %H:%M:%S'), to_time.strftime('%Y-%m-%d %H:%M:%S'))
+               for from_time, to_time in windows]
+    for n, report in enumerate(reports):
+        report['fromTime'], report['toTime'] = windows[n % len(windows)]
+        if report['barcode'] in stale:
+            report['stale'] = True
+    return JsonResponse({'reports': reports}, status=200)
+
+
+@api_view(['GET'])
+def get_report_series(request):
+    barcode = request.query_params.get('barcode')
+    from_time = request.query_params.get('fromTime')
+    to_time = request.query_params.get('toTime')
+    granularity = request.query_params.get('granularity')
+
+    if not barcode or not from_time or not to_time or not granularity:
+        return JsonResponse({'error': 'Missing required parameters'}, status=400)
+    if granularity not in GRANULARITIES:
+        return JsonResponse({'error': 'Invalid granularity'}, status=400)
+
+    try:
+        from_time = timezone.make_aware(timezone.datetime.strptime(from_time, '%Y-%m-%d %H:%M:%S'))
+        to_time = timezone.make_aware(timezone.datetime.strptime(to_time, '%Y-%m-%d %H:%M:%S'))
+        barcode = int(barcode)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid datetime format'}, status=400)
+
+    stale = is_deferred() and not wait_for_recalculation(barcode, settings.RECALCULATION_REPORT_WAIT)
+
+    report = {
+        'barcode': barcode,
+        'granularity': granularity,
+        'series': [{
+            'bucketStart': start.strftime('%Y-%m-%d %H:%M:%S'),
+            'revenue': revenue,
+            'netProfit': net_profit,
+            'quantity': quantity,
+        } for start, revenue, net_profit, quantity in get_series(barcode, from_time, to_time, granularity)],
+    }
+    if stale:
+        report['stale'] = True
+    return JsonResponse(report, status=200)
+
+
+def running_total(queryset, time_field, at):
+    """
+    Running total of the last row up to `at`, an ordered LIMIT 1 lookup on the (barcode, time, id) index.
+    """
+    return queryset.filter(**{time_field + '__lte': at}).order_by('-' + time_field, '-id') \
+        .values_list('total_quantity', flat=True).first() or 0
+
+
+@api_view(['GET'])
+def get_stock(request):
+    barcode = request.query_params.get('barcode')
+    at = request.query_params.get('at')
+
+    if not barcode or not at:
+        return JsonResponse({'error': 'Missing required parameters'}, status=400)
+
+    try:
+        at = timezone.make_aware(timezone.datetime.strptime(at, '%Y-%m-%d %H:%M:%S'))
+        barcode = int(barcode)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid datetime format'}, status=400)
+
+    stale = is_deferred() and not wait_for_recalculation(barcode, settings.RECALCULATION_REPORT_WAIT)
+
+    supplied = running_total(Supply.objects.filter(barcode=barcode), 'supply_time', at)
+    sold = running_total(Sale.objects.filter(barcode=barcode), 'sale_time', at)
+    stock = {
+        'barcode': barcode,
+        'at': at.strftime('%Y-%m-%d %H:%M:%S'),
+        'supplied': supplied,
+        'sold': sold,
+        'stock': supplied - sold,
+    }
+    if stale:
+        stock['stale'] = True
+    return JsonResponse(stock, status=200)
+
+
+def lot_margins(barcode, from_time, to_time):
+    """
+    Quantity, revenue and cost of the sales within the window by the supply lot they were taken
+    from, summed from the allocations. Units sold out of stock belong to no lot.
+    """
+    return Allocation.objects.filter(barcode=barcode, sale_time__gte=from_time, sale_time__lte=to_time) \
+        .values('supply_id', 'unit_cost') \
+        .annotate(sold=Sum('quantity'), revenue=Sum(F('quantity') * F('sale__price')),
+                  cost=Sum(F('quantity') * F('unit_cost'))) \
+        .order_by('supply_id')
+
+
+@api_view(['GET'])
+def get_lot_margins(request):
+    params, error = report_params(request.query_params)
+    if error:
+        return error
+    barcode, from_time, to_time = params
+
+    stale = is_deferred() and not wait_for_recalculation(barcode, settings.RECALCULATION_REPORT_WAIT)
+    with reading_from(replica_for(barcode)):
+        lots = [{
+            'supplyId': lot['supply_id'],
+            'unitCost': lot['unit_cost'],
+            'quantity': lot['sold'],
+            'revenue': lot['revenue'],
+            'cost': lot['cost'],
+            'netProfit': lot['revenue'] - lot['cost'],
+        } for lot in lot_margins(barcode, timezone.make_aware(from_time), timezone.make_aware(to_time))]
+    report = {'barcode': barcode, 'lots': lots}
+    if stale:
+        report['stale'] = True
+    return JsonResponse(report, status=200)
+
+
+@require_GET
+def get_metrics(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
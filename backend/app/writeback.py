@@ -0,0 +1,108 @@
+import io
+from itertools import islice
+
+from django.db import connection, transaction
+
+from .models import Allocation, Sale
+
+CHUNK_SIZE = 10000
+
+# (column, postgres type) of the rows written back, the sale id comes first
+SALE_TOTAL_COLUMNS = [
+    ('id', 'integer'),
+    ('total_net_profit', 'bigint'),
+    ('total_quantity', 'bigint'),
+    ('total_revenue', 'bigint'),
+    ('last_connected_supply_id', 'integer'),
+    ('last_connected_supply_remaining_q', 'integer'),
+]
+
+TEMP_TABLE = 'sale_totals_writeback'
+
+# columns of the allocation rows inserted by the replay
+ALLOCATION_COLUMNS = ['barcode', 'sale_id', 'sale_time', 'supply_id', 'quantity', 'unit_cost']
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_sale_totals(rows):
+    """
+    Stores (id, net profit, quantity, revenue, supply id, remaining q) rows on the sales,
+    without model instances. Postgres streams them into a temp table with COPY and applies
+    them with a single UPDATE ... FROM, other databases run an executemany UPDATE. Rows are
+    consumed chunk by chunk, so memory use doesn't grow with the number of rows.
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                _copy_update(cursor, rows)
+            else:
+                _executemany_update(cursor, rows)
+
+
+def _copy_update(cursor, rows):
+    # the temp table lives as long as the connection and is emptied after every transaction
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS %s (%s) ON COMMIT DELETE ROWS' % (
+        TEMP_TABLE, ', '.join('%s %s' % column for column in SALE_TOTAL_COLUMNS)
+    ))
+    cursor.execute('TRUNCATE %s' % TEMP_TABLE)
+
+    columns = [name for name, _ in SALE_TOTAL_COLUMNS]
+    copy_sql = 'COPY %s (%s) FROM STDIN' % (TEMP_TABLE, ', '.join(columns))
+    for chunk in chunks(rows, CHUNK_SIZE):
+        buffer = io.StringIO()
+        for row in chunk:
+            buffer.write('\t'.join(r'\N' if value is None else str(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+
+    cursor.execute('ANALYZE %s' % TEMP_TABLE)
+    cursor.execute('UPDATE %s AS sale SET %s FROM %s AS totals WHERE sale.id = totals.id' % (
+        Sale._meta.db_table,
+        ', '.join('%s = totals.%s' % (name, name) for name in columns[1:]),
+        TEMP_TABLE,
+    ))
+
+
+def _executemany_update(cursor, rows):
+    columns = [name for name, _ in SALE_TOTAL_COLUMNS]
+    sql = 'UPDATE %s SET %s WHERE id = %%s' % (
+        Sale._meta.db_table, ', '.join('%s = %%s' % name for name in columns[1:])
+    )
+    for chunk in chunks(rows, 1000):
+        cursor.executemany(sql, [row[1:] + row[:1] for row in chunk])
+
+
+def insert_allocations(rows):
+    """
+    Inserts (barcode, sale id, sale time, supply id, quantity, unit cost) allocation rows,
+    with COPY on Postgres and an executemany INSERT elsewhere, chunk by chunk.
+    """
+    table = Allocation._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            copy_sql = 'COPY %s (%s) FROM STDIN' % (table, ', '.join(ALLOCATION_COLUMNS))
+            for chunk in chunks(rows, CHUNK_SIZE):
+                buffer = io.StringIO()
+                for row in chunk:
+                    buffer.write('\t'.join(str(value) for value in row))
+                    buffer.write('\n')
+                buffer.seek(0)
+                cursor.copy_expert(copy_sql, buffer)
+        else:
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join(ALLOCATION_COLUMNS), ', '.join(['%s'] * len(ALLOCATION_COLUMNS))
+            )
+            for chunk in chunks(rows, 1000):
+                cursor.executemany(sql, [
+                    (barcode, sale_id, connection.ops.adapt_datetimefield_value(sale_time), *rest)
+                    for barcode, sale_id, sale_time, *rest in chunk
+                ])
@@ -12,5 +12,14 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+# reads use the async ORM under ASGI; every request runs its sync code on a thread of its own,
+# so persistent connections would pile up one per thread instead of being reused. They are off
+# here, and each request connects to the pgbouncer service of docker-compose.yml instead, which
+# keeps the postgres connections open (the entrypoint points POSTGRES_HOST at it). Without a
+# pooler every ASGI request opens a postgres connection of its own. In transaction pooling mode
+# a server-side cursor can't outlive the transaction, so `.iterator()` fetches client-side.
+os.environ.setdefault('ASYNC_READS', 'True')
+os.environ.setdefault('POSTGRES_CONN_MAX_AGE', '0')
+os.environ.setdefault('POSTGRES_DISABLE_SERVER_SIDE_CURSORS', 'True')
 
 application = get_asgi_application()
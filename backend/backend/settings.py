@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    'app.middleware.MetricsMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -131,11 +132,54 @@ DATABASES_ALL = {
         "USER": os.environ.get("POSTGRES_USER", "postgres"),
         "PASSWORD": os.environ.get("POSTGRES_PASSWORD", "postgres"),
         "PORT": int(os.environ.get("POSTGRES_PORT", "5432")),
+        # keep connections open between requests, checked for health before each reuse; asgi.py
+        # turns this off, under ASGI the pgbouncer service keeps them open instead
+        "CONN_MAX_AGE": int(os.environ.get("POSTGRES_CONN_MAX_AGE", "60")),
+        "CONN_HEALTH_CHECKS": True,
+        # server-side cursors don't survive pgbouncer in transaction pooling mode, set this there
+        "DISABLE_SERVER_SIDE_CURSORS": os.environ.get("POSTGRES_DISABLE_SERVER_SIDE_CURSORS", "False") == "True",
     },
 }
 
 DATABASES = {"default": DATABASES_ALL[DB_POSTGRESQL]}
 
+# optional streaming replica serving the reports, list and retrieve reads; a barcode written to
+# reads from the primary for REPLICA_PIN_SECONDS, as long as the replica may lag behind. The pins
+# live in the reports cache: without REPORT_CACHE_URL that is per process, and read-your-writes
+# only holds within the worker that wrote (the app.W001 check warns about it)
+REPLICA_DATABASE = "replica" if os.environ.get("POSTGRES_REPLICA_HOST") else None
+if REPLICA_DATABASE:
+    DATABASES[REPLICA_DATABASE] = {
+        **DATABASES["default"],
+        "HOST": os.environ["POSTGRES_REPLICA_HOST"],
+        "PORT": int(os.environ.get("POSTGRES_REPLICA_PORT", DATABASES["default"]["PORT"])),
+        "TEST": {"MIRROR": "default"},
+    }
+REPLICA_PIN_SECONDS = float(os.environ.get("REPLICA_PIN_SECONDS", "5"))
+# reads not limited to a barcode, like lists without one, are pinned by every write; off by default
+REPLICA_UNSCOPED_PIN_SECONDS = float(os.environ.get("REPLICA_UNSCOPED_PIN_SECONDS", "0"))
+DATABASE_ROUTERS = ["app.replicas.ReplicaRouter"]
+
+# reports are cached per (barcode, window) and invalidated by a per-barcode version bumped on
+# every write; with several worker processes point REPORT_CACHE_URL at redis so they share it
+REPORT_CACHE_URL = os.environ.get("REPORT_CACHE_URL")
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "reports": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REPORT_CACHE_URL,
+        "TIMEOUT": int(os.environ.get("REPORT_CACHE_TIMEOUT", "300")),
+    } if REPORT_CACHE_URL else {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "reports",
+        "TIMEOUT": int(os.environ.get("REPORT_CACHE_TIMEOUT", "300")),
+        "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("REPORT_CACHE_MAX_ENTRIES", "10000"))},
+    },
+}
+
 # set static URL address and path where to store static files
 STATIC_URL = "/django_static/"
 STATIC_ROOT = BASE_DIR / "django_static"
@@ -143,6 +187,9 @@ STATIC_ROOT = BASE_DIR / "django_static"
 
 REST_FRAMEWORK = {
 
+    'DEFAULT_PAGINATION_CLASS': 'app.pagination.KeysetPagination',
+    'PAGE_SIZE': int(os.environ.get("LIST_PAGE_SIZE", "1000")),
+
     'DEFAULT_RENDERER_CLASSES': (
         'djangorestframework_camel_case.render.CamelCaseJSONRenderer',
         # 'djangorestframework_camel_case.render.CamelCaseBrowsableAPIRenderer',
@@ -150,7 +197,41 @@ REST_FRAMEWORK = {
 
     'DEFAULT_PARSER_CLASSES': (
         'djangorestframework_camel_case.parser.CamelCaseJSONParser',
+        'app.parsers.CamelCaseNDJSONParser',
         # Any other parsers
     ),
 }
 
+
+# serve the reports, list and retrieve GETs with async views, switched on by backend/asgi.py
+ASYNC_READS = os.environ.get("ASYNC_READS", "False") == "True"
+
+# upper bound for the pageSize query parameter of the list endpoints
+LIST_MAX_PAGE_SIZE = int(os.environ.get("LIST_MAX_PAGE_SIZE", "10000"))
+# upper bound for barcodes x windows of one POST /reports/batch
+REPORT_BATCH_MAX_SIZE = int(os.environ.get("REPORT_BATCH_MAX_SIZE", "10000"))
+
+# FIFO recalculation: 'sync' runs it inside the write request, 'deferred' marks the
+# barcode dirty and leaves the work to the celery worker
+RECALCULATION_MODE = os.environ.get("RECALCULATION_MODE", "sync")
+# seconds a report waits for a dirty barcode before answering with stale data
+RECALCULATION_REPORT_WAIT = float(os.environ.get("RECALCULATION_REPORT_WAIT", "2"))
+
+# the in-memory broker only reaches workers inside the same process, use redis in deployments
+CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "memory://")
+CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "cache+memory://")
+CELERY_TASK_ALWAYS_EAGER = os.environ.get("CELERY_TASK_ALWAYS_EAGER", "False") == "True"
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_BEAT_SCHEDULE = {
+    "drain-dirty-barcodes": {
+        "task": "app.tasks.drain_dirty",
+        "schedule": 10.0,
+    },
+    "create-partitions": {
+        "task": "app.tasks.create_partitions",
+        "schedule": 3600.0,
+    },
+}
+
+# monthly partitions kept ready in advance once the tables are partitioned, see app.partitions
+PARTITION_MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", "3"))
@@ -0,0 +1,33 @@
+"""
+Settings for the test suite: the app settings on SQLite with celery tasks run eagerly on the
+in-memory broker, so the tests need neither postgres nor redis.
+
+    cd backend/
+    python manage.py test --settings=backend.test_settings
+"""
+import tempfile
+from pathlib import Path
+
+from .settings import *  # noqa: F401,F403
+
+TEST_DB_DIR = Path(tempfile.gettempdir())
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'TEST': {'NAME': str(TEST_DB_DIR / 'umag-test-primary.sqlite3')},
+    },
+    # stands in for the read replica, reads only go there with REPLICA_DATABASE set
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db-replica.sqlite3',
+        'TEST': {'NAME': str(TEST_DB_DIR / 'umag-test-replica.sqlite3')},
+    },
+}
+REPLICA_DATABASE = None
+
+RECALCULATION_MODE = 'sync'
+CELERY_BROKER_URL = 'memory://'
+CELERY_RESULT_BACKEND = 'cache+memory://'
+CELERY_TASK_ALWAYS_EAGER = True
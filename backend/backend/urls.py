@@ -2,7 +2,10 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework import routers
 
+from app.views import get_metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('api/', include('app.urls'))
+    path('api/', include('app.urls')),
+    path('metrics', get_metrics),
 ]
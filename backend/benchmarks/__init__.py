@@ -0,0 +1,12 @@
+import os
+
+
+def setup():
+    """
+    Configures Django with the benchmark settings and migrates the (throwaway) database.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
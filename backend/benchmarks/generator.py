@@ -0,0 +1,60 @@
+"""
+Deterministic synthetic sales and supplies. The same arguments always produce the same rows,
+so timings of different releases are taken on identical data.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+SALE_INTERVAL = timedelta(minutes=5)
+
+
+def generate(barcodes=10, sales_per_barcode=1000, supply_every=50, out_of_order=0.0, seed=0):
+    """
+    Yields ('sale' | 'supply', fields) in insertion order. Each barcode sells about one unit
+    every SALE_INTERVAL and is restocked every `supply_every` sales with roughly what sold since
+    the last supply. A share of `out_of_order` sales is inserted back-dated, up to a day before
+    the sales already inserted.
+    """
+    rnd = random.Random(seed)
+    for barcode in range(1, barcodes + 1):
+        since_supply = supply_every
+        for index in range(sales_per_barcode):
+            moment = START + index * SALE_INTERVAL
+            if since_supply >= supply_every:
+                yield 'supply', {
+                    'barcode': barcode,
+                    'quantity': rnd.randint(supply_every, supply_every * 3),
+                    'price': rnd.randint(50, 100),
+                    'supply_time': moment - timedelta(seconds=1),
+                }
+                since_supply = 0
+            if rnd.random() < out_of_order:
+                moment -= timedelta(seconds=rnd.randint(1, 24 * 3600))
+            yield 'sale', {
+                'barcode': barcode,
+                'quantity': rnd.randint(1, 3),
+                'price': rnd.randint(100, 150),
+                'sale_time': moment,
+            }
+            since_supply += 1
+
+
+def load(rows, batch_size=5000):
+    """
+    Inserts generated rows with bulk_create, without recalculating the sales. The supplies get
+    their running totals: `generate` yields them in (supply_time, id) order. Returns the barcodes.
+    """
+    from app.models import Sale, Supply
+    sales, supplies, supplied = [], [], {}
+    for kind, fields in rows:
+        barcode = fields['barcode']
+        supplied.setdefault(barcode, 0)
+        if kind == 'sale':
+            sales.append(Sale(**fields))
+        else:
+            supplied[barcode] += fields['quantity']
+            supplies.append(Supply(**fields, total_quantity=supplied[barcode]))
+    Supply.objects.bulk_create(supplies, batch_size=batch_size)
+    Sale.objects.bulk_create(sales, batch_size=batch_size)
+    return sorted(supplied)
@@ -0,0 +1,425 @@
+"""
+Concurrent load test of a local server process, with the requests of the Postman collection.
+
+    cd backend/
+    python -m benchmarks.load --server runserver --concurrency 8 --requests 2000 --output load.json
+
+Seeds a SQLite file (a temporary one unless BENCHMARK_DB is set) with generated data, starts
+the server on it and sends a weighted mix of appended and back-dated sales, back-dated
+supplies, updates, deletes, reports and lists from `--concurrency` client threads. The
+method, path and parameter names of every operation come from the collection. Prints a
+JSON summary: throughput, latency percentiles and status codes per operation, and the sales
+and supply running totals that differ from a from-scratch recomputation after the run.
+Exits with status 1 when any do.
+
+SQLite takes one writer at a time and the server serializes its writes in-process, so with
+several gunicorn or uvicorn workers concurrent writes fail as 500s ("database is locked").
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from typing import NamedTuple
+
+import django
+
+from benchmarks import setup
+from benchmarks.generator import SALE_INTERVAL, START, generate, load
+from benchmarks.scale import TIME_FORMAT, summarize
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+COLLECTION = BACKEND_DIR.parent / 'collection.json'
+
+# operation: (collection request, default weight)
+OPERATIONS = {
+    'append_sale': ('Create sale', 40),
+    'backdated_sale': ('Create sale', 5),
+    'backdated_supply': ('Create Supply', 5),
+    'update_sale': ('Update sale', 5),
+    'update_supply': ('Edit Supply', 3),
+    'delete_sale': ('Delete Sale', 2),
+    'delete_supply': ('Delete Supply', 1),
+    'report': ('Get report', 35),
+    'list_sales': ('Get sales', 4),
+}
+
+SERVERS = {
+    'runserver': lambda address, workers: [
+        sys.executable, 'manage.py', 'runserver', '--noreload', '%s:%d' % address,
+    ],
+    'gunicorn': lambda address, workers: [
+        sys.executable, '-m', 'gunicorn', 'backend.wsgi', '--bind', '%s:%d' % address,
+        '--workers', str(workers), '--threads', '8',
+    ],
+    'uvicorn': lambda address, workers: [
+        sys.executable, '-m', 'uvicorn', 'backend.asgi:application', '--host', address[0],
+        '--port', str(address[1]), '--workers', str(workers), '--log-level', 'warning',
+    ],
+}
+
+PLACEHOLDER = re.compile(r'{{(\w+)}}')
+
+
+class Endpoint(NamedTuple):
+    """
+    A request of the collection: method, path with {{variables}}, query and body field names.
+    """
+    method: str
+    path: str
+    query: tuple
+    body: tuple
+
+    def render(self, variables, fields):
+        path = PLACEHOLDER.sub(lambda match: str(variables[match.group(1)]), self.path)
+        if self.query:
+            path += '?' + '&'.join('%s=%s' % (key, str(fields[key]).replace(' ', '%20')) for key in self.query)
+        body = json.dumps({key: fields[key] for key in self.body}) if self.body else None
+        return path, body
+
+
+def read_collection(path):
+    """
+    Endpoints of the collection by request name.
+    """
+    with open(path) as collection:
+        items = json.load(collection)['item']
+    endpoints = {}
+    while items:
+        item = items.pop()
+        if 'item' in item:
+            items.extend(item['item'])
+            continue
+        request = item['request']
+        url = request['url']
+        raw = url['raw'] if isinstance(url, dict) else url
+        body = (request.get('body') or {}).get('raw') or ''
+        endpoints[item['name']] = Endpoint(
+            method=request['method'],
+            path=raw.split('?')[0].replace('{{base_url}}', ''),
+            query=tuple(param['key'] for param in (url.get('query') or []) if not param.get('disabled'))
+            if isinstance(url, dict) else (),
+            # the values are examples or variables, only the field names are kept
+            body=tuple(json.loads(PLACEHOLDER.sub('0', body))) if body.strip() else (),
+        )
+    return endpoints
+
+
+class IdPool:
+    """
+    Ids of the rows still there, handed out to one update or delete at a time.
+    """
+    def __init__(self, ids):
+        self._guard = threading.Lock()
+        self._ids = list(ids)
+
+    def add(self, row_id):
+        with self._guard:
+            self._ids.append(row_id)
+
+    def take(self, rnd):
+        with self._guard:
+            if not self._ids:
+                return None
+            index = rnd.randrange(len(self._ids))
+            self._ids[index], self._ids[-1] = self._ids[-1], self._ids[index]
+            return self._ids.pop()
+
+
+class LoadTest:
+    """
+    The operations of the mix against the server at `address`, each timed from sending the
+    request to reading the whole response.
+    """
+    def __init__(self, address, endpoints, barcodes, sales_per_barcode):
+        from app.models import Sale, Supply
+        self.address = address
+        self.endpoints = endpoints
+        self.barcodes = barcodes
+        self.history_end = START + sales_per_barcode * SALE_INTERVAL
+        self.appended = itertools.count(1)
+        self.sales = IdPool(Sale.objects.values_list('id', flat=True))
+        self.supplies = IdPool(Supply.objects.values_list('id', flat=True))
+        self._guard = threading.Lock()
+        self.timings = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def send(self, operation, variables=None, fields=None):
+        endpoint = self.endpoints[OPERATIONS[operation][0]]
+        path, body = endpoint.render(variables or {}, fields or {})
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        # a connection per request, keep-alive support differs between the servers
+        connection = http.client.HTTPConnection(*self.address, timeout=60)
+        started = time.perf_counter()
+        try:
+            connection.request(endpoint.method, '/' + path.lstrip('/'), body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException) as exc:
+            content, status = b'', type(exc).__name__
+        finally:
+            connection.close()
+        elapsed = time.perf_counter() - started
+        with self._guard:
+            self.statuses[operation][status] += 1
+            if status in (200, 201):
+                self.timings[operation].append(elapsed)
+        return json.loads(content) if status in (200, 201) and content else None
+
+    def random_moment(self, rnd):
+        return START + (self.history_end - START) * rnd.random()
+
+    def sale(self, rnd, barcode, moment):
+        return {
+            'barcode': barcode,
+            'quantity': rnd.randint(1, 3),
+            'price': rnd.randint(100, 150),
+            'saleTime': moment.strftime(TIME_FORMAT),
+        }
+
+    def supply(self, rnd, barcode, moment):
+        return {
+            'barcode': barcode,
+            'quantity': rnd.randint(50, 150),
+            'price': rnd.randint(50, 100),
+            'supplyTime': moment.strftime(TIME_FORMAT),
+        }
+
+    def append_sale(self, rnd, barcode):
+        moment = self.history_end + next(self.appended) * timedelta(seconds=1)
+        created = self.send('append_sale', fields=self.sale(rnd, barcode, moment))
+        if created:
+            self.sales.add(created['id'])
+
+    def backdated_sale(self, rnd, barcode):
+        created = self.send('backdated_sale', fields=self.sale(rnd, barcode, self.random_moment(rnd)))
+        if created:
+            self.sales.add(created['id'])
+
+    def backdated_supply(self, rnd, barcode):
+        created = self.send('backdated_supply', fields=self.supply(rnd, barcode, self.random_moment(rnd)))
+        if created:
+            self.supplies.add(created['id'])
+
+    def update_sale(self, rnd, barcode):
+        sale_id = self.sales.take(rnd)
+        if sale_id is not None:
+            self.send('update_sale', {'saleId': sale_id}, self.sale(rnd, barcode, self.random_moment(rnd)))
+            self.sales.add(sale_id)
+
+    def update_supply(self, rnd, barcode):
+        supply_id = self.supplies.take(rnd)
+        if supply_id is not None:
+            self.send('update_supply', {'supplyId': supply_id}, self.supply(rnd, barcode, self.random_moment(rnd)))
+            self.supplies.add(supply_id)
+
+    def delete_sale(self, rnd, barcode):
+        sale_id = self.sales.take(rnd)
+        if sale_id is not None:
+            self.send('delete_sale', {'saleId': sale_id})
+
+    def delete_supply(self, rnd, barcode):
+        supply_id = self.supplies.take(rnd)
+        if supply_id is not None:
+            self.send('delete_supply', {'supplyId': supply_id})
+
+    def report(self, rnd, barcode):
+        from_time, to_time = sorted([self.random_moment(rnd), self.random_moment(rnd)])
+        self.send('report', fields={
+            'barcode': barcode, 'fromTime': from_time.strftime(TIME_FORMAT), 'toTime': to_time.strftime(TIME_FORMAT),
+        })
+
+    def list_sales(self, rnd, barcode):
+        from_time = self.random_moment(rnd)
+        self.send('list_sales', fields={
+            'barcode': barcode, 'fromTime': from_time.strftime(TIME_FORMAT),
+            'toTime': (from_time + 100 * SALE_INTERVAL).strftime(TIME_FORMAT),
+        })
+
+    def run(self, mix, requests, concurrency, seed):
+        operations, weights = zip(*mix.items())
+        remaining = itertools.count(requests, -1)
+
+        def client(index):
+            rnd = random.Random('%s-%d' % (seed, index))
+            while next(remaining) > 0:
+                operation = rnd.choices(operations, weights)[0]
+                getattr(self, operation)(rnd, rnd.choice(self.barcodes))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(client, range(concurrency)))
+        return time.perf_counter() - started
+
+
+def parse_mix(value):
+    """
+    Weights of the operations: the defaults, updated by "operation=weight,..." from `value`.
+    """
+    mix = {operation: weight for operation, (_, weight) in OPERATIONS.items()}
+    for part in filter(None, (value or '').split(',')):
+        operation, _, weight = part.partition('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError('unknown operation %r, one of %s' % (operation, ', '.join(OPERATIONS)))
+        try:
+            mix[operation] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('weight of %s should be a number' % operation)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError('at least one operation needs a weight')
+    return {operation: weight for operation, weight in mix.items() if weight > 0}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_failed(message, log):
+    log.flush()
+    with open(log.name) as output:
+        return RuntimeError('%s:\n%s' % (message, output.read()[-2000:]))
+
+
+def start_server(kind, address, workers, log):
+    """
+    Starts the server on the benchmark settings and waits until it accepts connections.
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE='benchmarks.settings')
+    server = subprocess.Popen(SERVERS[kind](address, workers), cwd=BACKEND_DIR, env=env, stdout=log,
+                              stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise server_failed('%s exited with %s' % (kind, server.returncode), log)
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise server_failed('%s did not start listening within 30s' % kind, log)
+
+
+def divergence(barcodes):
+    """
+    Stored running totals that differ from a recomputation from scratch, over all barcodes.
+    """
+    from app.management.commands.rebuild_ledger import rebuild_barcode
+    result = {'sales': 0, 'mismatched_sales': 0, 'mismatched_supplies': 0, 'examples': []}
+    for barcode in barcodes:
+        diff = rebuild_barcode(barcode, dry_run=True)
+        result['sales'] += diff['sales']
+        result['mismatched_sales'] += diff['rows']
+        result['mismatched_supplies'] += diff['supplies']
+        result['examples'] += [dict(example, barcode=barcode) for example in diff['examples']]
+    result['examples'] = result['examples'][:10]
+    return result
+
+
+def run(args, workdir):
+    os.environ.setdefault('BENCHMARK_DB', str(Path(workdir) / 'load.sqlite3'))
+    endpoints = read_collection(args.collection)
+    missing = {name for name, _ in OPERATIONS.values()} - set(endpoints)
+    if missing:
+        raise RuntimeError('%s lacks the requests %s' % (args.collection, ', '.join(sorted(missing))))
+
+    setup()
+    from django.db import connections
+    from app.management.commands.rebuild_ledger import rebuild_barcode
+    barcodes = load(generate(args.barcodes, args.sales, args.supply_every, args.out_of_order, args.seed))
+    for barcode in barcodes:
+        rebuild_barcode(barcode)
+    connections.close_all()
+
+    address = ('127.0.0.1', args.port or free_port())
+    with open(Path(workdir) / 'server.log', 'w') as log:
+        server = start_server(args.server, address, args.workers, log)
+        try:
+            test = LoadTest(address, endpoints, barcodes, args.sales)
+            seconds = test.run(args.mix, args.requests, args.concurrency, args.seed)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    results = {}
+    for operation in args.mix:
+        endpoint = endpoints[OPERATIONS[operation][0]]
+        results[operation] = {
+            'endpoint': '%s %s' % (endpoint.method, endpoint.path),
+            'statuses': {str(status): count for status, count in sorted(test.statuses[operation].items(), key=str)},
+            **summarize(test.timings[operation]),
+        }
+    sent = sum(sum(statuses.values()) for statuses in test.statuses.values())
+    return {
+        'config': {
+            'server': args.server,
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'mix': args.mix,
+            'barcodes': args.barcodes,
+            'sales_per_barcode': args.sales,
+            'supply_every': args.supply_every,
+            'out_of_order': args.out_of_order,
+            'seed': args.seed,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': 'sqlite',
+        },
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(sent / seconds, 1) if seconds else None,
+        'results': results,
+        'divergence': divergence(barcodes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--server', choices=sorted(SERVERS), default='runserver')
+    parser.add_argument('--workers', type=int, default=1, help='Server processes, gunicorn and uvicorn only.')
+    parser.add_argument('--port', type=int, help='Port of the server, a free one by default.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Client threads sending requests.')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests over all client threads.')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(None),
+                        help='Weights of the operations, "append_sale=40,report=35,...", the others keep their '
+                             'default, 0 leaves one out. Operations: %s.' % ', '.join(OPERATIONS))
+    parser.add_argument('--collection', default=str(COLLECTION), help='Postman collection describing the API.')
+    parser.add_argument('--barcodes', type=int, default=5)
+    parser.add_argument('--sales', type=int, default=500, help='Seeded sales per barcode.')
+    parser.add_argument('--supply-every', type=int, default=50, help='Sales between two seeded supplies of a barcode.')
+    parser.add_argument('--out-of-order', type=float, default=0.0, help='Share of back-dated seeded sales, 0 to 1.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Also write the JSON result to this file.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        result = run(args, workdir)
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    if result['divergence']['mismatched_sales'] or result['divergence']['mismatched_supplies']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
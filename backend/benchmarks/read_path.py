@@ -0,0 +1,93 @@
+"""
+Rows per second of the sale list endpoint, serializer path against the `.values()` path.
+
+    cd backend/
+    python -m benchmarks.read_path --rows 100000 --page-size 10000
+
+Prints a JSON summary. Both paths are checked to answer with the same bytes.
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks import setup
+
+
+def seed(rows):
+    from app.models import Sale
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    Sale.objects.bulk_create([
+        Sale(barcode=i % 10, quantity=i % 7 + 1, price=1000 + i % 500, sale_time=start + timedelta(seconds=i))
+        for i in range(rows)
+    ], batch_size=5000)
+
+
+def serializer_view():
+    from app.views import SaleViewSet
+
+    class SerializerSaleViewSet(SaleViewSet):
+        """
+        The list as it was before the `.values()` path.
+        """
+        def list(self, request, *args, **kwargs):
+            page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+    return SerializerSaleViewSet.as_view({'get': 'list'})
+
+
+def fetch_all(view, page_size):
+    """
+    Walks all pages following the `Link` header, returns the bodies.
+    """
+    from rest_framework.test import APIRequestFactory
+    factory = APIRequestFactory()
+    url = '/api/sales?pageSize=%d' % page_size
+    bodies = []
+    while url:
+        response = view(factory.get(url))
+        if hasattr(response, 'render'):
+            response.render()
+        bodies.append(response.content)
+        link = response.get('Link')
+        url = link[1:link.index('>')] if link else None
+    return bodies
+
+
+def measure(view, rows, page_size, repeat):
+    best, bodies = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        bodies = fetch_all(view, page_size)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {'seconds': round(best, 4), 'rows_per_second': round(rows / best)}, bodies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--page-size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup()
+    from app.views import SaleViewSet
+    seed(args.rows)
+
+    before, before_bodies = measure(serializer_view(), args.rows, args.page_size, args.repeat)
+    after, after_bodies = measure(SaleViewSet.as_view({'get': 'list'}), args.rows, args.page_size, args.repeat)
+    print(json.dumps({
+        'rows': args.rows,
+        'page_size': args.page_size,
+        'serializer': before,
+        'values': after,
+        'speedup': round(before['seconds'] / after['seconds'], 2),
+        'identical': before_bodies == after_bodies,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
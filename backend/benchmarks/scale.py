@@ -0,0 +1,164 @@
+"""
+Times the FIFO recalculation and the write and report endpoints on generated data.
+
+    cd backend/
+    python -m benchmarks.scale --barcodes 20 --sales 5000 --supply-every 50 --out-of-order 0.1 --output result.json
+
+Runs on SQLite (in memory unless BENCHMARK_DB is set) and prints the results as JSON:
+the configuration plus count, mean, p50, p95, p99 and max milliseconds per operation.
+"""
+import argparse
+import json
+import platform
+import random
+import time
+from datetime import timedelta
+
+import django
+
+from benchmarks import setup
+from benchmarks.generator import SALE_INTERVAL, START, generate, load
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    if not timings:
+        return {'count': 0}
+
+    def percentile(share):
+        return round(timings[min(len(timings) - 1, int(share * len(timings)))] * 1000, 3)
+
+    return {
+        'count': len(timings),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(timings[-1] * 1000, 3),
+    }
+
+
+def timed(call):
+    started = time.perf_counter()
+    response = call()
+    elapsed = time.perf_counter() - started
+    # recalculations return their stats, only responses are checked
+    if getattr(response, 'status_code', 200) != 200:
+        raise RuntimeError('%s answered %s: %s' % (call, response.status_code, response.content[:200]))
+    return elapsed
+
+
+class Scenario:
+    """
+    Operations against the loaded data, driven by a seeded random generator.
+    """
+    def __init__(self, barcodes, sales_per_barcode, seed):
+        from rest_framework.test import APIClient
+        self.client = APIClient()
+        self.barcodes = barcodes
+        self.rnd = random.Random(seed)
+        self.history_end = START + sales_per_barcode * SALE_INTERVAL
+        self.appended = 0
+
+    def random_moment(self):
+        return START + (self.history_end - START) * self.rnd.random()
+
+    def random_sale_id(self, barcode):
+        from app.models import Sale
+        ids = Sale.objects.filter(barcode=barcode).values_list('id', flat=True)
+        return self.rnd.choice(list(ids))
+
+    def sale(self, barcode, moment):
+        return {
+            'barcode': barcode,
+            'quantity': self.rnd.randint(1, 3),
+            'price': self.rnd.randint(100, 150),
+            'saleTime': moment.strftime(TIME_FORMAT),
+        }
+
+    def recalculate(self, barcode):
+        from app.recalculation import recalculate_from
+        return timed(lambda: recalculate_from(barcode))
+
+    def create_append(self, barcode):
+        self.appended += 1
+        moment = self.history_end + self.appended * timedelta(seconds=1)
+        return timed(lambda: self.client.post('/api/sales', self.sale(barcode, moment), format='json'))
+
+    def create_backdated(self, barcode):
+        data = self.sale(barcode, self.random_moment())
+        return timed(lambda: self.client.post('/api/sales', data, format='json'))
+
+    def update(self, barcode):
+        url = '/api/sales/%d' % self.random_sale_id(barcode)
+        data = self.sale(barcode, self.random_moment())
+        del data['barcode']
+        return timed(lambda: self.client.put(url, data, format='json'))
+
+    def destroy(self, barcode):
+        url = '/api/sales/%d' % self.random_sale_id(barcode)
+        return timed(lambda: self.client.delete(url))
+
+    def report(self, barcode):
+        from_time, to_time = sorted([self.random_moment(), self.random_moment()])
+        params = {'barcode': barcode, 'fromTime': from_time.strftime(TIME_FORMAT), 'toTime': to_time.strftime(TIME_FORMAT)}
+        return timed(lambda: self.client.get('/api/reports', params))
+
+
+OPERATIONS = ['create_append', 'create_backdated', 'update', 'destroy', 'report']
+
+
+def run(args):
+    setup()
+    started = time.perf_counter()
+    barcodes = load(generate(args.barcodes, args.sales, args.supply_every, args.out_of_order, args.seed))
+    load_seconds = time.perf_counter() - started
+
+    scenario = Scenario(barcodes, args.sales, args.seed)
+    results = {'recalculate': summarize([scenario.recalculate(barcode) for barcode in barcodes])}
+    for operation in OPERATIONS:
+        results[operation] = summarize([
+            getattr(scenario, operation)(scenario.rnd.choice(barcodes)) for _ in range(args.ops)
+        ])
+
+    return {
+        'config': {
+            'barcodes': args.barcodes,
+            'sales_per_barcode': args.sales,
+            'supply_every': args.supply_every,
+            'out_of_order': args.out_of_order,
+            'ops': args.ops,
+            'seed': args.seed,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': 'sqlite',
+        },
+        'load_seconds': round(load_seconds, 3),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--barcodes', type=int, default=10)
+    parser.add_argument('--sales', type=int, default=2000, help='Sales per barcode.')
+    parser.add_argument('--supply-every', type=int, default=50, help='Sales between two supplies of a barcode.')
+    parser.add_argument('--out-of-order', type=float, default=0.0, help='Share of back-dated sale inserts, 0 to 1.')
+    parser.add_argument('--ops', type=int, default=100, help='Requests per timed endpoint operation.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Also write the JSON result to this file.')
+    args = parser.parse_args()
+
+    result = json.dumps(run(args), indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""
+Settings for the benchmarks: the app settings on a throwaway SQLite database, so they run
+without the docker services.
+"""
+import os
+
+from backend.settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('BENCHMARK_DB', ':memory:'),
+    }
+}
+
+# a second SQLite file stands in for the read replica, copy the primary over to "replicate"
+if os.environ.get('BENCHMARK_REPLICA_DB'):
+    REPLICA_DATABASE = 'replica'
+    DATABASES[REPLICA_DATABASE] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['BENCHMARK_REPLICA_DB'],
+    }
+
+RECALCULATION_MODE = 'sync'
+CELERY_TASK_ALWAYS_EAGER = True
+# keeps connection.queries from growing over thousands of requests
+DEBUG = False
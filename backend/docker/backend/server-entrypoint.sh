@@ -17,7 +17,18 @@ python manage.py collectstatic --noinput
 
 # python manage.py createsuperuser --noinput
 
-gunicorn backend.wsgi --bind 0.0.0.0:8000 --workers 4 --threads 4
+# SERVER_INTERFACE=asgi serves the reads with the async views; it opens a connection per request,
+# so it goes through pgbouncer when PGBOUNCER_HOST is set (migrations above connect directly)
+if [ "$SERVER_INTERFACE" = "asgi" ]
+then
+    if [ -n "$PGBOUNCER_HOST" ]
+    then
+        export POSTGRES_HOST="$PGBOUNCER_HOST" POSTGRES_PORT="${PGBOUNCER_PORT:-6432}"
+    fi
+    gunicorn backend.asgi --bind 0.0.0.0:8000 --workers 4 --worker-class uvicorn.workers.UvicornWorker
+else
+    gunicorn backend.wsgi --bind 0.0.0.0:8000 --workers 4 --threads 4
+fi
 
 # for debug
 #python manage.py runserver 0.0.0.0:8000
\ No newline at end of file
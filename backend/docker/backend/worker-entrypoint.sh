@@ -0,0 +1,8 @@
+#!/bin/sh
+
+until cd /app/backend
+do
+    echo "Waiting for server volume..."
+done
+
+celery -A backend worker -B --loglevel=info